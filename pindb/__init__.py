@@ -3,22 +3,33 @@ from __future__ import absolute_import
 __version__ = (0, 1, 12)  # remember to change setup.py
 
 import contextlib
+from collections import deque, namedtuple
 from functools import wraps
 from threading import local
 from itertools import cycle
-from random import randint
+from random import randint, random
+from time import time
 from warnings import warn
 
 from django.conf import settings
 from django.utils import importlib
 
-from .exceptions import PinDbException, PinDbConfigError, UnpinnedWriteException
+from .signals import write_routed
+from .exceptions import (PinDbException, PinDbConfigError,
+    UnpinnedWriteException, QueryTimeout, ReplicaUnavailable)
 
 __all__ = (
-    'PinDbException', 'PinDbConfigError', 'UnpinnedWriteException',
-    'unpin_all', 'pin', 'get_pinned', 'get_newly_pinned',
-    'is_pinned', 'get_replica', 'unpinned_replica',
-    'populate_replicas', 'StrictPinDbRouter', 'GreedyPinDbRouter'
+    'PinDbException', 'PinDbConfigError', 'UnpinnedWriteException', 'QueryTimeout',
+    'ReplicaUnavailable',
+    'unpin_all', 'pin', 'defer_pinning', 'has_deferred_pins',
+    'get_pinned', 'get_newly_pinned', 'is_pinned', 'get_written', 'get_replica', 'unpinned_replica',
+    'set_staleness_tolerant', 'is_staleness_tolerant',
+    'set_replica_role', 'get_replica_role', 'replica_role',
+    'prefer_fresh', 'bulk_reads',
+    'mark_unhealthy', 'mark_healthy', 'start_slow', 'start_trace', 'get_trace',
+    'capture_pinning', 'install_pinning', 'propagate_pinning', 'PinningExecutor',
+    'populate_replicas', 'StrictPinDbRouter', 'GreedyPinDbRouter',
+    'ShadowStrictPinDbRouter'
 )
 
 _locals = local()
@@ -34,20 +45,90 @@ def unpin_all():
     _locals.newly_pinned_set = set()
     # replica choices already made during this pinning context:
     _locals.chosen_replicas = {}  # {master alias: replica alias}
+    # masters actually written to during this pinning context:
+    _locals.written_set = set()
+    # whether pinned reads may fall back to replicas under master pressure:
+    _locals.staleness_tolerant = False
+    # the pool of replicas reads come from, None for the default one:
+    _locals.replica_role = None
+    # when the writes behind pins carried over from earlier contexts happened:
+    _locals.written_at = {}  # {master alias: time}
+    # why each set was pinned (or unpinned_replica'd), for tracing:
+    _locals.pin_reasons = {}  # {master alias: reason}
+    # routing decisions, if tracing this pinning context; see start_trace:
+    _locals.trace = None
+    # reads routed during this pinning context, if recording; see
+    # ShadowStrictPinDbRouter:
+    _locals.reads = None  # deque of (model, alias)
+    # rows written to sets which aren't pinned, read from their masters by
+    # primary key instead; see pindb.overlay:
+    _locals.written_rows = {}  # {(model label, pk): master alias}
+    _locals.newly_written_rows = set()  # {(model label, pk)}
+    # sets whose reads should come from first-tier replicas; see prefer_fresh:
+    _locals.fresh_set = set()
+    # whether reads should come from deeper-tier replicas; see bulk_reads:
+    _locals.bulk = False
+    # pins recorded elsewhere, applied when first needed; see defer_pinning:
+    _locals.deferred_pins = None  # a callable
 
 # Number of replicas for each DB set, loaded when the Router is constructed;
 # zero-based to ease using random.randint. If a set as 3 replicas, there will
 # be a 2 here.
 DB_SET_SIZES = {}  # How many slaves each DB set has - 1
+# Also loaded when the Router is constructed.
+REPLICA_MASTERS = {}  # {replica alias: master alias}
+# Replicas of each DB set in this worker's zone (PINDB_ZONE) and elsewhere.
+# Without a PINDB_ZONE, every replica counts as local.
+REPLICA_CANDIDATES = {}  # {master alias: ([local replica alias...], [remote...])}
+# Replicas known to be down, process-wide; see mark_unhealthy.
+UNHEALTHY_REPLICAS = set()
+# Replicas tagged with a ROLE other than PINDB_DEFAULT_REPLICA_ROLE; any
+# others serve reads made outside replica_role.
+REPLICA_ROLES = {}  # {replica alias: role}
+# Replicas still warming up, process-wide; see start_slow.
+RAMPING_REPLICAS = {}  # {replica alias: time the ramp started}
+# How many hops each replica is from its master, per the PARENT of each in
+# DATABASE_SETS; 1 for those replicating from the master itself.
+REPLICA_TIERS = {}  # {replica alias: tier}
+# For sets with replicas chained off others: the first tier, for fresh reads,
+# and the ones below it, for bulk reads.
+TIER_CANDIDATES = {}  # {master alias: {'fresh': (local, remote), 'bulk': (local, remote)}}
 def _init_state():
     if getattr(_locals, 'inited', False):
         return
     unpin_all()
     _locals.inited = True
 
-def pin(alias, count_as_new=True):
+def defer_pinning(loader):
+    """Call ``loader`` to pin DB sets only once pinning state is consulted.
+
+    This lets a pinning context be restored from, say, a cookie without the
+    cost of decoding it for work which never asks what's pinned.
+
+    """
+    _init_state()
+    _locals.deferred_pins = loader
+
+def _init_pins():
+    """Like _init_state, but also apply any deferred pins."""
+    _init_state()
+    if _locals.deferred_pins is not None:
+        loader, _locals.deferred_pins = _locals.deferred_pins, None
+        loader()
+
+def has_deferred_pins():
+    """Return whether pins deferred by ``defer_pinning`` are yet to be applied."""
     _init_state()
+    return _locals.deferred_pins is not None
+
+def pin(alias, count_as_new=True, reason='pin', written_at=None):
+    """Pin ``alias``; ``written_at`` is when the write behind a carried-over pin happened."""
+    _init_pins()
+    if not alias in _locals.pinned_set:
+        _locals.pin_reasons[alias] = reason
     _locals.pinned_set.add(alias)
+    if written_at is not None:
+        _locals.written_at[alias] = written_at
     if count_as_new:
         _locals.newly_pinned_set.add(alias)
 
@@ -55,13 +136,15 @@ def _unpin_one(alias, also_unpin_new=True):
     """
     Not intended for external use; just here for the decorators below.
     """
-    _init_state()
+    _init_pins()
     _locals.pinned_set.remove(alias)
+    _locals.pin_reasons.pop(alias, None)
+    _locals.written_at.pop(alias, None)
     if also_unpin_new:
         _locals.newly_pinned_set.discard(alias)
 
 def get_pinned():
-    _init_state()
+    _init_pins()
     return _locals.pinned_set.copy()
 
 def get_newly_pinned():
@@ -69,13 +152,231 @@ def get_newly_pinned():
     return _locals.newly_pinned_set.copy()
 
 def is_pinned(alias):
-    _init_state()
+    _init_pins()
     return alias in _locals.pinned_set
 
 def is_newly_pinned(alias):
     _init_state()
     return alias in _locals.newly_pinned_set
 
+def _record_write(alias):
+    _init_state()
+    _locals.written_set.add(alias)
+
+def _record_row(alias, label, pk, count_as_new=True):
+    _init_pins()
+    _locals.written_rows[(label, pk)] = alias
+    if count_as_new:
+        _locals.newly_written_rows.add((label, pk))
+
+def _written_rows():
+    _init_pins()
+    return _locals.written_rows
+
+def _newly_written_rows():
+    _init_state()
+    return dict((key, _locals.written_rows[key]) for key in _locals.newly_written_rows)
+
+def get_written():
+    """Return the DB sets routed a write during this pinning context."""
+    _init_state()
+    return _locals.written_set.copy()
+
+def set_staleness_tolerant(tolerant=True):
+    """Declare whether this pinning context's reads can tolerate some staleness.
+
+    When a master is under pressure, reads of sets pinned by earlier writes
+    (as carried over by the middleware's cookie) are served by a replica
+    instead. ``tolerant`` may be a number of seconds, in which case only pins
+    from writes at least that long ago are. Sets this context pinned or wrote
+    to itself are always read from their masters.
+
+    """
+    _init_state()
+    _locals.staleness_tolerant = tolerant
+
+def is_staleness_tolerant():
+    _init_state()
+    return _locals.staleness_tolerant
+
+def _normalize_role(role):
+    if role == getattr(settings, 'PINDB_DEFAULT_REPLICA_ROLE', None):
+        return None
+    return role
+
+def set_replica_role(role):
+    """Send this pinning context's replica reads to replicas tagged with ``role``.
+
+    ``None`` goes back to the default pool. Replicas chosen for each role are
+    sticky separately.
+
+    """
+    _init_state()
+    _locals.replica_role = _normalize_role(role)
+
+def get_replica_role():
+    _init_state()
+    return _locals.replica_role
+
+class replica_role(object):
+    """
+    with replica_role("reporting"):
+        ...
+
+    Read from replicas tagged with the given ROLE, or any replica if the set
+    has none.
+    """
+    def __init__(self, role):
+        self.role = role
+
+    def __enter__(self):
+        self.previous = get_replica_role()
+        set_replica_role(self.role)
+
+    def __exit__(self, type, value, tb):
+        _locals.replica_role = self.previous
+
+        if any((type, value, tb)):
+            raise type, value, tb
+
+def prefer_fresh(alias):
+    """Read the DB set ``alias`` from first-tier replicas for the rest of this pinning context.
+
+    For reads which need to be fresher than usual but not pinned, like those
+    just after a pin has expired. Sets without chained replicas are unaffected.
+
+    """
+    _init_state()
+    _locals.fresh_set.add(alias)
+
+class bulk_reads(object):
+    """
+    with bulk_reads():
+        ...
+
+    Read from replicas below the first tier, where a set has any, to leave
+    the first tier to reads which need to be fresh.
+    """
+    def __enter__(self):
+        _init_state()
+        self.previous = _locals.bulk
+        _locals.bulk = True
+
+    def __exit__(self, type, value, tb):
+        _locals.bulk = self.previous
+
+        if any((type, value, tb)):
+            raise type, value, tb
+
+def start_trace():
+    """Record the routing decisions made during the rest of this pinning context."""
+    _init_state()
+    _locals.trace = []
+
+def get_trace():
+    """Return the routing decisions recorded since ``start_trace``, or None.
+
+    Each is a (model, 'read' or 'write', alias, reason) tuple. The reason is
+    one of 'unmanaged', 'replica', 'no_replicas', 'unpinned_replica',
+    'pressure' or 'overlay' (a write leaving its set unpinned; see
+    pindb.overlay), or else why the set was pinned: 'pin', 'cookie',
+    'greedy', 'master', 'policy', 'predicted' or 'propagated'.
+
+    """
+    _init_state()
+    if _locals.trace is None:
+        return None
+    return list(_locals.trace)
+
+def _trace(model, access, alias, reason):
+    _locals.trace.append((model, access, alias, reason))
+
+PinningContext = namedtuple('PinningContext',
+    'pinned_set newly_pinned_set chosen_replicas written_rows')
+
+def capture_pinning():
+    """Return an immutable snapshot of this thread's pinning context."""
+    _init_pins()
+    return PinningContext(
+        frozenset(_locals.pinned_set),
+        frozenset(_locals.newly_pinned_set),
+        tuple(_locals.chosen_replicas.items()),
+        tuple(_locals.written_rows.items()))
+
+def install_pinning(context):
+    """Replace this thread's pinning context with a ``capture_pinning`` snapshot."""
+    unpin_all()
+    _locals.inited = True
+    _locals.pinned_set.update(context.pinned_set)
+    _locals.newly_pinned_set.update(context.newly_pinned_set)
+    _locals.chosen_replicas.update(context.chosen_replicas)
+    _locals.written_rows.update(context.written_rows)
+    _locals.pin_reasons.update(dict.fromkeys(context.pinned_set, 'propagated'))
+
+def propagate_pinning(func):
+    """Wrap ``func`` to run elsewhere under the current thread's pinning context.
+
+    The wrapper is meant to be handed to another thread: it runs ``func`` with
+    a copy of the pinning context as it was when wrapped, then merges any DB
+    sets newly pinned or written by ``func`` back into this thread's context.
+    The worker thread's own context is restored afterwards.
+
+    """
+    context = capture_pinning()
+    # Hold on to the parent's (mutable) state so the worker can merge into it.
+    parent_pinned = _locals.pinned_set
+    parent_newly_pinned = _locals.newly_pinned_set
+    parent_written = _locals.written_set
+    parent_written_rows = _locals.written_rows
+    parent_newly_written_rows = _locals.newly_written_rows
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        previous = _locals.__dict__.copy()
+        install_pinning(context)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            newly_pinned = _locals.newly_pinned_set - context.newly_pinned_set
+            parent_pinned.update(newly_pinned)
+            parent_newly_pinned.update(newly_pinned)
+            parent_written.update(_locals.written_set)
+            for key in _locals.newly_written_rows:
+                parent_written_rows[key] = _locals.written_rows[key]
+            parent_newly_written_rows.update(_locals.newly_written_rows)
+            _locals.__dict__.clear()
+            _locals.__dict__.update(previous)
+    return wrapper
+
+class PinningExecutor(object):
+    """Wrap a ``concurrent.futures``-style executor to propagate pinning.
+
+    Work submitted from a thread runs under that thread's pinning context, and
+    pins it makes are merged back as each piece of work completes. ::
+
+        with PinningExecutor(ThreadPoolExecutor(4)) as executor:
+            futures = [executor.submit(fetch, pk) for pk in pks]
+
+    """
+    def __init__(self, executor):
+        self.executor = executor
+
+    def submit(self, fn, *args, **kwargs):
+        return self.executor.submit(propagate_pinning(fn), *args, **kwargs)
+
+    def map(self, fn, *iterables, **kwargs):
+        return self.executor.map(propagate_pinning(fn), *iterables, **kwargs)
+
+    def shutdown(self, wait=True):
+        return self.executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.shutdown(wait=True)
+        return False
+
 REPLICA_TEMPLATE = "%s-%s"
 def _make_replica_alias(master_alias, replica_num):
     return REPLICA_TEMPLATE % (master_alias, replica_num)
@@ -84,7 +385,9 @@ def get_replica(master_alias):
     """Return an arbitrary replica of a given master.
 
     If one was already chosen during this pinning context, keep returning the
-    same one.
+    same one. Replicas tagged with the context's ``replica_role`` are
+    preferred, else any other replica; within those, first-tier replicas for
+    sets marked by ``prefer_fresh`` and deeper ones within ``bulk_reads``.
 
     """
     _init_state()
@@ -98,16 +401,133 @@ def get_replica(master_alias):
     if effective_size == -1:
         return master_alias
     else:
-        previous_replica = _locals.chosen_replicas.get(master_alias)
+        role = _locals.replica_role
+        tier = None
+        if master_alias in TIER_CANDIDATES:
+            if _locals.bulk:
+                tier = 'bulk'
+            elif master_alias in _locals.fresh_set:
+                tier = 'fresh'
+        if role is None and tier is None:
+            key = master_alias
+        else:
+            key = (master_alias, role, tier)
+        previous_replica = _locals.chosen_replicas.get(key)
         if previous_replica:
             return previous_replica
-        replica_num = randint(0, effective_size)
-
-        chosen_replica = _make_replica_alias(master_alias, replica_num)
-        _locals.chosen_replicas[master_alias] = chosen_replica
+        local, remote = REPLICA_CANDIDATES[master_alias]
+        pools = [(local, remote)]
+        if tier is not None:
+            pools.insert(0, TIER_CANDIDATES[master_alias][tier])
+        if REPLICA_ROLES:
+            in_role = [(_in_role(l, role), _in_role(r, role)) for l, r in pools]
+            pools = [pool for pool in in_role if pool[0] or pool[1]] + pools
+        candidates = None
+        for local, remote in pools:
+            if UNHEALTHY_REPLICAS:
+                # Spill over to other zones only if there's nothing healthy
+                # here, and to other roles only if there's nothing healthy in
+                # this one.
+                candidates = _healthy(local) or _healthy(remote)
+            else:
+                candidates = local or remote
+            if candidates:
+                break
+        if not candidates:
+            # If nothing's healthy anywhere, any replica is as good as another.
+            candidates = local + remote
+        if RAMPING_REPLICAS:
+            chosen_replica = _choose_ramped(candidates)
+        else:
+            chosen_replica = candidates[randint(0, len(candidates) - 1)]
+        _locals.chosen_replicas[key] = chosen_replica
 
         return chosen_replica
 
+def _replica_tiers(master_alias, replica_overrides):
+    """Return {replica alias: tier} for a set, following each replica's PARENT.
+
+    A PARENT is the index (in the set) or alias of another of the set's
+    replicas; replicas without one replicate from the master.
+
+    """
+    parents = {}
+    for i, replica_override in enumerate(replica_overrides):
+        parent = replica_override.get('PARENT')
+        if isinstance(parent, (int, long)):
+            parent = _make_replica_alias(master_alias, parent)
+        parents[_make_replica_alias(master_alias, i)] = parent
+    tiers = {}
+    for replica_alias in parents:
+        chain = [replica_alias]
+        while parents[chain[-1]] is not None and parents[chain[-1]] not in tiers:
+            parent = parents[chain[-1]]
+            if parent not in parents:
+                raise PinDbConfigError("%s replicates from %s, which isn't a replica of %s" %
+                                       (chain[-1], parent, master_alias))
+            if parent in chain:
+                raise PinDbConfigError("Replicas of %s replicate from each other in a loop: %s" %
+                                       (master_alias, " -> ".join(chain + [parent])))
+            chain.append(parent)
+        tier = tiers.get(parents[chain[-1]], 0) + 1
+        for alias in reversed(chain):
+            tiers[alias] = tier
+            tier += 1
+    return tiers
+
+def _in_role(aliases, role):
+    return [alias for alias in aliases if REPLICA_ROLES.get(alias) == role]
+
+def _healthy(aliases):
+    return [alias for alias in aliases if alias not in UNHEALTHY_REPLICAS]
+
+def _ramp_weight(alias, now_time):
+    """Return the share of its usual traffic a replica should get now."""
+    started = RAMPING_REPLICAS.get(alias)
+    if started is None:
+        return 1.0
+    seconds = getattr(settings, 'PINDB_SLOW_START_SECONDS', 0)
+    progress = (now_time - started) / float(seconds) if seconds else 1.0
+    if progress >= 1:
+        RAMPING_REPLICAS.pop(alias, None)
+        return 1.0
+    min_weight = getattr(settings, 'PINDB_SLOW_START_MIN_WEIGHT', 0.05)
+    if getattr(settings, 'PINDB_SLOW_START_CURVE', 'linear') == 'exponential':
+        return min_weight ** (1 - progress)
+    return min_weight + (1 - min_weight) * max(progress, 0)
+
+def _choose_ramped(candidates):
+    now_time = time()
+    weights = [_ramp_weight(alias, now_time) for alias in candidates]
+    point = random() * sum(weights)
+    for alias, weight in zip(candidates, weights):
+        point -= weight
+        if point < 0:
+            return alias
+    return candidates[-1]
+
+def start_slow(alias):
+    """Ramp a replica (in this process) up to its full share of reads.
+
+    Over ``PINDB_SLOW_START_SECONDS``, the replica's chance of being chosen
+    grows from ``PINDB_SLOW_START_MIN_WEIGHT`` of the others' to the same,
+    linearly or, with ``PINDB_SLOW_START_CURVE = 'exponential'``,
+    exponentially. Does nothing unless ``PINDB_SLOW_START_SECONDS`` is set.
+
+    """
+    if getattr(settings, 'PINDB_SLOW_START_SECONDS', 0):
+        RAMPING_REPLICAS[alias] = time()
+
+def mark_unhealthy(alias):
+    """Stop choosing a replica (in this process) while others are available."""
+    UNHEALTHY_REPLICAS.add(alias)
+
+def mark_healthy(alias):
+    """Choose a replica again, ramping it up if it was unhealthy; see start_slow."""
+    if alias in UNHEALTHY_REPLICAS:
+        UNHEALTHY_REPLICAS.discard(alias)
+        start_slow(alias)
+
 class unpinned_replica(object):
     """
     with unpinned_replica("default"):
@@ -121,12 +541,16 @@ class unpinned_replica(object):
     def __enter__(self):
         self.was_pinned = is_pinned(self.alias)
         self.was_newly_pinned = is_newly_pinned(self.alias)
+        self.reason = _locals.pin_reasons.get(self.alias, 'pin')
         if self.was_pinned:
             _unpin_one(self.alias, True)
+        _locals.pin_reasons[self.alias] = 'unpinned_replica'
 
     def __exit__(self, type, value, tb):
+        if _locals.pin_reasons.get(self.alias) == 'unpinned_replica':
+            del _locals.pin_reasons[self.alias]
         if self.was_pinned:
-            pin(self.alias, self.was_newly_pinned)
+            pin(self.alias, self.was_newly_pinned, self.reason)
 
         if any((type, value, tb)):
             raise type, value, tb
@@ -174,7 +598,7 @@ class master(object):
     def __enter__(self):
         self.was_pinned = is_pinned(self.alias)
         self.was_newly_pinned = is_newly_pinned(self.alias)
-        pin(self.alias, False)
+        pin(self.alias, False, 'master')
 
     def __exit__(self, type, value, tb):
         if not self.was_pinned:
@@ -245,11 +669,62 @@ class PinDbRouterBase(object):
             raise PinDbConfigError("You must define MASTER_DATABASES and DATABASE_SETS settings.")
 
         # stash the # to chose from to reduce per-call overhead in the routing.
+        zone = getattr(settings, 'PINDB_ZONE', None)
+        default_role = getattr(settings, 'PINDB_DEFAULT_REPLICA_ROLE', None)
         for alias, master_values in settings.MASTER_DATABASES.items():
             DB_SET_SIZES[alias] = len(settings.DATABASE_SETS[alias]) - 1
+            tiers = _replica_tiers(alias, settings.DATABASE_SETS[alias])
+            REPLICA_TIERS.update(tiers)
+            local, remote = [], []
+            for i, replica_override in enumerate(settings.DATABASE_SETS[alias]):
+                replica_alias = _make_replica_alias(alias, i)
+                if replica_override.get('SLOW_START') and replica_alias not in REPLICA_MASTERS:
+                    # A newly added replica; ramp it up from this process' start.
+                    start_slow(replica_alias)
+                REPLICA_MASTERS[replica_alias] = alias
+                role = replica_override.get('ROLE', default_role)
+                if role == default_role:
+                    REPLICA_ROLES.pop(replica_alias, None)
+                else:
+                    REPLICA_ROLES[replica_alias] = role
+                if zone is None or replica_override.get('ZONE') == zone:
+                    local.append(replica_alias)
+                else:
+                    remote.append(replica_alias)
+            REPLICA_CANDIDATES[alias] = (local, remote)
+            if any(tier > 1 for tier in tiers.values()):
+                TIER_CANDIDATES[alias] = {
+                    'fresh': ([r for r in local if tiers[r] == 1],
+                              [r for r in remote if tiers[r] == 1]),
+                    'bulk': ([r for r in local if tiers[r] > 1],
+                             [r for r in remote if tiers[r] > 1]),
+                }
+            else:
+                TIER_CANDIDATES.pop(alias, None)
             if DB_SET_SIZES[alias] == -1:
                 warn("No replicas found for %s; using just the master" % alias)
 
+        # shed pinned reads from overloaded masters, if configured.
+        from .pressure import get_monitor
+        self.pressure = get_monitor()
+        # read rows this context wrote from their masters, if configured.
+        from .overlay import get_overlay
+        self.overlay = get_overlay()
+        # record per-alias query latency, if configured.
+        from .histograms import get_recorder
+        self.latency = get_recorder()
+        # reuse replica connections across requests, if configured.
+        from .pool import get_pools
+        get_pools()
+        # compare sampled replica reads with their masters, if configured.
+        from .staleness import get_sampler
+        self.sampler = get_sampler()
+        # share replica health and load with other workers, if configured.
+        from .shared import get_shared_state
+        get_shared_state()
+        self.tolerant_models = set(label.lower() for label in
+            getattr(settings, 'PINDB_STALENESS_TOLERANT_MODELS', ()))
+
         # defer master selection to a domain-specific router.
         delegates = getattr(settings, 'PINDB_DELEGATE_ROUTERS', [])
         if delegates:
@@ -260,34 +735,114 @@ class PinDbRouterBase(object):
             # or just always use default's set.
             self.delegate = DummyRouter()
 
-    def db_for_read(self, model, **hints):
+    def master_for_read(self, model, **hints):
+        """Return the master of the DB set a read would go to, without applying pinning."""
         master_alias = self.delegate.db_for_read(model, **hints)
         if master_alias is None:
             master_alias = "default"
+        return master_alias
+
+    def db_for_read(self, model, **hints):
+        return self.route_read(self.master_for_read(model, **hints), model)
 
+    def route_read(self, master_alias, model=None):
+        """Return the DB a read of the set ``master_alias`` should go to.
+
+        ``model`` is None for reads not made through the ORM.
+
+        """
         if not is_enabled():
             return master_alias
+        if self.overlay is not None:
+            self.overlay.ensure_installed()
+
+        tracing = getattr(_locals, 'trace', None) is not None
 
         # allow anything unmanaged by the DB set system to work unhindered.
         if not master_alias in settings.MASTER_DATABASES:
+            if tracing:
+                _trace(model, 'read', master_alias, 'unmanaged')
             return master_alias
 
         if is_pinned(master_alias):
+            alias = master_alias
+            if self.pressure is not None and self.pressure.under_pressure(master_alias):
+                alias = self._for_read_under_pressure(master_alias, model)
+            if tracing:
+                _trace(model, 'read', alias, 'pressure' if alias != master_alias
+                       else _locals.pin_reasons.get(master_alias, 'pin'))
+            return alias
+
+        alias = get_replica(master_alias)
+        if self.sampler is not None and alias != master_alias:
+            self.sampler.consider(model, master_alias, alias)
+        if tracing:
+            _trace(model, 'read', alias, 'no_replicas' if alias == master_alias
+                   else _locals.pin_reasons.get(master_alias, 'replica'))
+        return alias
+
+    def _for_read_under_pressure(self, master_alias, model):
+        tolerance = is_staleness_tolerant()
+        if model is not None and "%s.%s" % (
+                model._meta.app_label, model._meta.object_name.lower()) in self.tolerant_models:
+            tolerance = True
+        if not tolerance:
+            return master_alias
+        # Reads of this context's own writes must see them.
+        written_at = _locals.written_at.get(master_alias)
+        if (written_at is None or master_alias in _locals.newly_pinned_set or
+                master_alias in _locals.written_set):
             return master_alias
-        return get_replica(master_alias)
+        if tolerance is not True and time() - written_at < tolerance:
+            return master_alias
+        replica_alias = get_replica(master_alias)
+        if replica_alias != master_alias:
+            self.pressure.record_degraded(master_alias)
+        return replica_alias
 
-    def db_for_write(self, model, **hints):
+    def master_for_write(self, model, **hints):
+        """Return the master a write would go to, without applying any pinning policy."""
         master_alias = self.delegate.db_for_write(model, **hints)
         if master_alias is None:
             master_alias = "default"
+        return master_alias
 
+    def db_for_write(self, model, **hints):
+        return self.route_write(self.master_for_write(model, **hints), model, **hints)
+
+    def route_write(self, master_alias, model=None, **hints):
+        """Return the DB a write to the set ``master_alias`` should go to.
+
+        Pins (or refuses) according to the router's policy. ``model`` is None
+        for writes not made through the ORM.
+
+        """
         if not is_enabled():
             return master_alias
 
+        tracing = getattr(_locals, 'trace', None) is not None
+
         # allow anything unmanaged by the DB set system to work unhindered.
         if not master_alias in settings.MASTER_DATABASES:
+            if tracing:
+                _trace(model, 'write', master_alias, 'unmanaged')
             return master_alias
-        return self._for_write_with_policy(master_alias, model, **hints)
+        if (self.overlay is not None and model is not None and
+                not is_pinned(master_alias) and self.overlay.covers(model, hints)):
+            # Only the saved row need be read fresh; see pindb.overlay.
+            alias, reason = master_alias, 'overlay'
+        else:
+            alias = self._for_write_with_policy(master_alias, model, **hints)
+            reason = None
+            if _locals.pin_reasons.get(master_alias) in ('policy', 'predicted'):
+                # The declared or predicted write came true; carry the pin over
+                # to later requests, as a pin made by the write itself would be.
+                pin(master_alias)
+        _record_write(master_alias)
+        write_routed.send(sender=self.__class__, alias=master_alias, model=model)
+        if tracing:
+            _trace(model, 'write', alias, reason or _locals.pin_reasons.get(master_alias, 'pin'))
+        return alias
 
     def allow_relation(self, obj1, obj2, **hints):
         return self.delegate.allow_relation(obj1, obj2, **hints)
@@ -303,5 +858,41 @@ class StrictPinDbRouter(PinDbRouterBase):
 
 class GreedyPinDbRouter(PinDbRouterBase):
     def _for_write_with_policy(self, master_alias, model, **hints):
-        pin(master_alias)
+        pin(master_alias, reason='greedy')
         return master_alias
+
+class ShadowStrictPinDbRouter(GreedyPinDbRouter):
+    """Route like GreedyPinDbRouter, but record the writes Strict would refuse.
+
+    See ``pindb.shadow.get_report()``. Each is recorded with the last
+    ``PINDB_SHADOW_READS`` reads of its pinning context.
+
+    """
+    def __init__(self):
+        super(ShadowStrictPinDbRouter, self).__init__()
+        from .shadow import get_report
+        self.report = get_report()
+        self.max_reads = getattr(settings, 'PINDB_SHADOW_READS', 20)
+
+    def route_read(self, master_alias, model=None):
+        alias = super(ShadowStrictPinDbRouter, self).route_read(master_alias, model)
+        _init_state()
+        if _locals.reads is None:
+            _locals.reads = deque(maxlen=self.max_reads)
+        _locals.reads.append((model, alias))
+        return alias
+
+    def _for_write_with_policy(self, master_alias, model, **hints):
+        if not is_pinned(master_alias):
+            self.report.record(master_alias, model, _locals.reads or ())
+        return super(ShadowStrictPinDbRouter, self)._for_write_with_policy(
+            master_alias, model, **hints)
+
+def _get_router():
+    """Return the pindb router in ``DATABASE_ROUTERS``, or None if there isn't one."""
+    # Settings modules import pindb, so django.db can't be imported up top.
+    from django.db import router
+    for candidate in router.routers:
+        if isinstance(candidate, PinDbRouterBase):
+            return candidate
+    return None
@@ -0,0 +1,147 @@
+from __future__ import absolute_import
+
+from collections import deque
+from copy import deepcopy
+from threading import Lock
+from time import time
+
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.db.models.sql.datastructures import EmptyResultSet
+
+from . import REPLICA_MASTERS, is_enabled
+from .signals import write_routed
+
+__all__ = ('QueryCache', 'get_query_cache', 'cached')
+
+class QueryCache(object):
+    """An in-process LRU cache of query results read from replicas.
+
+    Replica reads already accept replication lag, so a result a few seconds
+    older is usually acceptable too. Only reads the router sends to a replica
+    are cached, so pinned sets always go to their master. Entries for a DB set
+    are dropped when this process writes to its master.
+
+    ``max_rows`` caps the total number of cached rows (an empty result counts
+    as one); the least recently used entries are evicted past it. ``ttl`` is
+    the default number of seconds an entry is served for.
+
+    """
+    def __init__(self, max_rows=10000, ttl=5):
+        self.max_rows = max_rows
+        self.ttl = ttl
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+        self._lock = Lock()
+        self._entries = {}  # {key: (expires at, rows, use tick)}
+        # Keys in order of use; stale ticks are skipped on eviction.
+        self._uses = deque()
+        self._tick = 0
+        self._rows = 0
+
+    def cached(self, queryset, ttl=None):
+        """Return the results of ``queryset`` as a list, from cache if allowed."""
+        if not is_enabled() or queryset._db is not None:
+            # Explicit .using() is left to its own devices.
+            return list(queryset)
+        db = queryset.db
+        master_alias = REPLICA_MASTERS.get(db)
+        if master_alias is None:
+            # Pinned, unmanaged, or a set without replicas: no staleness allowed.
+            return list(queryset)
+        try:
+            sql, params = queryset.query.get_compiler(using=db).as_sql()
+        except EmptyResultSet:
+            return []
+        # values(), values_list() and only() can share SQL but not rows.
+        fields = getattr(queryset, '_fields', None)
+        key = (master_alias, sql, tuple(params), queryset.__class__, queryset.model,
+               fields if fields is None else tuple(fields), getattr(queryset, 'flat', None))
+
+        rows = self._get(key)
+        if rows is None:
+            rows = list(queryset)
+            self._set(key, rows, self.ttl if ttl is None else ttl)
+        # Hand out copies so callers can't mutate each other's instances,
+        # including their state and related object caches.
+        return deepcopy(rows)
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time():
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._use(key, entry[0], entry[1])
+            return entry[1]
+
+    def _set(self, key, rows, ttl):
+        size = max(1, len(rows))
+        if size > self.max_rows:
+            return
+        with self._lock:
+            self._discard(key)
+            self._rows += size
+            self._use(key, time() + ttl, rows)
+            while self._rows > self.max_rows:
+                old_key, tick = self._uses.popleft()
+                entry = self._entries.get(old_key)
+                if entry is not None and entry[2] == tick:
+                    self._discard(old_key)
+                    self.evictions += 1
+
+    def _use(self, key, expires, rows):
+        self._tick += 1
+        self._entries[key] = (expires, rows, self._tick)
+        self._uses.append((key, self._tick))
+        if len(self._uses) > 2 * len(self._entries) + 16:
+            # Mostly stale ticks from repeated hits; rebuild from the live ones.
+            self._uses = deque((k, entry[2]) for k, entry in
+                sorted(self._entries.items(), key=lambda item: item[1][2]))
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._rows -= max(1, len(entry[1]))
+
+    def invalidate(self, master_alias):
+        """Drop every entry read from the DB set of ``master_alias``."""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == master_alias]:
+                self._discard(key)
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._uses.clear()
+            self._rows = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+_query_cache = None
+def get_query_cache():
+    """Return the process-wide cache configured by settings."""
+    global _query_cache
+    if _query_cache is None:
+        _query_cache = QueryCache(
+            max_rows=getattr(settings, 'PINDB_QUERY_CACHE_MAX_ROWS', 10000),
+            ttl=getattr(settings, 'PINDB_QUERY_CACHE_SECONDS', 5))
+    return _query_cache
+
+def cached(queryset, ttl=None):
+    """Evaluate ``queryset``, serving replica reads from the process-wide cache."""
+    return get_query_cache().cached(queryset, ttl)
+
+def _invalidate_routed_write(sender, alias, **kwargs):
+    if _query_cache is not None:
+        _query_cache.invalidate(alias)
+write_routed.connect(_invalidate_routed_write)
+
+def _invalidate_saved(sender, using=None, **kwargs):
+    # Catches saves which bypass the router with .using().
+    if _query_cache is not None and using is not None:
+        _query_cache.invalidate(REPLICA_MASTERS.get(using, using))
+post_save.connect(_invalidate_saved)
+post_delete.connect(_invalidate_saved)
@@ -11,3 +11,9 @@ class UnpinnedWriteException(PinDbException):
     pass
 
 
+class QueryTimeout(PinDbException):
+    pass
+
+
+class ReplicaUnavailable(PinDbException):
+    pass
@@ -0,0 +1,116 @@
+from __future__ import absolute_import
+
+from collections import namedtuple
+from time import time
+
+from django.conf import settings
+from django.db import connections
+
+from . import _make_replica_alias, mark_healthy, mark_unhealthy
+from .scatter import _gather
+
+__all__ = ('Probe', 'get_topology', 'probe', 'check_topology',
+           'unhealthy_sets', 'update_health')
+
+Probe = namedtuple('Probe', 'alias master healthy connect_seconds latency lag error')
+
+def get_topology():
+    """Return {master alias: [replica alias, ...]} as ``populate_replicas`` makes them."""
+    return dict((master, [_make_replica_alias(master, i)
+                          for i in range(len(settings.DATABASE_SETS.get(master, ())))])
+                for master in settings.MASTER_DATABASES)
+
+def _replication_lag(connection):
+    """Return how many seconds a replica is behind, or None if we can't tell."""
+    cursor = connection.cursor()
+    if connection.vendor == 'mysql':
+        cursor.execute("SHOW SLAVE STATUS")
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        columns = [column[0] for column in cursor.description]
+        return row[columns.index('Seconds_Behind_Master')]
+    if connection.vendor == 'postgresql':
+        cursor.execute("SELECT CASE WHEN pg_is_in_recovery() THEN "
+                       "EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END")
+        return cursor.fetchone()[0]
+    return None
+
+def probe(alias):
+    """Connect to ``alias`` and time it and a trivial query.
+
+    Return (connect seconds, round-trip seconds, replication lag seconds).
+    Lag is None for masters and for backends which can't report it.
+
+    """
+    connection = connections[alias]
+    connection.close()
+    started = time()
+    cursor = connection.cursor()
+    connected = time()
+    cursor.execute("SELECT 1")
+    cursor.fetchone()
+    latency = time() - connected
+
+    lag = None
+    if alias not in settings.MASTER_DATABASES:
+        try:
+            lag = _replication_lag(connection)
+            if lag is not None:
+                lag = float(lag)
+        except Exception:
+            # Not having the privileges to ask isn't a health problem.
+            lag = None
+    return connected - started, latency, lag
+
+def check_topology(max_workers=10, timeout=5.0, max_lag=None):
+    """Probe every master and replica concurrently.
+
+    Each probe runs on a pool of at most ``max_workers`` threads and is given
+    up on after ``timeout`` seconds, so this takes about as long as the
+    slowest alias. A replica more than ``max_lag`` seconds behind is counted
+    as unhealthy. Return a list of ``Probe``, ordered by alias.
+
+    """
+    masters = {}
+    for master, replicas in get_topology().items():
+        masters[master] = master
+        for replica in replicas:
+            masters[replica] = master
+
+    probes = []
+    for result in _gather([(alias, alias) for alias in masters], probe,
+                          max_workers, timeout):
+        if result.error is not None:
+            probes.append(Probe(result.alias, masters[result.alias], False,
+                                None, None, None, str(result.error) or
+                                result.error.__class__.__name__))
+            continue
+        connect_seconds, latency, lag = result.result
+        healthy = max_lag is None or lag is None or lag <= max_lag
+        probes.append(Probe(result.alias, masters[result.alias], healthy,
+                            connect_seconds, latency, lag,
+                            None if healthy else "lagging"))
+    return sorted(probes)
+
+def unhealthy_sets(probes):
+    """Return the DB sets whose master is down or whose replicas all are.
+
+    Sets configured without replicas only need a healthy master.
+
+    """
+    topology = get_topology()
+    healthy = set(result.alias for result in probes if result.healthy)
+    return sorted(master for master, replicas in topology.items()
+                  if master not in healthy or
+                  (replicas and not healthy.intersection(replicas)))
+
+def update_health(probes):
+    """Mark this process' replicas healthy or unhealthy according to ``probes``."""
+    for result in probes:
+        if result.alias == result.master:
+            continue
+        if result.healthy:
+            mark_healthy(result.alias)
+        else:
+            mark_unhealthy(result.alias)
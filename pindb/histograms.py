@@ -0,0 +1,188 @@
+from __future__ import absolute_import
+
+from array import array
+from threading import Lock, current_thread, local
+from weakref import ref
+
+from django.conf import settings
+
+from . import instrumentation
+
+__all__ = ('LatencyHistogram', 'LatencyRecorder', 'get_recorder')
+
+# Each power-of-two range of microseconds is split into 2 ** SUB_BITS linear
+# buckets, so a recorded latency is off by at most 1 / 2 ** SUB_BITS.
+SUB_BITS = 5
+SUB_COUNT = 1 << SUB_BITS
+# Latencies are capped at 2 ** MAX_BITS microseconds (about 38 hours).
+MAX_BITS = 37
+BUCKETS = (MAX_BITS - SUB_BITS + 1) * SUB_COUNT
+
+def _bucket(micros):
+    if micros < SUB_COUNT:
+        return micros
+    micros = min(micros, (1 << MAX_BITS) - 1)
+    shift = micros.bit_length() - 1 - SUB_BITS
+    return (shift + 1) * SUB_COUNT + (micros >> shift) - SUB_COUNT
+
+def _bucket_value(index):
+    """Return the middle of a bucket, in microseconds."""
+    if index < SUB_COUNT:
+        return index
+    shift = index // SUB_COUNT - 1
+    return ((SUB_COUNT + index % SUB_COUNT) << shift) + (1 << shift) // 2
+
+class LatencyHistogram(object):
+    """Count latencies in fixed log-linear buckets, HDR histogram style.
+
+    Histograms are a fixed size whatever they hold, and merge by adding
+    bucket counts, so ones kept by different threads or processes (see
+    ``export``) can be combined before taking percentiles.
+
+    """
+    def __init__(self):
+        self.counts = array('L', [0]) * BUCKETS
+        self.count = 0
+        self.total_micros = 0
+
+    def record(self, seconds):
+        micros = max(int(seconds * 1000000), 0)
+        self.counts[_bucket(micros)] += 1
+        self.count += 1
+        self.total_micros += micros
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.count += other.count
+        self.total_micros += other.total_micros
+
+    def percentile(self, percent):
+        """Return the latency in seconds below which ``percent`` of them fall."""
+        if not self.count:
+            return None
+        rank = max(1, int(round(self.count * percent / 100.0)))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return _bucket_value(index) / 1000000.0
+
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total_micros / 1000000.0 / self.count
+
+    def export(self):
+        """Return JSON-able data for ``from_export``, listing only used buckets."""
+        return {
+            'count': self.count,
+            'total_micros': self.total_micros,
+            'buckets': [[index, count] for index, count in enumerate(self.counts) if count],
+        }
+
+    @classmethod
+    def from_export(cls, data):
+        histogram = cls()
+        for index, count in data['buckets']:
+            histogram.counts[index] = count
+        histogram.count = data['count']
+        histogram.total_micros = data['total_micros']
+        return histogram
+
+class LatencyRecorder(object):
+    """Record query latency per alias, split into reads and writes.
+
+    A ``pindb.instrumentation`` listener. Each thread records into its own
+    histograms without locking; ``histograms`` merges them when asked. Those
+    of threads which have finished are folded together, so short-lived
+    threads don't each leave theirs behind.
+
+    """
+    def __init__(self):
+        self._local = local()
+        self._lock = Lock()
+        # (weakref to each live thread, its {(alias, 'read' or 'write'): histogram})
+        self._threads = []
+        # the same, merged from finished threads and other processes' exports
+        self._merged = {}
+
+    def query_started(self, alias, is_write):
+        pass
+
+    def query_finished(self, alias, is_write, seconds):
+        histograms = getattr(self._local, 'histograms', None)
+        if histograms is None:
+            histograms = self._local.histograms = {}
+            with self._lock:
+                self._retire_finished()
+                self._threads.append((ref(current_thread()), histograms))
+        key = (alias, 'write' if is_write else 'read')
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = LatencyHistogram()
+        histogram.record(seconds)
+
+    def histograms(self):
+        """Return {(alias, 'read' or 'write'): histogram} merged across threads."""
+        merged = {}
+        with self._lock:
+            self._retire_finished()
+            threads = [histograms for thread, histograms in self._threads] + [self._merged]
+        for histograms in threads:
+            for key, histogram in histograms.items():
+                merged.setdefault(key, LatencyHistogram()).merge(histogram)
+        return merged
+
+    def _retire_finished(self):
+        """Fold the histograms of finished threads into ``_merged``; hold ``_lock``."""
+        live = []
+        for entry in self._threads:
+            thread, histograms = entry[0](), entry[1]
+            if thread is not None and thread.is_alive():
+                live.append(entry)
+                continue
+            for key, histogram in histograms.items():
+                self._merged.setdefault(key, LatencyHistogram()).merge(histogram)
+        self._threads = live
+
+    def report(self, percentiles=(50, 90, 99, 99.9)):
+        """Return {alias: {'read' or 'write': {'count', 'mean', 'p50', ...}}}."""
+        ret = {}
+        for (alias, access), histogram in self.histograms().items():
+            summary = {'count': histogram.count, 'mean': histogram.mean()}
+            for percent in percentiles:
+                summary['p%s' % percent] = histogram.percentile(percent)
+            ret.setdefault(alias, {})[access] = summary
+        return ret
+
+    def export(self):
+        """Return JSON-able data, for merging with other processes' recorders."""
+        return dict(('%s:%s' % key, histogram.export())
+                    for key, histogram in self.histograms().items())
+
+    def load(self, data):
+        """Merge in data from another recorder's ``export``."""
+        with self._lock:
+            for key, histogram_data in data.items():
+                key = tuple(key.rsplit(':', 1))
+                self._merged.setdefault(key, LatencyHistogram()).merge(
+                    LatencyHistogram.from_export(histogram_data))
+
+    def reset(self):
+        with self._lock:
+            for thread, histograms in self._threads:
+                histograms.clear()
+            self._merged = {}
+
+_recorder = None
+def get_recorder():
+    """Return the process-wide recorder configured by settings, or None if disabled."""
+    global _recorder
+    if not getattr(settings, 'PINDB_LATENCY_HISTOGRAMS', False):
+        return None
+    if _recorder is None:
+        _recorder = LatencyRecorder()
+        instrumentation.add_listener(_recorder)
+    return _recorder
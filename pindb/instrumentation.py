@@ -0,0 +1,114 @@
+from __future__ import absolute_import
+
+from functools import partial
+from threading import Lock
+from time import time
+
+from django.conf import settings
+from django.db.backends import BaseDatabaseWrapper
+
+from . import REPLICA_MASTERS
+
+__all__ = ('install', 'add_listener', 'remove_listener', 'add_cursor_wrapper',
+    'InstrumentedCursor')
+
+# Objects told about each query run on a managed alias. Each has
+# query_started(alias, is_write) and query_finished(alias, is_write, seconds).
+_listeners = []
+# Everything pindb does as a connection's cursor is made, innermost first; see
+# add_cursor_wrapper.
+_cursor_wrappers = []  # [(order, wrapper)]
+_install_lock = Lock()
+_original_cursor = None
+
+# Where pindb's own cursor wrappers go, nearest the connection first: pooling
+# must hand over a connection before the cursor is made, and statements should
+# be timed without any reading ahead for staleness sampling.
+POOL_ORDER = -10
+TIMING_ORDER = 0
+SAMPLING_ORDER = 10
+
+def _is_managed(alias):
+    return alias in REPLICA_MASTERS or alias in settings.MASTER_DATABASES
+
+def _is_write(sql):
+    return sql.lstrip()[:6].upper() != 'SELECT'
+
+class InstrumentedCursor(object):
+    """Wrap a cursor to report the timing of each statement to the listeners."""
+    def __init__(self, cursor, alias):
+        self.cursor = cursor
+        self.alias = alias
+
+    def execute(self, sql, params=()):
+        return self._timed(self.cursor.execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        return self._timed(self.cursor.executemany, sql, param_list)
+
+    def _timed(self, method, sql, params):
+        is_write = _is_write(sql)
+        listeners = list(_listeners)
+        for listener in listeners:
+            listener.query_started(self.alias, is_write)
+        started = time()
+        try:
+            return method(sql, params)
+        finally:
+            seconds = time() - started
+            for listener in listeners:
+                listener.query_finished(self.alias, is_write, seconds)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+def add_cursor_wrapper(wrapper, order):
+    """Have ``wrapper(connection, make_cursor)`` make every connection's cursors.
+
+    ``make_cursor()`` returns the cursor as made by the wrappers of lower
+    ``order``, and ultimately Django; ``wrapper`` returns the cursor to use.
+    This is the only place pindb patches ``BaseDatabaseWrapper.cursor``.
+    Adding a wrapper again does nothing.
+
+    """
+    _patch_cursor()
+    with _install_lock:
+        if wrapper not in [w for o, w in _cursor_wrappers]:
+            _cursor_wrappers.append((order, wrapper))
+            _cursor_wrappers.sort(key=lambda entry: entry[0])
+
+def _patch_cursor():
+    global _original_cursor
+    with _install_lock:
+        if _original_cursor is not None:
+            return
+        _original_cursor = original = BaseDatabaseWrapper.cursor
+
+        def cursor(self):
+            make_cursor = partial(original, self)
+            for order, wrapper in _cursor_wrappers:
+                make_cursor = partial(wrapper, self, make_cursor)
+            return make_cursor()
+        BaseDatabaseWrapper.cursor = cursor
+
+def _instrumented(connection, make_cursor):
+    cursor = make_cursor()
+    if _listeners and _is_managed(connection.alias):
+        return InstrumentedCursor(cursor, connection.alias)
+    return cursor
+
+def install():
+    """Wrap the cursors of every alias pindb manages. Safe to call repeatedly."""
+    add_cursor_wrapper(_instrumented, TIMING_ORDER)
+
+def add_listener(listener):
+    install()
+    if listener not in _listeners:
+        _listeners.append(listener)
+
+def remove_listener(listener):
+    if listener in _listeners:
+        _listeners.remove(listener)
@@ -0,0 +1,123 @@
+from __future__ import absolute_import
+
+from threading import Lock
+
+from django.conf import settings
+
+import anyjson
+
+from . import pin, get_written
+
+__all__ = (
+    'WritePredictor', 'get_predictor', 'start_context', 'finish_context',
+)
+
+class WritePredictor(object):
+    """Learn which DB sets a route (URL name, task name, ...) ends up writing.
+
+    Once a route has been seen at least ``min_requests`` times and writes to a
+    DB set in at least ``threshold`` of them, ``predict`` returns that set so
+    it can be pinned before any reads happen. A ``frozen`` predictor ignores
+    further observations, e.g. for a table learned elsewhere and loaded in
+    production.
+
+    """
+    def __init__(self, threshold=0.5, min_requests=20, table=None, frozen=False):
+        self.threshold = threshold
+        self.min_requests = min_requests
+        self.frozen = frozen
+        self._lock = Lock()
+        # {route: [requests seen, {master alias: requests which wrote}]}
+        self._counts = {}
+        # {route: frozenset of predicted aliases}, kept up to date by observe.
+        self._predictions = {}
+        if table:
+            self.load(table)
+
+    def predict(self, route):
+        """Return the DB sets ``route`` is expected to write to."""
+        return self._predictions.get(route, frozenset())
+
+    def observe(self, route, written):
+        """Record that a run of ``route`` wrote to the DB sets in ``written``."""
+        if self.frozen:
+            return
+        with self._lock:
+            counts = self._counts.setdefault(route, [0, {}])
+            counts[0] += 1
+            for alias in written:
+                counts[1][alias] = counts[1].get(alias, 0) + 1
+            self._predictions[route] = self._predict_from(counts)
+
+    def _predict_from(self, counts):
+        requests, writes = counts
+        if requests < self.min_requests:
+            return frozenset()
+        return frozenset(alias for alias, count in writes.items()
+                         if float(count) / requests >= self.threshold)
+
+    def export(self):
+        """Return the learned table as JSON-able data."""
+        with self._lock:
+            return dict((route, {'requests': requests, 'writes': writes.copy()})
+                        for route, (requests, writes) in self._counts.items())
+
+    def load(self, table):
+        """Merge in a table previously returned by ``export``."""
+        with self._lock:
+            for route, entry in table.items():
+                counts = self._counts.setdefault(route, [0, {}])
+                counts[0] += entry['requests']
+                for alias, count in entry['writes'].items():
+                    counts[1][alias] = counts[1].get(alias, 0) + count
+                self._predictions[route] = self._predict_from(counts)
+
+    def save(self, path):
+        f = open(path, 'w')
+        try:
+            f.write(anyjson.dumps(self.export()))
+        finally:
+            f.close()
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        f = open(path)
+        try:
+            table = anyjson.loads(f.read())
+        finally:
+            f.close()
+        return cls(table=table, **kwargs)
+
+_predictor = None
+def get_predictor():
+    """Return the process-wide predictor configured by settings, or None if disabled."""
+    global _predictor
+    if not getattr(settings, 'PINDB_WRITE_PREDICTION', False):
+        return None
+    if _predictor is None:
+        kwargs = {
+            'threshold': getattr(settings, 'PINDB_WRITE_PREDICTION_THRESHOLD', 0.5),
+            'min_requests': getattr(settings, 'PINDB_WRITE_PREDICTION_MIN_REQUESTS', 20),
+            'frozen': getattr(settings, 'PINDB_WRITE_PREDICTION_FROZEN', False),
+        }
+        path = getattr(settings, 'PINDB_WRITE_PREDICTION_TABLE', None)
+        if path:
+            _predictor = WritePredictor.from_file(path, **kwargs)
+        else:
+            _predictor = WritePredictor(**kwargs)
+    return _predictor
+
+def start_context(route):
+    """Pin whatever ``route`` is predicted to write; call as a pinning context starts."""
+    predictor = get_predictor()
+    if predictor is None:
+        return
+    for alias in predictor.predict(route):
+        pin(alias, count_as_new=False, reason='predicted')
+
+def finish_context(route):
+    """Teach the predictor what ``route`` wrote; call before the pinning context ends."""
+    predictor = get_predictor()
+    if predictor is None:
+        return
+    predictor.observe(route, get_written())
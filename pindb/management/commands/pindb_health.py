@@ -0,0 +1,54 @@
+from __future__ import absolute_import
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+import anyjson
+
+from pindb.health import check_topology, unhealthy_sets
+
+def _millis(seconds):
+    if seconds is None:
+        return "-"
+    return "%.1fms" % (seconds * 1000)
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--timeout', action='store', type='float', dest='timeout',
+            default=5.0, help='Seconds to wait for each database. Defaults to 5.'),
+        make_option('--workers', action='store', type='int', dest='workers',
+            default=10, help='How many databases to probe at once. Defaults to 10.'),
+        make_option('--max-lag', action='store', type='float', dest='max_lag',
+            default=None, help='Count replicas further behind than this many '
+                'seconds as unhealthy, where the backend reports lag.'),
+        make_option('--json', action='store_true', dest='json', default=False,
+            help='Output JSON rather than a table.'),
+    )
+    help = ('Probes every master and replica concurrently, reporting '
+            'connectivity, connect time, query latency and replication lag. '
+            'Fails if any DB set has no healthy replica or an unreachable master.')
+
+    def handle_noargs(self, **options):
+        probes = check_topology(max_workers=options.get('workers'),
+                                timeout=options.get('timeout'),
+                                max_lag=options.get('max_lag'))
+
+        if options.get('json'):
+            self.stdout.write(anyjson.dumps([probe._asdict() for probe in probes]))
+            self.stdout.write("\n")
+        else:
+            row = "%-20s %-15s %-8s %10s %10s %10s  %s\n"
+            self.stdout.write(row % ('alias', 'set', 'status', 'connect',
+                                     'latency', 'lag', 'error'))
+            for probe in probes:
+                self.stdout.write(row % (
+                    probe.alias, probe.master, 'ok' if probe.healthy else 'FAIL',
+                    _millis(probe.connect_seconds), _millis(probe.latency),
+                    "-" if probe.lag is None else "%.1fs" % probe.lag,
+                    probe.error or ""))
+
+        failed = unhealthy_sets(probes)
+        if failed:
+            raise CommandError("No healthy replica or master for DB sets: %s" %
+                               ", ".join(failed))
@@ -1,27 +1,59 @@
 from __future__ import absolute_import
 
+import logging
+from functools import partial
 from math import ceil
+from random import random
 from time import time
 
 from django.conf import settings
+from django.core.urlresolvers import resolve, Resolver404
 
 import anyjson
 
-from . import pin, get_newly_pinned, unpin_all, is_enabled
+from . import (pin, prefer_fresh, defer_pinning, has_deferred_pins, get_newly_pinned,
+    get_written, unpin_all, is_enabled, is_pinned, set_staleness_tolerant,
+    set_replica_role, start_trace, get_trace, _init_pins, _unpin_one,
+    _record_row, _newly_written_rows)
+from .learning import get_predictor
+from .policies import compile_policies, get_view_policy
 
 
 # The name of the cookie that directs a request's reads to the master DB
 PINNING_COOKIE = getattr(settings, 'PINDB_PINNING_COOKIE', 'pindb_pinned_set')
 
+# The name of the cookie that directs reads of rows just written (by
+# PINDB_ROW_OVERLAY_MODELS) to the master DB
+OVERLAY_COOKIE = getattr(settings, 'PINDB_OVERLAY_COOKIE', 'pindb_written_rows')
+
 # The number of seconds for which reads are directed to the master DB after a
 # write
 PINNING_SECONDS = int(getattr(settings, 'PINDB_PINNING_SECONDS', 15))
 
-def _get_request_pins(cookie_value):
+# The number of seconds after a pin expires for which reads prefer first-tier
+# replicas, in sets with replicas chained off others
+FRESH_READ_SECONDS = int(getattr(settings, 'PINDB_FRESH_READ_SECONDS', 0))
+
+# Where to report each traced request's routing decisions: 'header', 'log' or
+# None to not trace at all
+TRACE = getattr(settings, 'PINDB_TRACE', None)
+
+# The share of requests traced
+TRACE_SAMPLE_RATE = float(getattr(settings, 'PINDB_TRACE_SAMPLE_RATE', 1.0))
+
+# The response header traces are reported in
+TRACE_HEADER = getattr(settings, 'PINDB_TRACE_HEADER', 'X-PinDB-Trace')
+
+# The most distinct decisions reported in the header, to keep it short
+TRACE_HEADER_ENTRIES = int(getattr(settings, 'PINDB_TRACE_HEADER_ENTRIES', 20))
+
+trace_logger = logging.getLogger('pindb.trace')
+
+def _get_request_pins(cookie_value, grace=0):
     """Extract the persistent pinnings from a cookie.
 
-    Return an iterable of (DB alias, time pinned until) tuples. Any expired
-    pinnings are omitted.
+    Return an iterable of (DB alias, time pinned until) tuples. Any pinnings
+    expired more than ``grace`` seconds ago are omitted.
 
     """
     ret = []
@@ -37,10 +69,52 @@ def _get_request_pins(cookie_value):
     for alias, until in pinned_untils:
         if not alias in settings.MASTER_DATABASES:
             continue
-        if now_time < until:
+        if now_time < until + grace:
             ret.append((alias, until))
     return ret
 
+def _get_request_rows(cookie_value):
+    """Extract the rows written from a cookie.
+
+    Return an iterable of (DB alias, model label, pk, time fresh until)
+    tuples. Any expired rows are omitted.
+
+    """
+    ret = []
+
+    now_time = time()
+    try:
+        written_untils = anyjson.loads(cookie_value)
+    except ValueError:
+        written_untils = []
+
+    for alias, label, pk, until in written_untils:
+        if not alias in settings.MASTER_DATABASES:
+            continue
+        if now_time < until:
+            ret.append((alias, label, pk, until))
+    return ret
+
+def _pin_from_cookie(request):
+    if PINNING_COOKIE in request.COOKIES:
+        now_time = time()
+        for alias, until in _get_request_pins(request.COOKIES[PINNING_COOKIE],
+                                              FRESH_READ_SECONDS):
+            # Keep track of existing end times for the return trip.
+            request._pinned_until[alias] = until
+            if now_time < until:
+                # The cookie only records when a pin expires; back out when
+                # the write that caused it happened.
+                pin(alias, count_as_new=False, reason='cookie',
+                    written_at=until - PINNING_SECONDS)
+            else:
+                # Recently expired: replicas far down a chain may still lag.
+                prefer_fresh(alias)
+    if OVERLAY_COOKIE in request.COOKIES:
+        for alias, label, pk, until in _get_request_rows(request.COOKIES[OVERLAY_COOKIE]):
+            request._written_until[(label, pk)] = (alias, until)
+            _record_row(alias, label, pk, count_as_new=False)
+
 def _get_response_pins(request_pinned_until):
     """Return the union of the preexisting pinned set--socked away on the request--with any newly set pins."""
     pinned_until = request_pinned_until.copy()
@@ -52,6 +126,45 @@ def _get_response_pins(request_pinned_until):
 
     return pinned_until
 
+def _get_response_rows(request_written_until):
+    """Return the rows written carried over on the request, with any newly written."""
+    written_until = request_written_until.copy()
+
+    new_expiration = int(ceil(time() + PINNING_SECONDS))
+    for key, alias in _newly_written_rows().items():
+        written_until[key] = (alias, new_expiration)
+
+    return written_until
+
+def _summarize_trace(trace):
+    """Collapse repeated routing decisions into [[model, access, alias, reason, count], ...]."""
+    summary = []
+    positions = {}
+    for model, access, alias, reason in trace:
+        if model is None:
+            label = None
+        else:
+            label = "%s.%s" % (model._meta.app_label, model._meta.object_name.lower())
+        key = (label, access, alias, reason)
+        if key in positions:
+            summary[positions[key]][4] += 1
+        else:
+            positions[key] = len(summary)
+            summary.append([label, access, alias, reason, 1])
+    return summary
+
+def _format_trace(summary):
+    """Render a trace summary compactly enough for a response header."""
+    entries = []
+    for label, access, alias, reason, count in summary[:TRACE_HEADER_ENTRIES]:
+        entry = "%s %s %s %s" % (access, label, alias, reason)
+        if count > 1:
+            entry += " x%s" % count
+        entries.append(entry)
+    if len(summary) > TRACE_HEADER_ENTRIES:
+        entries.append("+%s more" % (len(summary) - TRACE_HEADER_ENTRIES))
+    return ", ".join(entries)
+
 class PinDbMiddleware(object):
     """Middleware to support the persisting pinning between requests after a write.
 
@@ -61,29 +174,122 @@ class PinDbMiddleware(object):
 
     When the cookie is detected on a request, related DBs are pinned.
 
+    Views may also declare how they use DB sets, either with the decorators in
+    ``pindb.policies`` or by URL name in ``PINDB_VIEW_POLICIES``; the policy is
+    applied once the view is resolved and before it runs any queries. Views
+    without a policy can have their writes predicted from past requests; see
+    ``pindb.learning``.
+
+    With ``PINDB_TRACE`` set, a sample of requests report every routing
+    decision they made, and why, in a response header or a log line.
+
     """
+    def __init__(self):
+        self.policies = compile_policies(getattr(settings, 'PINDB_VIEW_POLICIES', {}))
+        # Learns which DB sets views without a declared policy write to.
+        self.predictor = get_predictor()
+
     def process_request(self, request):
-        """Pin DB sets according to data in an incoming cookie."""
+        """Pin DB sets according to data in an incoming cookie, once needed."""
         # Make a clean slate. This is also necessary to ensure the threadlocal
         # attrs of our locals() object exist.
         unpin_all()
 
         request._pinned_until = {}
+        request._written_until = {}  # {(model label, pk): (alias, until)}
 
-        if ((not is_enabled()) or 
-                (not PINNING_COOKIE in request.COOKIES)):
+        if TRACE and is_enabled() and random() < TRACE_SAMPLE_RATE:
+            start_trace()
+
+        if ((not is_enabled()) or
+                (not PINNING_COOKIE in request.COOKIES and
+                 not OVERLAY_COOKIE in request.COOKIES)):
             return
 
-        for alias, until in _get_request_pins(request.COOKIES[PINNING_COOKIE]):
-            # Keep track of existing end times for the return trip.
-            request._pinned_until[alias] = until
-            pin(alias, count_as_new=False)
+        # Decode the cookie only if something asks what's pinned; requests
+        # which never touch a DB set needn't pay for it.
+        defer_pinning(partial(_pin_from_cookie, request))
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        """Apply the view's pinning policy, or pin its predicted writes."""
+        if not is_enabled():
+            return
+
+        route = None
+        if self.policies or self.predictor is not None:
+            route = self._get_route(request, view_func)
+
+        policy = self.policies.get(route)
+        if policy is None:
+            policy = get_view_policy(view_func)
+        if policy is not None:
+            self._apply_policy(request, policy)
+        elif self.predictor is not None:
+            request._pindb_route = route
+            for alias in self.predictor.predict(route):
+                # Only carried over to later requests if it's written to.
+                pin(alias, count_as_new=False, reason='predicted')
+
+    def _get_route(self, request, view_func):
+        """Return the URL name of the request, else the dotted path of its view."""
+        try:
+            match = resolve(request.path_info, getattr(request, 'urlconf', None))
+        except Resolver404:
+            pass
+        else:
+            if match.url_name:
+                return match.url_name
+        return "%s.%s" % (view_func.__module__,
+                          getattr(view_func, '__name__', view_func.__class__.__name__))
+
+    def _apply_policy(self, request, policy):
+        if policy.staleness is not None:
+            # Pins from writes older than the bound are dropped below, so
+            # under master pressure the view gives up the younger ones too.
+            set_staleness_tolerant(True)
+        if policy.role is not None:
+            set_replica_role(policy.role)
+
+        if policy.replicas_only or policy.staleness is not None:
+            # Needs the cookie's pins to decide which to drop.
+            _init_pins()
+
+        now_time = time()
+        for alias, until in request._pinned_until.items():
+            if not is_pinned(alias):
+                continue
+            # The cookie only records when a pin expires; back out when the
+            # write that caused it happened.
+            written_at = until - PINNING_SECONDS
+            if (policy.wants_replica(alias) or
+                    (policy.staleness is not None and
+                     now_time - written_at >= policy.staleness)):
+                # Leave request._pinned_until alone so the pin is still
+                # carried over to later requests.
+                _unpin_one(alias, also_unpin_new=False)
+
+        for alias in policy.pins:
+            # Only carried over to later requests if it's written to.
+            pin(alias, count_as_new=False, reason='policy')
 
     def process_response(self, request, response):
         """Set outgoing cookie to persist preexisting and new pinnings."""
         if not is_enabled():
             return response
 
+        route = getattr(request, '_pindb_route', None)
+        if route is not None:
+            self.predictor.observe(route, get_written())
+
+        trace = get_trace()
+        if trace is not None:
+            self._report_trace(request, response, trace)
+
+        if has_deferred_pins():
+            # Nothing asked about or changed the pins the cookie carried in,
+            # so it stands as it is.
+            return response
+
         pinned_until = _get_response_pins(request._pinned_until)
 
         to_persist = list(pinned_until.items())
@@ -92,6 +298,24 @@ class PinDbMiddleware(object):
             # TODO: Use Django 1.4's signed cookies.
             response.set_cookie(PINNING_COOKIE,
                 value=anyjson.dumps(to_persist),
+                max_age=PINNING_SECONDS + FRESH_READ_SECONDS)
+
+        written_until = _get_response_rows(request._written_until)
+        if written_until:
+            response.set_cookie(OVERLAY_COOKIE,
+                value=anyjson.dumps([[alias, label, pk, until] for (label, pk), (alias, until)
+                                     in written_until.items()]),
                 max_age=PINNING_SECONDS)
 
         return response
+
+    def _report_trace(self, request, response, trace):
+        summary = _summarize_trace(trace)
+        if TRACE == 'header':
+            response[TRACE_HEADER] = _format_trace(summary)
+        elif TRACE == 'log':
+            trace_logger.info(anyjson.dumps({
+                'path': request.path,
+                'status': response.status_code,
+                'trace': summary,
+            }))
@@ -0,0 +1,145 @@
+from __future__ import absolute_import
+
+import sys
+from threading import Lock
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.signals import request_started
+
+from . import (REPLICA_MASTERS, is_enabled, is_pinned, pin, _record_row,
+    _written_rows)
+
+__all__ = ('RowOverlay', 'install', 'get_overlay')
+
+_install_lock = Lock()
+_originals = None
+
+def _label(model):
+    return "%s.%s" % (model._meta.app_label, model._meta.object_name.lower())
+
+def _django_db_ready():
+    """Return whether django.db has finished importing, so django.db.models can be."""
+    return hasattr(sys.modules.get('django.db'), 'connection')
+
+def _pk_lookup(model, kwargs):
+    """Return the primary key a ``get`` looks up, or None if it doesn't."""
+    pk = model._meta.pk
+    for name in ('pk', pk.name, pk.attname):
+        for lookup in (name, name + '__exact'):
+            if lookup in kwargs:
+                try:
+                    return pk.to_python(kwargs[lookup])
+                except (ValidationError, TypeError):
+                    return None
+    return None
+
+class RowOverlay(object):
+    """Read back rows this pinning context wrote, rather than pinning their set.
+
+    Creating, saving or deleting an instance of one of ``models`` leaves its
+    DB set unpinned, even under StrictPinDbRouter, and records the row
+    instead. ``get`` lookups of a recorded row by
+    primary key, including those made following a foreign key, go to the
+    set's master; every other read still goes to a replica. Past ``max_rows``
+    rows in a set, it's pinned as usual.
+
+    Writes which aren't of a single instance, like ``QuerySet.update``, pin as
+    usual: there's no telling which rows they touch.
+
+    """
+    def __init__(self, models, max_rows=20):
+        self.models = set(label.lower() for label in models)
+        self.max_rows = max_rows
+
+    def ensure_installed(self):
+        """Install, if that had to wait for django.db; for the router."""
+        if _originals is None and _django_db_ready():
+            install()
+
+    def covers(self, model, hints):
+        """Return whether a write routed with ``hints`` can be recorded by row."""
+        self.ensure_installed()
+        return isinstance(hints.get('instance'), model) and _label(model) in self.models
+
+    def record(self, alias, instance):
+        if instance.pk is None or is_pinned(alias):
+            return
+        key = (_label(instance.__class__), instance.pk)
+        rows = _written_rows()
+        if key not in rows and sum(1 for master in rows.values()
+                                   if master == alias) >= self.max_rows:
+            pin(alias, reason='overlay')
+            return
+        _record_row(alias, key[0], key[1])
+
+    def master_for_lookup(self, model, kwargs):
+        """Return the master a ``get(**kwargs)`` must read from, or None for any DB."""
+        label = _label(model)
+        if label not in self.models or not is_enabled():
+            return None
+        pk = _pk_lookup(model, kwargs)
+        if pk is None:
+            return None
+        return _written_rows().get((label, pk))
+
+def install():
+    """Send primary key lookups of written rows to masters. Safe to call repeatedly."""
+    global _originals
+    from django.db.models.query import QuerySet
+    from django.db.models.signals import post_save, post_delete
+    with _install_lock:
+        if _originals is not None:
+            return
+        post_save.connect(_record_written)
+        post_delete.connect(_record_written)
+        _originals = original_get, original_create = QuerySet.get, QuerySet.create
+
+        def get(self, *args, **kwargs):
+            # Replicas chosen for us (as when following a foreign key) are
+            # overridden, but not other explicit .using()s.
+            if _overlay is not None and (self._db is None or self._db in REPLICA_MASTERS):
+                master_alias = _overlay.master_for_lookup(self.model, kwargs)
+                if master_alias is not None:
+                    self = self.using(master_alias)
+            return original_get(self, *args, **kwargs)
+
+        def create(self, **kwargs):
+            if (_overlay is not None and self._db is None and
+                    _label(self.model) in _overlay.models):
+                # Let save() route the write, telling the router the instance.
+                obj = self.model(**kwargs)
+                obj.save(force_insert=True)
+                return obj
+            return original_create(self, **kwargs)
+        QuerySet.get = get
+        QuerySet.create = create
+
+_overlay = None
+def get_overlay():
+    """Return the process-wide overlay configured by settings, or None if disabled."""
+    global _overlay
+    models = getattr(settings, 'PINDB_ROW_OVERLAY_MODELS', ())
+    if not models:
+        return None
+    if _overlay is None:
+        _overlay = RowOverlay(models, getattr(settings, 'PINDB_ROW_OVERLAY_MAX_ROWS', 20))
+        if _django_db_ready():
+            install()
+        else:
+            # Routers named in DATABASE_ROUTERS are built while django.db is
+            # first imported, before django.db.models can be. Install once
+            # it's done: as requests start, or as the router is first used.
+            request_started.connect(_install_on_request)
+    return _overlay
+
+def _install_on_request(sender, **kwargs):
+    if _overlay is not None:
+        _overlay.ensure_installed()
+
+def _record_written(sender, instance, using=None, raw=False, **kwargs):
+    if (_overlay is None or raw or not is_enabled() or
+            using not in settings.MASTER_DATABASES or
+            _label(sender) not in _overlay.models):
+        return
+    _overlay.record(using, instance)
@@ -0,0 +1,150 @@
+from __future__ import absolute_import
+
+from django.conf import settings
+
+from . import _mash_aliases
+from .exceptions import PinDbConfigError
+
+__all__ = (
+    'ViewPolicy', 'compile_policies', 'get_view_policy',
+    'pins', 'replicas_only', 'tolerates_staleness', 'reads_from_role',
+)
+
+class ViewPolicy(object):
+    """How a view uses its DB sets, declared up front.
+
+    The middleware applies a view's policy before the view runs, so pinning
+    decisions are made once rather than reactively by the router.
+
+    ``pins`` is the DB sets the view will write to; they are pinned as soon as
+    the view is resolved, and carried over to later requests once written to.
+
+    ``replicas_only`` is the DB sets the view reads from replicas regardless
+    of pinning carried over by the cookie, or ``True`` for all of them.
+
+    ``staleness`` is the number of seconds of replication lag the view
+    tolerates. Carried-over pins from writes older than that are dropped.
+
+    ``role`` is the replica pool the view's replica reads go to; see
+    ``pindb.replica_role``.
+
+    """
+    def __init__(self, pins=(), replicas_only=(), staleness=None, role=None):
+        self.pins = _mash_aliases(pins) if pins else set()
+        if replicas_only is True:
+            self.replicas_only = True
+        else:
+            self.replicas_only = _mash_aliases(replicas_only) if replicas_only else set()
+        self.staleness = staleness
+        self.role = role
+
+    def merge(self, other):
+        """Return a new policy combining this one with ``other``.
+
+        Pins and replica-only sets are unioned; the tighter staleness wins, and
+        ``other``'s role, if it has one.
+
+        """
+        if self.replicas_only is True or other.replicas_only is True:
+            replicas_only = True
+        else:
+            replicas_only = self.replicas_only | other.replicas_only
+        stalenesses = [s for s in (self.staleness, other.staleness) if s is not None]
+        return ViewPolicy(
+            pins=self.pins | other.pins,
+            replicas_only=replicas_only,
+            staleness=min(stalenesses) if stalenesses else None,
+            role=other.role if other.role is not None else self.role)
+
+    def wants_replica(self, alias):
+        return self.replicas_only is True or alias in self.replicas_only
+
+    def __repr__(self):
+        return "ViewPolicy(pins=%r, replicas_only=%r, staleness=%r, role=%r)" % (
+            sorted(self.pins),
+            self.replicas_only if self.replicas_only is True else sorted(self.replicas_only),
+            self.staleness, self.role)
+
+_POLICY_KEYS = ('pins', 'replicas_only', 'staleness', 'role')
+
+def compile_policies(table):
+    """Turn a ``PINDB_VIEW_POLICIES``-style dict into ``ViewPolicy`` objects.
+
+    ``table`` maps URL names to dicts of ``ViewPolicy`` keyword arguments::
+
+        PINDB_VIEW_POLICIES = {
+            'dashboard': {'replicas_only': True},
+            'checkout': {'pins': ['default', 'orders']},
+            'search': {'staleness': 5},
+            'monthly_report': {'role': 'reporting'},
+        }
+
+    """
+    compiled = {}
+    for url_name, options in (table or {}).items():
+        unknown = set(options) - set(_POLICY_KEYS)
+        if unknown:
+            raise PinDbConfigError("Unknown view policy options for %s: %s" % (
+                url_name, ", ".join(sorted(unknown))))
+        policy = ViewPolicy(**options)
+        if policy.replicas_only is True:
+            named = policy.pins
+        else:
+            named = policy.pins | policy.replicas_only
+        for alias in named:
+            if not alias in settings.MASTER_DATABASES:
+                raise PinDbConfigError("View policy for %s names unknown DB set %s" % (
+                    url_name, alias))
+        compiled[url_name] = policy
+    return compiled
+
+def get_view_policy(view_func):
+    """Return the policy declared on a view with the decorators below, if any."""
+    return getattr(view_func, 'pindb_policy', None)
+
+def _declare(**kwargs):
+    def decorator(view_func):
+        policy = ViewPolicy(**kwargs)
+        existing = get_view_policy(view_func)
+        if existing is not None:
+            policy = existing.merge(policy)
+        view_func.pindb_policy = policy
+        return view_func
+    return decorator
+
+def pins(aliases):
+    """
+    @pins([alias,...])
+    def view...
+
+    Pin the given DB sets before the view runs, because it will write to them.
+    """
+    return _declare(pins=aliases)
+
+def replicas_only(aliases=True):
+    """
+    @replicas_only([alias,...])
+    def view...
+
+    Read from replicas despite any pinning carried over from earlier requests.
+    With no arguments, applies to every DB set.
+    """
+    return _declare(replicas_only=aliases)
+
+def tolerates_staleness(seconds):
+    """
+    @tolerates_staleness(seconds)
+    def view...
+
+    Read from replicas once a carried-over pin's write is ``seconds`` old.
+    """
+    return _declare(staleness=seconds)
+
+def reads_from_role(role):
+    """
+    @reads_from_role(role)
+    def view...
+
+    Send the view's replica reads to replicas tagged with ``role``.
+    """
+    return _declare(role=role)
@@ -0,0 +1,152 @@
+from __future__ import absolute_import
+
+import logging
+from functools import partial
+from threading import Lock
+from time import time
+
+from django.conf import settings
+
+from . import REPLICA_MASTERS
+from .instrumentation import add_cursor_wrapper, POOL_ORDER
+
+__all__ = ('ConnectionPool', 'install', 'get_pools')
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool(object):
+    """Keep a replica's idle DB-API connections for reuse across requests.
+
+    At most ``max_size`` idle connections are kept; ones idle for longer than
+    ``idle_seconds`` are closed rather than handed out, and, if ``validate``,
+    a connection must answer a trivial query before it's handed out. When the
+    pool is empty, Django connects as usual, and the connection joins the
+    pool when it's closed.
+
+    """
+    def __init__(self, alias, max_size=10, idle_seconds=300, validate=True):
+        self.alias = alias
+        self.max_size = max_size
+        self.idle_seconds = idle_seconds
+        self.validate = validate
+        self._lock = Lock()
+        self._idle = []  # [(connection, time returned)], most recent last
+        self.stats = dict.fromkeys(
+            ['reused', 'connected', 'returned', 'closed_idle', 'closed_invalid',
+             'closed_overflow'], 0)
+
+    def checkout(self):
+        """Return an idle connection, or None if the caller should connect."""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    self.stats['connected'] += 1
+                    return None
+                connection, returned = self._idle.pop()
+                if time() - returned > self.idle_seconds:
+                    # The rest are older still.
+                    stale = [connection] + [idle[0] for idle in self._idle]
+                    self._idle = []
+                    self.stats['closed_idle'] += len(stale)
+                else:
+                    stale = None
+            if stale is not None:
+                for connection in stale:
+                    _close(connection)
+                continue
+            if self.validate and not _is_usable(connection):
+                with self._lock:
+                    self.stats['closed_invalid'] += 1
+                _close(connection)
+                continue
+            with self._lock:
+                self.stats['reused'] += 1
+            return connection
+
+    def checkin(self, connection):
+        """Take back a connection, closing it if it's broken or not wanted."""
+        try:
+            # Don't hand a transaction on to the next request.
+            connection.rollback()
+        except Exception:
+            with self._lock:
+                self.stats['closed_invalid'] += 1
+            _close(connection)
+            return
+        with self._lock:
+            self.stats['returned'] += 1
+            if len(self._idle) < self.max_size:
+                self._idle.append((connection, time()))
+                return
+            self.stats['closed_overflow'] += 1
+        _close(connection)
+
+    def release(self, wrapper):
+        """Return a DatabaseWrapper's connection to the pool; its ``close`` method."""
+        if wrapper.connection is not None:
+            connection, wrapper.connection = wrapper.connection, None
+            self.checkin(connection)
+
+    def clear(self):
+        """Close every idle connection."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, returned in idle:
+            _close(connection)
+
+    def report(self):
+        """Return the pool's counters and how many connections sit idle."""
+        with self._lock:
+            return dict(self.stats, idle=len(self._idle))
+
+def _is_usable(connection):
+    try:
+        cursor = connection.cursor()
+        try:
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+        finally:
+            cursor.close()
+    except Exception:
+        return False
+    return True
+
+def _close(connection):
+    try:
+        connection.close()
+    except Exception:
+        logger.debug("Error closing a pooled connection", exc_info=True)
+
+def _pooled(connection, make_cursor):
+    if connection.connection is None and _pools is not None:
+        pool = _pools.get(connection.alias)
+        if pool is not None:
+            if getattr(connection, '_pindb_pool', None) is not pool:
+                # Closing (as Django does at request end) returns the
+                # connection rather than disconnecting.
+                connection._pindb_pool = pool
+                connection.close = partial(pool.release, connection)
+            connection.connection = pool.checkout()
+    return make_cursor()
+
+def install():
+    """Draw pooled aliases' connections from their pools. Safe to call repeatedly."""
+    add_cursor_wrapper(_pooled, POOL_ORDER)
+
+_pools = None
+_init_lock = Lock()
+def get_pools():
+    """Return {replica alias: pool} as configured by settings, or None if disabled."""
+    global _pools
+    max_size = getattr(settings, 'PINDB_REPLICA_POOL_SIZE', 0)
+    if not max_size:
+        return None
+    with _init_lock:
+        if _pools is None:
+            idle_seconds = getattr(settings, 'PINDB_REPLICA_POOL_IDLE_SECONDS', 300)
+            validate = getattr(settings, 'PINDB_REPLICA_POOL_VALIDATE', True)
+            _pools = dict((alias, ConnectionPool(alias, max_size, idle_seconds, validate))
+                          for alias in REPLICA_MASTERS)
+            install()
+    return _pools
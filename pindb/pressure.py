@@ -0,0 +1,76 @@
+from __future__ import absolute_import
+
+from threading import Lock
+
+from django.conf import settings
+
+from . import instrumentation
+
+__all__ = ('PressureMonitor', 'get_monitor')
+
+class PressureMonitor(object):
+    """Track per-alias load, measured in-process, to spot a saturated master.
+
+    A master is under pressure when this process has at least
+    ``max_in_flight`` queries running against it, or when the moving average
+    of its query latency exceeds ``max_latency`` seconds. ``decay`` is the
+    weight given to each new latency sample.
+
+    """
+    def __init__(self, max_in_flight=None, max_latency=None, decay=0.2):
+        self.max_in_flight = max_in_flight
+        self.max_latency = max_latency
+        self.decay = decay
+        self._lock = Lock()
+        self.in_flight = {}  # {alias: queries running}
+        self.latency = {}  # {alias: moving average seconds}
+        self.degraded = {}  # {master alias: reads sent to a replica instead}
+
+    def query_started(self, alias, is_write):
+        with self._lock:
+            self.in_flight[alias] = self.in_flight.get(alias, 0) + 1
+
+    def query_finished(self, alias, is_write, seconds):
+        with self._lock:
+            self.in_flight[alias] -= 1
+            previous = self.latency.get(alias)
+            if previous is None:
+                self.latency[alias] = seconds
+            else:
+                self.latency[alias] = previous + self.decay * (seconds - previous)
+
+    def under_pressure(self, alias):
+        if (self.max_in_flight is not None and
+                self.in_flight.get(alias, 0) >= self.max_in_flight):
+            return True
+        if (self.max_latency is not None and
+                self.latency.get(alias, 0) > self.max_latency):
+            return True
+        return False
+
+    def record_degraded(self, alias):
+        with self._lock:
+            self.degraded[alias] = self.degraded.get(alias, 0) + 1
+
+    def report(self):
+        """Return {alias: {'in_flight', 'latency', 'degraded'}} for every alias seen."""
+        with self._lock:
+            aliases = set(self.in_flight) | set(self.latency) | set(self.degraded)
+            return dict((alias, {
+                'in_flight': self.in_flight.get(alias, 0),
+                'latency': self.latency.get(alias),
+                'degraded': self.degraded.get(alias, 0),
+            }) for alias in aliases)
+
+_monitor = None
+def get_monitor():
+    """Return the process-wide monitor configured by settings, or None if disabled."""
+    global _monitor
+    max_in_flight = getattr(settings, 'PINDB_MASTER_MAX_IN_FLIGHT', None)
+    max_latency = getattr(settings, 'PINDB_MASTER_MAX_LATENCY', None)
+    if max_in_flight is None and max_latency is None:
+        return None
+    if _monitor is None:
+        _monitor = PressureMonitor(max_in_flight, max_latency)
+        instrumentation.add_listener(_monitor)
+    return _monitor
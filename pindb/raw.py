@@ -0,0 +1,33 @@
+from __future__ import absolute_import
+
+from django.db import connections
+
+from . import _get_router
+
+__all__ = ('resolve', 'cursor')
+
+def resolve(alias, write=False):
+    """Return the DB to run raw SQL against for the DB set ``alias``.
+
+    The set is routed just as the ORM's queries are: reads go to a replica
+    unless the set is pinned, and writes go to the master, pinning the set
+    (so the middleware persists it) or, under ``StrictPinDbRouter``, raising
+    ``UnpinnedWriteException`` if it isn't pinned already. Aliases which
+    aren't DB sets are returned as they are.
+
+    """
+    pindb_router = _get_router()
+    if pindb_router is None:
+        return alias
+    if write:
+        return pindb_router.route_write(alias)
+    return pindb_router.route_read(alias)
+
+def cursor(alias, write=False):
+    """Return a cursor for raw SQL on the DB set ``alias``, routed by ``resolve``. ::
+
+        c = pindb.raw.cursor('default')
+        c.execute("SELECT ...")
+
+    """
+    return connections[resolve(alias, write)].cursor()
@@ -0,0 +1,109 @@
+from __future__ import absolute_import
+
+from collections import namedtuple
+from Queue import Queue, Empty
+from threading import Thread
+from time import time
+
+from django.db import connections
+
+from . import is_enabled, is_pinned, get_replica, propagate_pinning
+from .exceptions import QueryTimeout
+
+__all__ = ('SetResult', 'scatter_gather')
+
+SetResult = namedtuple('SetResult', 'alias db result error')
+
+def _resolve(alias):
+    """Pick the DB for a set the way the routers would for a read."""
+    if not is_enabled() or is_pinned(alias):
+        return alias
+    return get_replica(alias)
+
+def _make_runner(query):
+    if hasattr(query, 'using'):
+        return lambda db: list(query.using(db))
+    return query
+
+def scatter_gather(query, aliases, max_workers=None, timeout=None):
+    """Run a read against several DB sets concurrently.
+
+    ``query`` is either a queryset, which is evaluated against each DB, or a
+    callable taking the alias of the DB to read from. Each DB set in
+    ``aliases`` is resolved to its master or a replica according to the
+    current pinning, then run on a pool of at most ``max_workers`` threads.
+
+    Yields a ``SetResult`` for each set as it completes. If the read raised,
+    ``error`` holds the exception; if it ran for more than ``timeout``
+    seconds, ``error`` is a ``QueryTimeout`` and its eventual result is
+    discarded.
+
+    """
+    resolved = {}
+    for alias in aliases:
+        if alias not in resolved:
+            resolved[alias] = _resolve(alias)
+    run = propagate_pinning(_make_runner(query))
+    return _gather(resolved.items(), run, max_workers, timeout)
+
+def _gather(targets, run, max_workers=None, timeout=None):
+    """Call ``run(db)`` for each (alias, db) in ``targets`` on a pool of threads.
+
+    Yields a ``SetResult`` for each as it completes or times out.
+
+    """
+    resolved = dict(targets)
+    if not resolved:
+        return
+    tasks = Queue()
+    for alias, db in targets:
+        tasks.put((alias, db))
+
+    results = Queue()
+    started = {}  # {alias: time its read started}
+
+    def work():
+        while True:
+            try:
+                alias, db = tasks.get_nowait()
+            except Empty:
+                return
+            started[alias] = time()
+            try:
+                try:
+                    results.put(SetResult(alias, db, run(db), None))
+                except Exception, e:
+                    results.put(SetResult(alias, db, None, e))
+            finally:
+                # Each worker thread has its own connections; don't leak them.
+                connections[db].close()
+
+    for i in range(min(max_workers or len(resolved), len(resolved))):
+        worker = Thread(target=work)
+        worker.daemon = True
+        worker.start()
+
+    outstanding = set(resolved)
+    while outstanding:
+        wait = None
+        if timeout is not None:
+            now_time = time()
+            deadlines = [(started[alias] + timeout, alias)
+                         for alias in outstanding if alias in started]
+            for deadline, alias in sorted(deadlines):
+                if deadline <= now_time:
+                    outstanding.discard(alias)
+                    yield SetResult(alias, resolved[alias], None, QueryTimeout(
+                        "Read from %s took longer than %s seconds" % (alias, timeout)))
+            if not outstanding:
+                return
+            pending = [deadline for deadline, alias in deadlines if alias in outstanding]
+            # Sets which haven't started yet will once a worker frees up.
+            wait = max(0, min(pending) - now_time) if pending else timeout
+        try:
+            result = results.get(timeout=wait)
+        except Empty:
+            continue
+        if result.alias in outstanding:
+            outstanding.discard(result.alias)
+            yield result
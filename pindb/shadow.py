@@ -0,0 +1,87 @@
+from __future__ import absolute_import
+
+import logging
+import os
+import traceback
+from threading import Lock
+from time import time
+
+import django
+
+__all__ = ('ShadowReport', 'get_report')
+
+logger = logging.getLogger(__name__)
+
+# Frames from these are routing machinery, not the code doing the write.
+_SKIPPED_DIRS = tuple(os.path.dirname(os.path.abspath(path)) + os.sep
+                      for path in (django.__file__, __file__))
+
+def _call_site():
+    """Return "file:line in function" of the innermost frame outside Django and pindb."""
+    for filename, line, function, text in reversed(traceback.extract_stack()):
+        path = os.path.abspath(filename)
+        if path.startswith(_SKIPPED_DIRS):
+            continue
+        return "%s:%s in %s" % (filename, line, function)
+    return None
+
+def _label(model):
+    if model is None:
+        # Raw SQL; see pindb.raw.
+        return None
+    return "%s.%s" % (model._meta.app_label, model._meta.object_name.lower())
+
+class ShadowReport(object):
+    """Aggregate the writes ``StrictPinDbRouter`` would have refused.
+
+    Violations are grouped by (master alias, model, call site), so each
+    group is one missing ``pin()``. Each group keeps its count, when it was
+    first and last seen, and the reads which preceded its latest write in the
+    pinning context.
+
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self.violations = {}  # {(master alias, model label, call site): {...}}
+
+    def record(self, master_alias, model, reads):
+        key = (master_alias, _label(model), _call_site())
+        now_time = time()
+        reads = [(_label(read_model), alias) for read_model, alias in reads]
+        with self._lock:
+            violation = self.violations.get(key)
+            if violation is None:
+                violation = self.violations[key] = {'count': 0, 'first_seen': now_time}
+                logger.warning("Unpinned write to %s (%s) from %s", *key)
+            violation['count'] += 1
+            violation['last_seen'] = now_time
+            violation['reads'] = reads
+
+    def report(self):
+        """Return a list of violations, most frequent first.
+
+        Each is a dict of 'alias', 'model', 'call_site', 'count',
+        'first_seen', 'last_seen' and 'reads', a list of (model, alias).
+
+        """
+        with self._lock:
+            ret = [dict(violation, alias=alias, model=model, call_site=call_site)
+                   for (alias, model, call_site), violation in self.violations.items()]
+        ret.sort(key=lambda violation: (-violation['count'], violation['alias'],
+                                        violation['model'], violation['call_site']))
+        return ret
+
+    def reset(self):
+        with self._lock:
+            self.violations = {}
+
+_report = None
+_init_lock = Lock()
+def get_report():
+    """Return the process-wide report ``ShadowStrictPinDbRouter`` records into."""
+    global _report
+    if _report is None:
+        with _init_lock:
+            if _report is None:
+                _report = ShadowReport()
+    return _report
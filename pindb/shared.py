@@ -0,0 +1,283 @@
+from __future__ import absolute_import
+
+import fcntl
+import logging
+import mmap
+import os
+import struct
+from threading import Lock, Thread
+from time import sleep, time
+from zlib import crc32
+
+from django.conf import settings
+from django.core.signals import request_started
+
+from . import instrumentation, mark_healthy, mark_unhealthy, REPLICA_MASTERS
+from .health import check_topology, get_topology
+
+__all__ = ('SharedState', 'get_shared_state')
+
+logger = logging.getLogger(__name__)
+
+MAGIC = 'PINDBSHM'
+VERSION = 1
+# magic, version, number of aliases, number of worker slots, layout checksum
+HEADER = struct.Struct('<8sIIIi')
+# Written only by the elected prober: a sequence number (odd while a write is
+# in progress), healthy flag (0 unknown, 1 healthy, 2 unhealthy), lag
+# seconds (negative if unknown) and when it was last probed.
+HEALTH = struct.Struct('<IBxxxdd')
+# Written only by the worker owning the slot: queries in flight, queries run
+# and microseconds spent running them.
+LOAD = struct.Struct('<iQQ')
+
+UNKNOWN, HEALTHY, UNHEALTHY = 0, 1, 2
+
+class SharedState(object):
+    """Per-alias routing state shared by every worker process on a host.
+
+    The state lives in a file-backed mmap whose layout is derived from
+    ``aliases``: a header, a health record per alias, then a block of load
+    counters per worker slot. Each part has a single writer, so readers never
+    lock: one elected worker probes the DB topology and writes health and
+    lag, and each worker claims a slot for its own in-flight and query
+    counts, which readers sum. Slots and the election are held with
+    ``fcntl`` locks, so they're freed when a worker dies.
+
+    """
+    def __init__(self, path, aliases, slots=64):
+        self.path = path
+        self.aliases = sorted(aliases)
+        self.index = dict((alias, i) for i, alias in enumerate(self.aliases))
+        self.slots = slots
+        self.health_offset = HEADER.size
+        self.load_offset = self.health_offset + HEALTH.size * len(self.aliases)
+        self.size = self.load_offset + LOAD.size * len(self.aliases) * slots
+        # Byte-range locks past the end of the data: one per slot, then the
+        # prober election.
+        self.election_lock = self.size + slots
+
+        while True:
+            self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self.size, 0)
+            if os.fstat(self._fd).st_ino == os.stat(path).st_ino:
+                break
+            # Replaced while we waited for the lock; start over on the new file.
+            os.close(self._fd)
+        try:
+            self._map = None
+            if os.fstat(self._fd).st_size >= self.size:
+                self._map = mmap.mmap(self._fd, self.size)
+                if HEADER.unpack_from(self._map, 0) != self._header():
+                    self._map.close()
+                    self._map = None
+            if self._map is None:
+                # New, or laid out for other aliases: start afresh. Workers
+                # may still have the old layout mapped, so the file is
+                # replaced rather than resized under them.
+                fd = self._create()
+                os.close(self._fd)
+                self._fd = fd
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, self.size, 0)
+
+        self._lock = Lock()
+        self.pid = None
+        self.slot = None
+        self.elected = False
+
+    def _create(self):
+        """Lay out a new file, move it into place and return its descriptor."""
+        temp_path = '%s.%s' % (self.path, os.getpid())
+        fd = os.open(temp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0644)
+        os.ftruncate(fd, self.size)
+        self._map = mmap.mmap(fd, self.size)
+        HEADER.pack_into(self._map, 0, *self._header())
+        os.rename(temp_path, self.path)
+        return fd
+
+    def _header(self):
+        return (MAGIC, VERSION, len(self.aliases), self.slots,
+                crc32('\0'.join(self.aliases)))
+
+    def _ensure_process(self):
+        """Claim a slot for this process, again after a fork."""
+        if self.pid == os.getpid():
+            return
+        with self._lock:
+            if self.pid == os.getpid():
+                return
+            # fcntl locks aren't inherited across fork.
+            self.elected = False
+            self.slot = None
+            for slot in range(self.slots):
+                try:
+                    fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, self.size + slot)
+                except IOError:
+                    continue
+                self.slot = slot
+                self._clear_slot(slot)
+                break
+            else:
+                logger.warning("No free pindb shared state slot; load from pid %s won't be shared",
+                               os.getpid())
+            self.pid = os.getpid()
+
+    def _clear_slot(self, slot):
+        for i in range(len(self.aliases)):
+            LOAD.pack_into(self._map, self._load_at(slot, i), 0, 0, 0)
+
+    def _load_at(self, slot, i):
+        return self.load_offset + LOAD.size * (slot * len(self.aliases) + i)
+
+    # Health, written by the elected prober:
+    def try_elect(self):
+        """Become the prober if nobody else is. Return whether this process is."""
+        self._ensure_process()
+        if not self.elected:
+            try:
+                fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, self.election_lock)
+            except IOError:
+                return False
+            self.elected = True
+        return True
+
+    def set_health(self, alias, healthy, lag=None):
+        offset = self.health_offset + HEALTH.size * self.index[alias]
+        sequence = HEALTH.unpack_from(self._map, offset)[0]
+        struct.pack_into('<I', self._map, offset, sequence + 1)
+        HEALTH.pack_into(self._map, offset, sequence + 1,
+                         HEALTHY if healthy else UNHEALTHY,
+                         -1.0 if lag is None else lag, time())
+        # Only once the record is whole may readers take it.
+        struct.pack_into('<I', self._map, offset, sequence + 2)
+
+    def get_health(self, alias):
+        """Return (healthy, lag, time probed); each is None if unknown."""
+        offset = self.health_offset + HEALTH.size * self.index[alias]
+        # Retry reads which overlapped a write; give up waiting on a prober
+        # which died mid-write.
+        for attempt in range(100):
+            sequence, healthy, lag, updated = HEALTH.unpack_from(self._map, offset)
+            if sequence % 2 == 0 and HEALTH.unpack_from(self._map, offset)[0] == sequence:
+                break
+        if healthy == UNKNOWN:
+            return None, None, None
+        return healthy == HEALTHY, None if lag < 0 else lag, updated
+
+    # Load, written by each worker to its own slot; a pindb.instrumentation
+    # listener:
+    def query_started(self, alias, is_write):
+        self._ensure_process()
+        if self.slot is None or alias not in self.index:
+            return
+        offset = self._load_at(self.slot, self.index[alias])
+        with self._lock:
+            in_flight, queries, micros = LOAD.unpack_from(self._map, offset)
+            LOAD.pack_into(self._map, offset, in_flight + 1, queries, micros)
+
+    def query_finished(self, alias, is_write, seconds):
+        if self.slot is None or alias not in self.index:
+            return
+        offset = self._load_at(self.slot, self.index[alias])
+        with self._lock:
+            in_flight, queries, micros = LOAD.unpack_from(self._map, offset)
+            LOAD.pack_into(self._map, offset, in_flight - 1, queries + 1,
+                           micros + int(seconds * 1000000))
+
+    def report(self):
+        """Return {alias: {'healthy', 'lag', 'probed', 'in_flight', 'queries', 'seconds'}}."""
+        ret = {}
+        for alias, i in self.index.items():
+            healthy, lag, probed = self.get_health(alias)
+            in_flight = queries = micros = 0
+            for slot in range(self.slots):
+                counts = LOAD.unpack_from(self._map, self._load_at(slot, i))
+                in_flight += counts[0]
+                queries += counts[1]
+                micros += counts[2]
+            ret[alias] = {
+                'healthy': healthy,
+                'lag': lag,
+                'probed': probed,
+                'in_flight': in_flight,
+                'queries': queries,
+                'seconds': micros / 1000000.0,
+            }
+        return ret
+
+    def probe(self, **kwargs):
+        """Probe the topology and publish the results; for the elected prober."""
+        for result in check_topology(**kwargs):
+            if result.alias in self.index:
+                self.set_health(result.alias, result.healthy, result.lag)
+
+    def sync(self):
+        """Apply the shared health of replicas to this process' routing."""
+        for alias in self.aliases:
+            if alias not in REPLICA_MASTERS:
+                continue
+            healthy = self.get_health(alias)[0]
+            if healthy is True:
+                mark_healthy(alias)
+            elif healthy is False:
+                mark_unhealthy(alias)
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+def _run_prober(state, seconds, timeout):
+    while True:
+        if state.try_elect():
+            try:
+                state.probe(timeout=timeout)
+            except Exception:
+                logger.exception("pindb shared state probe failed")
+        sleep(seconds)
+
+_shared_state = None
+_prober_pid = None
+_last_sync = [0]
+_init_lock = Lock()
+def get_shared_state():
+    """Return the host-wide state configured by settings, or None if disabled.
+
+    Starts this process' prober thread, which probes only while elected, and
+    syncs shared replica health into routing as requests start.
+
+    """
+    global _shared_state, _prober_pid
+    path = getattr(settings, 'PINDB_SHARED_STATE_PATH', None)
+    if not path:
+        return None
+    with _init_lock:
+        if _shared_state is None:
+            aliases = []
+            for master, replicas in get_topology().items():
+                aliases.append(master)
+                aliases.extend(replicas)
+            _shared_state = SharedState(path, aliases,
+                getattr(settings, 'PINDB_SHARED_STATE_SLOTS', 64))
+            instrumentation.add_listener(_shared_state)
+            request_started.connect(_sync_at_request_start)
+        if _prober_pid != os.getpid() and getattr(settings, 'PINDB_SHARED_STATE_PROBE', True):
+            # (Re)start after a fork, which only copies the forking thread.
+            _prober_pid = os.getpid()
+            prober = Thread(target=_run_prober, name="pindb-prober", args=(
+                _shared_state,
+                getattr(settings, 'PINDB_SHARED_STATE_PROBE_SECONDS', 5.0),
+                getattr(settings, 'PINDB_SHARED_STATE_PROBE_TIMEOUT', 2.0)))
+            prober.daemon = True
+            prober.start()
+    return _shared_state
+
+def _sync_at_request_start(**kwargs):
+    if _shared_state is None:
+        return
+    if _prober_pid != os.getpid():
+        get_shared_state()
+    now_time = time()
+    if now_time - _last_sync[0] >= getattr(settings, 'PINDB_SHARED_STATE_SYNC_SECONDS', 1.0):
+        _last_sync[0] = now_time
+        _shared_state.sync()
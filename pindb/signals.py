@@ -0,0 +1,6 @@
+from __future__ import absolute_import
+
+from django.dispatch import Signal
+
+# Sent when a pindb router directs a write to a managed master.
+write_routed = Signal(providing_args=['alias', 'model'])
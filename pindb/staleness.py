@@ -0,0 +1,235 @@
+from __future__ import absolute_import
+
+import logging
+import os
+from hashlib import md5
+from Queue import Queue, Full, Empty
+from random import random
+from threading import Lock, Thread, local
+from time import time
+
+from django.conf import settings
+from django.db import connections, transaction
+
+from .instrumentation import add_cursor_wrapper, SAMPLING_ORDER, _is_write
+from .signals import write_routed
+
+__all__ = ('StalenessSampler', 'install', 'get_sampler')
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds, in seconds since the last write to a set, of the buckets
+# samples are counted in.
+BUCKETS = (1, 2, 5, 10, 15, 30, 60)
+
+# When this process last routed a write to each master.
+_last_writes = {}  # {master alias: time}
+
+def _bucket(seconds):
+    if seconds is None:
+        return 'no write seen'
+    lower = 0
+    for upper in BUCKETS:
+        if seconds < upper:
+            return '%s-%ss' % (lower, upper)
+        lower = upper
+    return '%ss+' % lower
+
+def _digest(rows):
+    """Hash a result set, ignoring row order, which only ORDER BY pins down."""
+    return md5('\n'.join(sorted(repr(tuple(row)) for row in rows))).hexdigest()
+
+class SampledCursor(object):
+    """Read a result set ahead to digest it, then hand the rows out as usual."""
+    def __init__(self, cursor, sampler, sample):
+        self.cursor = cursor
+        self.sampler = sampler
+        self.sample = sample  # (model label, master alias) or None once used
+        self.buffer = []
+
+    def execute(self, sql, params=()):
+        result = self.cursor.execute(sql, params)
+        sample, self.sample = self.sample, None
+        if sample is not None and not _is_write(sql):
+            self.buffer = list(self.cursor.fetchmany(self.sampler.max_rows + 1) or ())
+            if len(self.buffer) <= self.sampler.max_rows:
+                self.sampler.enqueue(sample[0], sample[1], sql, params,
+                                     _digest(self.buffer))
+        return result
+
+    def executemany(self, sql, param_list):
+        return self.cursor.executemany(sql, param_list)
+
+    def fetchone(self):
+        if self.buffer:
+            return self.buffer.pop(0)
+        return self.cursor.fetchone()
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.cursor.arraysize
+        if self.buffer:
+            rows, self.buffer = self.buffer[:size], self.buffer[size:]
+            return rows
+        return self.cursor.fetchmany(size)
+
+    def fetchall(self):
+        rows, self.buffer = self.buffer, []
+        return rows + list(self.cursor.fetchall())
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        while self.buffer:
+            yield self.buffer.pop(0)
+        for row in self.cursor:
+            yield row
+
+class StalenessSampler(object):
+    """Measure how often replica reads differ from what the master would say.
+
+    A ``rate`` share of the reads routed to replicas are read ahead and
+    digested, then re-run on the master by a background thread, which
+    compares digests. Samples are counted by model and by how long it had
+    been since this process last wrote to the set, so pinning windows can be
+    tuned from how soon after a write replicas stop disagreeing.
+
+    The master runs the query a little after the replica did, so a write in
+    between also counts as a mismatch; take rates as upper bounds. Results of
+    more than ``max_rows`` rows aren't sampled, and samples are dropped while
+    ``max_queue`` are waiting to be checked. With ``workers=0``, nothing
+    checks them until ``run_pending`` is called.
+
+    """
+    def __init__(self, rate, max_rows=1000, max_queue=100, workers=1):
+        self.rate = rate
+        self.max_rows = max_rows
+        self.workers = workers
+        self._local = local()
+        self._lock = Lock()
+        self._queue = Queue(max_queue)
+        self._worker_pid = None
+        self.counts = {}  # {(model label, bucket): [samples, mismatches]}
+        self.dropped = self.errors = 0
+
+    def consider(self, model, master_alias, replica_alias):
+        """Maybe sample the read about to run on ``replica_alias``; for the router."""
+        if random() < self.rate:
+            label = ('raw' if model is None else
+                     "%s.%s" % (model._meta.app_label, model._meta.object_name.lower()))
+            self._local.pending = (replica_alias, (label, master_alias))
+        else:
+            self._local.pending = None
+
+    def _take_pending(self, alias):
+        pending = getattr(self._local, 'pending', None)
+        if pending is not None and pending[0] == alias:
+            self._local.pending = None
+            return pending[1]
+        return None
+
+    def enqueue(self, label, master_alias, sql, params, digest):
+        last_write = _last_writes.get(master_alias)
+        since_write = None if last_write is None else time() - last_write
+        try:
+            self._queue.put_nowait((label, master_alias, sql, params, digest, since_write))
+        except Full:
+            with self._lock:
+                self.dropped += 1
+            return
+        if self.workers and self._worker_pid != os.getpid():
+            self._start_workers()
+
+    def _start_workers(self):
+        with self._lock:
+            if self._worker_pid == os.getpid():
+                return
+            # (Re)start after a fork, which only copies the forking thread.
+            self._worker_pid = os.getpid()
+            for i in range(self.workers):
+                worker = Thread(target=self._work, name="pindb-staleness-%s" % i)
+                worker.daemon = True
+                worker.start()
+
+    def _work(self):
+        while True:
+            self._check(*self._queue.get())
+
+    def run_pending(self):
+        """Check every waiting sample in this thread."""
+        while True:
+            try:
+                job = self._queue.get_nowait()
+            except Empty:
+                return
+            self._check(*job)
+
+    def _check(self, label, master_alias, sql, params, digest, since_write):
+        try:
+            cursor = connections[master_alias].cursor()
+            cursor.execute(sql, params)
+            matches = _digest(cursor.fetchall()) == digest
+            transaction.rollback_unless_managed(using=master_alias)
+        except Exception:
+            logger.debug("Couldn't re-run a sampled read on %s", master_alias, exc_info=True)
+            with self._lock:
+                self.errors += 1
+            return
+        with self._lock:
+            counts = self.counts.setdefault((label, _bucket(since_write)), [0, 0])
+            counts[0] += 1
+            if not matches:
+                counts[1] += 1
+
+    def report(self):
+        """Return {model label: {bucket: {'samples', 'mismatches', 'rate'}}}.
+
+        Buckets are seconds since the last write to the set, like '2-5s'.
+        Reads not made through the ORM are under 'raw'.
+
+        """
+        ret = {}
+        with self._lock:
+            for (label, bucket), (samples, mismatches) in self.counts.items():
+                ret.setdefault(label, {})[bucket] = {
+                    'samples': samples,
+                    'mismatches': mismatches,
+                    'rate': float(mismatches) / samples,
+                }
+        return ret
+
+    def reset(self):
+        with self._lock:
+            self.counts = {}
+            self.dropped = self.errors = 0
+
+def _sampled(connection, make_cursor):
+    cursor = make_cursor()
+    if _sampler is not None:
+        sample = _sampler._take_pending(connection.alias)
+        if sample is not None:
+            return SampledCursor(cursor, _sampler, sample)
+    return cursor
+
+def install():
+    """Read ahead sampled replica reads. Safe to call repeatedly."""
+    add_cursor_wrapper(_sampled, SAMPLING_ORDER)
+
+_sampler = None
+def get_sampler():
+    """Return the process-wide sampler configured by settings, or None if disabled."""
+    global _sampler
+    rate = getattr(settings, 'PINDB_STALENESS_SAMPLE_RATE', 0)
+    if not rate:
+        return None
+    if _sampler is None:
+        _sampler = StalenessSampler(rate,
+            max_rows=getattr(settings, 'PINDB_STALENESS_SAMPLE_MAX_ROWS', 1000),
+            max_queue=getattr(settings, 'PINDB_STALENESS_SAMPLE_QUEUE', 100))
+        install()
+    return _sampler
+
+def _note_write(sender, alias, **kwargs):
+    _last_writes[alias] = time()
+write_routed.connect(_note_write)
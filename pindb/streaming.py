@@ -0,0 +1,173 @@
+from __future__ import absolute_import
+
+import logging
+from random import randint
+
+from django.db import connections, router, transaction, DatabaseError
+from django.db.models.query import ValuesQuerySet, ValuesListQuerySet
+
+from . import (REPLICA_CANDIDATES, UNHEALTHY_REPLICAS, bulk_reads, get_replica,
+    is_enabled, _get_router)
+from .exceptions import ReplicaUnavailable
+from .health import _replication_lag
+
+__all__ = ('stream',)
+
+logger = logging.getLogger(__name__)
+
+def _master_for_read(model):
+    """Find the master of the DB set a model reads from without consulting pinning."""
+    pindb_router = _get_router()
+    if pindb_router is not None:
+        return pindb_router.master_for_read(model)
+    return router.db_for_read(model)
+
+def _keyed(queryset, key):
+    """Make ``queryset`` select ``key``, if it's of values() or values_list().
+
+    Return the queryset, a function of its rows returning their key, and one
+    returning each row as the original queryset would have.
+
+    """
+    if not isinstance(queryset, ValuesQuerySet):
+        return queryset, lambda row: getattr(row, key), lambda row: row
+
+    pk_name = queryset.model._meta.pk.attname
+    if queryset._fields:
+        names = list(queryset._fields)
+    else:
+        # Everything, in the order rows come in.
+        query = queryset.query
+        names = query.extra_select.keys() + queryset.field_names + query.aggregate_select.keys()
+    # The primary key may be asked for as 'pk' or by its field.
+    canonical = [pk_name if name == 'pk' else name for name in names]
+    key_name = pk_name if key == 'pk' else key
+    flat = getattr(queryset, 'flat', False)
+    added = key_name not in canonical
+    if added:
+        # Select the key too, after the rest, and drop it from the rows.
+        names.append(key)
+        canonical.append(key_name)
+        if isinstance(queryset, ValuesListQuerySet):
+            queryset = queryset.values_list(*names)
+        else:
+            queryset = queryset.values(*names)
+    index = canonical.index(key_name)
+
+    if isinstance(queryset, ValuesListQuerySet):
+        if flat and not added:
+            # Each row is the key itself.
+            return queryset, lambda row: row, lambda row: row
+        key_of = lambda row: row[index]
+        if not added:
+            return queryset, key_of, lambda row: row
+        return queryset, key_of, (lambda row: row[0]) if flat else (lambda row: row[:index])
+
+    name = names[index]
+    def without_key(row):
+        row = row.copy()
+        del row[name]
+        return row
+    return queryset, lambda row: row[name], without_key if added else (lambda row: row)
+
+class _Replicas(object):
+    """The replicas of one DB set a scan may use, in the order it falls back to them."""
+    def __init__(self, master_alias):
+        self.master_alias = master_alias
+        local, remote = REPLICA_CANDIDATES.get(master_alias, ([], []))
+        self.candidates = local + remote
+        self.abandoned = set()
+
+    def first(self):
+        if not self.candidates:
+            # A set without replicas is read from its master, as by the router.
+            return self.master_alias
+        # Start on a deeper tier, where there's one, out of the way of reads
+        # which need to be fresh.
+        with bulk_reads():
+            return get_replica(self.master_alias)
+
+    def any_healthy(self):
+        return any(candidate not in self.abandoned and candidate not in UNHEALTHY_REPLICAS
+                   for candidate in self.candidates)
+
+    def next(self, alias, reason):
+        """Give up on ``alias`` and return another replica to carry on with."""
+        logger.warning("Streaming from %s failed over from %s: %s",
+                       self.master_alias, alias, reason)
+        self.abandoned.add(alias)
+        connections[alias].close()
+        remaining = [candidate for candidate in self.candidates
+                     if candidate not in self.abandoned]
+        healthy = [candidate for candidate in remaining
+                   if candidate not in UNHEALTHY_REPLICAS]
+        remaining = healthy or remaining
+        if not remaining:
+            raise ReplicaUnavailable("No replica of %s is left to stream from (%s)" %
+                                     (self.master_alias, reason))
+        return remaining[randint(0, len(remaining) - 1)]
+
+def stream(queryset, chunk_size=1000, key='pk', max_lag=None):
+    """Iterate a large queryset from a single replica, a chunk at a time.
+
+    Rows are fetched ``chunk_size`` at a time in order of ``key``, a unique
+    field (any ordering of ``queryset`` is replaced), each chunk resuming
+    after the last row of the one before. So only a chunk is held in memory,
+    and nothing is pinned: the master isn't read unless the DB set has no
+    replicas.
+
+    Querysets of ``values()`` and ``values_list()`` work too; ``key`` is
+    selected alongside their fields if need be, and left out of the rows.
+
+    The scan stays on one replica, chosen as within ``bulk_reads``, and
+    checks on it between chunks. If it has been marked unhealthy, if it's
+    more than ``max_lag`` seconds behind (where the backend can tell), or if a
+    chunk fails with a DatabaseError, the scan carries on from the same row on
+    another replica of the set. Raise ``ReplicaUnavailable`` once every
+    replica has been given up on.
+
+    """
+    model = queryset.model
+    master_alias = _master_for_read(model)
+    if not is_enabled():
+        replicas = _Replicas(None)
+        alias = master_alias
+    else:
+        replicas = _Replicas(master_alias)
+        alias = replicas.first()
+
+    queryset, key_of, unkeyed = _keyed(queryset.order_by(key), key)
+    last = None
+    while True:
+        if alias in UNHEALTHY_REPLICAS and replicas.any_healthy():
+            alias = replicas.next(alias, "marked unhealthy")
+            continue
+        if max_lag is not None and alias != master_alias:
+            try:
+                lag = _replication_lag(connections[alias])
+            except DatabaseError, e:
+                alias = replicas.next(alias, e)
+                continue
+            if lag is not None and float(lag) > max_lag:
+                alias = replicas.next(alias, "%s seconds behind" % lag)
+                continue
+
+        chunk = queryset.using(alias)
+        if last is not None:
+            chunk = chunk.filter(**{'%s__gt' % key: last})
+        try:
+            rows = list(chunk[:chunk_size])
+            # Don't hold a transaction (and its snapshot) open on the replica
+            # for the whole scan.
+            transaction.rollback_unless_managed(using=alias)
+        except DatabaseError, e:
+            if alias == master_alias:
+                raise
+            alias = replicas.next(alias, e)
+            continue
+
+        for row in rows:
+            yield unkeyed(row)
+        if len(rows) < chunk_size:
+            return
+        last = key_of(rows[-1])
@@ -0,0 +1,136 @@
+from __future__ import absolute_import
+
+from threading import local
+
+from django.conf import settings
+from django.db import connections
+from django.test import TestCase
+
+from .health import get_topology
+
+__all__ = (
+    'share_connections', 'unshare_connections', 'record_queries',
+    'SharedConnectionsMixin', 'RoutingTestCase',
+)
+
+_recording = local()
+
+class SharedConnection(object):
+    """Stand in for an alias' connection, running its queries on another's.
+
+    Everything but ``alias`` and ``cursor`` is the master's, so transactions
+    begun on either are one and the same.
+
+    """
+    def __init__(self, alias, connection):
+        self.__dict__['alias'] = alias
+        self.__dict__['_connection'] = connection
+
+    def cursor(self):
+        cursor = self._connection.cursor()
+        queries = getattr(_recording, 'queries', None)
+        if queries is not None:
+            return RecordingCursor(cursor, self.alias, queries)
+        return cursor
+
+    def __getattr__(self, attr):
+        return getattr(self._connection, attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._connection, attr, value)
+
+class RecordingCursor(object):
+    """Note which alias each statement was routed to."""
+    def __init__(self, cursor, alias, queries):
+        self.cursor = cursor
+        self.alias = alias
+        self.queries = queries
+
+    def execute(self, sql, params=()):
+        self.queries.append((self.alias, sql))
+        return self.cursor.execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self.queries.append((self.alias, sql))
+        return self.cursor.executemany(sql, param_list)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+def share_connections():
+    """Make this thread's replica aliases use their master's connection.
+
+    Routing and pinning work as usual, but every query of a DB set runs on
+    one connection, so it sees data written in the master's (uncommitted)
+    test transaction and no extra connections are opened.
+
+    """
+    for master, replicas in get_topology().items():
+        connection = connections[master]
+        if isinstance(connection, SharedConnection):
+            continue
+        setattr(connections._connections, master, SharedConnection(master, connection))
+        for replica in replicas:
+            if replica in settings.DATABASES:
+                setattr(connections._connections, replica,
+                        SharedConnection(replica, connection))
+
+def unshare_connections():
+    """Undo ``share_connections`` for this thread."""
+    for master, replicas in get_topology().items():
+        for alias in [master] + replicas:
+            connection = getattr(connections._connections, alias, None)
+            if isinstance(connection, SharedConnection):
+                if alias == master:
+                    setattr(connections._connections, alias, connection._connection)
+                else:
+                    delattr(connections._connections, alias)
+
+class record_queries(object):
+    """
+    with record_queries() as queries:
+        ...
+
+    Collect (alias, sql) for each statement run on a shared connection, by
+    the alias it was routed to.
+    """
+    def __enter__(self):
+        self.previous = getattr(_recording, 'queries', None)
+        _recording.queries = []
+        return _recording.queries
+
+    def __exit__(self, type, value, tb):
+        _recording.queries = self.previous
+
+        if any((type, value, tb)):
+            raise type, value, tb
+
+class SharedConnectionsMixin(object):
+    """Share replicas' connections with their masters for each test.
+
+    Mix in ahead of a ``TestCase`` (with ``multi_db = True`` for DB sets other
+    than default) to run full pindb routing inside its transactions.
+
+    """
+    def _fixture_setup(self):
+        share_connections()
+        super(SharedConnectionsMixin, self)._fixture_setup()
+
+    def _fixture_teardown(self):
+        try:
+            super(SharedConnectionsMixin, self)._fixture_teardown()
+        finally:
+            unshare_connections()
+
+    def assertRoutedTo(self, aliases, func, *args, **kwargs):
+        """Assert that calling ``func`` ran queries on exactly ``aliases``."""
+        with record_queries() as queries:
+            result = func(*args, **kwargs)
+        self.assertEqual(set(alias for alias, sql in queries), set(aliases))
+        return result
+
+class RoutingTestCase(SharedConnectionsMixin, TestCase):
+    multi_db = True
@@ -1,13 +1,15 @@
 from __future__ import absolute_import
 
 from copy import deepcopy
-import os, tempfile
-from threading import local
+import os, sqlite3, subprocess, sys, tempfile, time
+from StringIO import StringIO
+from threading import local, Event, Thread
 
 from django import VERSION as dj_VERSION
 from django.http import HttpRequest, HttpResponse
 from django import db as dj_db
 from django.db.backends.dummy.base import DatabaseWrapper as DummyDatabaseWrapper
+from django.db import transaction
 from django.db.utils import ConnectionHandler, ConnectionRouter
 from django.conf import settings
 from django.core.management import call_command
@@ -24,11 +26,16 @@ import anyjson
 from mock import patch
 from override_settings import override_settings  # a backport from Django 1.4
 
+from test_project.loadtest import LoadTest
+from test_project.simulator import Simulation
 from test_project.test_app.models import HamModel, EggModel, FrobModel
+from test_project.test_app import unpinned, views
 
 import pindb
-from pindb import middleware
-from pindb.exceptions import PinDbConfigError, UnpinnedWriteException
+from pindb import (cache, health, histograms, instrumentation, shared, testing, learning, middleware, policies,
+    overlay, pool, pressure, raw, scatter, shadow, staleness, streaming, writebehind)
+from pindb.exceptions import (PinDbConfigError, UnpinnedWriteException, QueryTimeout,
+    ReplicaUnavailable)
 
 """
 Test writing without pinning
@@ -344,6 +351,57 @@ class NoDelegateTest(PinDbTestCase):
         self.assertEqual(pindb.get_replica("egg"), "egg")
         self.assertEqual(pindb.get_replica("frob"), "frob")
 
+    @patch("pindb.randint")
+    def test_propagate_pinning(self, mock_randint):
+        mock_randint.return_value = 1
+        pindb.pin("default")
+        self.assertEqual(pindb.get_replica("egg"), "egg")
+        self.assertEqual(pindb.get_replica("default"), "default-1")
+        seen = {}
+
+        def work():
+            mock_randint.return_value = 0
+            seen['replica'] = pindb.get_replica("default")
+            # Writes are allowed under the parent's pins:
+            seen['write'] = dj_db.router.db_for_write(HamModel)
+            pindb.pin("egg")
+
+        thread = Thread(target=pindb.propagate_pinning(work))
+        thread.start()
+        thread.join()
+        self.assertEqual(seen, {'replica': 'default-1', 'write': 'default'})
+        self.assertEqual(pindb.get_pinned(), set(["default", "egg"]))
+        self.assertEqual(pindb.get_newly_pinned(), set(["default", "egg"]))
+        self.assertEqual(pindb.get_written(), set(["default"]))
+
+    def test_pinning_snapshot(self):
+        pindb.pin("default", count_as_new=False)
+        snapshot = pindb.capture_pinning()
+        pindb.pin("egg")
+        self.assertEqual(snapshot.pinned_set, frozenset(["default"]))
+        pindb.install_pinning(snapshot)
+        self.assertEqual(pindb.get_pinned(), set(["default"]))
+        self.assertEqual(pindb.get_newly_pinned(), set())
+
+    def test_pinning_executor(self):
+        class InlineExecutor(object):
+            def submit(self, fn, *args, **kwargs):
+                return fn(*args, **kwargs)
+
+            def shutdown(self, wait=True):
+                pass
+
+        def work(alias):
+            # The submitting thread's pins are visible to the work:
+            self.assertTrue(pindb.is_pinned("default"))
+            pindb.pin(alias)
+            return alias
+
+        pindb.pin("default")
+        with pindb.PinningExecutor(InlineExecutor()) as executor:
+            self.assertEqual(executor.submit(work, "egg"), "egg")
+        self.assertEqual(pindb.get_pinned(), set(["default", "egg"]))
+
     def test_router(self):
         self.assertTrue(
             dj_db.router.db_for_read(HamModel) in ["default-0", "default-1"]
@@ -376,6 +434,217 @@ class NoDelegateTest(PinDbTestCase):
         self.assertTrue(dj_db.router.allow_syncdb("default", EggModel))
 
 
+zoned_settings = {
+    'DATABASE_ROUTERS': ['pindb.StrictPinDbRouter'],
+    'PINDB_ZONE': 'a',
+    'MASTER_DATABASES': {
+        'default':  {
+            'NAME': ':memory:',
+            'ENGINE': 'django.db.backends.sqlite3',
+        },
+    },
+    'DATABASE_SETS': {
+        'default': [{'ZONE': 'a'}, {'ZONE': 'b'}, {'ZONE': 'a'}],
+    },
+    'PINDB_DELEGATE_ROUTERS': None
+}
+populate_databases(zoned_settings)
+
+@override_settings(**zoned_settings)
+class ZoneTest(PinDbTestCase):
+    def tearDown(self):
+        pindb.UNHEALTHY_REPLICAS.clear()
+
+    def test_internals(self):
+        self.assertEqual(pindb.REPLICA_CANDIDATES['default'],
+                         (['default-0', 'default-2'], ['default-1']))
+
+    @patch("pindb.randint")
+    def test_prefers_local_zone(self, mock_randint):
+        mock_randint.return_value = 1
+        self.assertEqual(pindb.get_replica("default"), "default-2")
+        mock_randint.assert_called_with(0, 1)
+
+        pindb.unpin_all()
+        pindb.mark_unhealthy("default-2")
+        mock_randint.return_value = 0
+        self.assertEqual(pindb.get_replica("default"), "default-0")
+
+        # Spills over to other zones once nothing local is healthy:
+        pindb.unpin_all()
+        pindb.mark_unhealthy("default-0")
+        self.assertEqual(pindb.get_replica("default"), "default-1")
+
+        # With nothing healthy anywhere, use whatever's there:
+        pindb.unpin_all()
+        pindb.mark_unhealthy("default-1")
+        mock_randint.return_value = 2
+        self.assertEqual(pindb.get_replica("default"), "default-1")
+
+        pindb.unpin_all()
+        pindb.mark_healthy("default-2")
+        mock_randint.return_value = 0
+        self.assertEqual(pindb.get_replica("default"), "default-2")
+
+role_settings = deepcopy(zoned_settings)
+del role_settings['PINDB_ZONE']
+role_settings.update({
+    'PINDB_DEFAULT_REPLICA_ROLE': 'oltp',
+    'DATABASE_SETS': {
+        'default': [{'ROLE': 'reporting'}, {}, {'ROLE': 'oltp'}],
+    },
+})
+populate_databases(role_settings)
+
+@override_settings(**role_settings)
+class RoleTest(PinDbTestCase):
+    def tearDown(self):
+        pindb.UNHEALTHY_REPLICAS.clear()
+
+    @patch("pindb.randint")
+    def test_role_pools(self, mock_randint):
+        mock_randint.return_value = 0
+        self.assertEqual(pindb.REPLICA_ROLES, {'default-0': 'reporting'})
+        self.assertEqual(pindb.get_replica("default"), "default-1")
+        mock_randint.assert_called_with(0, 1)
+
+        with pindb.replica_role("reporting"):
+            self.assertEqual(pindb.get_replica("default"), "default-0")
+            mock_randint.assert_called_with(0, 0)
+            with pindb.replica_role("oltp"):
+                self.assertEqual(pindb.get_replica("default"), "default-1")
+        # Each role's choice is sticky on its own:
+        mock_randint.return_value = 1
+        self.assertEqual(pindb.get_replica("default"), "default-1")
+        with pindb.replica_role("reporting"):
+            self.assertEqual(pindb.get_replica("default"), "default-0")
+
+    @patch("pindb.randint")
+    def test_fallback(self, mock_randint):
+        mock_randint.return_value = 2
+        # Unknown roles read from any replica:
+        pindb.set_replica_role("batch")
+        self.assertEqual(pindb.get_replica("default"), "default-2")
+
+        pindb.unpin_all()
+        pindb.mark_unhealthy("default-0")
+        mock_randint.return_value = 0
+        with pindb.replica_role("reporting"):
+            self.assertEqual(pindb.get_replica("default"), "default-1")
+
+    def test_view_policy(self):
+        @policies.reads_from_role("reporting")
+        @policies.pins("default")
+        def view(request):
+            pass
+        policy = policies.get_view_policy(view)
+        self.assertEqual(policy.role, "reporting")
+        self.assertEqual(policy.pins, set(["default"]))
+
+        request = HttpRequest()
+        request._pinned_until = {}
+        middleware.PinDbMiddleware()._apply_policy(request, policy)
+        self.assertEqual(pindb.get_replica_role(), "reporting")
+
+tier_settings = deepcopy(zoned_settings)
+del tier_settings['PINDB_ZONE']
+tier_settings['DATABASE_SETS'] = {
+    'default': [{}, {'PARENT': 0}, {'PARENT': 'default-1'}, {}],
+}
+populate_databases(tier_settings)
+
+@override_settings(**tier_settings)
+class TierTest(PinDbTestCase):
+    def test_internals(self):
+        self.assertEqual([pindb.REPLICA_TIERS['default-%s' % i] for i in range(4)],
+                         [1, 2, 3, 1])
+        self.assertEqual(pindb.TIER_CANDIDATES['default'], {
+            'fresh': (['default-0', 'default-3'], []),
+            'bulk': (['default-1', 'default-2'], []),
+        })
+        self.assertRaises(PinDbConfigError, pindb._replica_tiers,
+                          'x', [{'PARENT': 1}, {'PARENT': 0}])
+        self.assertRaises(PinDbConfigError, pindb._replica_tiers, 'x', [{'PARENT': 1}])
+
+    @patch("pindb.randint")
+    def test_tiers(self, mock_randint):
+        mock_randint.return_value = 1
+        self.assertEqual(pindb.get_replica("default"), "default-1")
+        with pindb.bulk_reads():
+            self.assertEqual(pindb.get_replica("default"), "default-2")
+        pindb.prefer_fresh("default")
+        self.assertEqual(pindb.get_replica("default"), "default-3")
+        # Sticky as ever, until the pinning context ends:
+        mock_randint.return_value = 0
+        self.assertEqual(pindb.get_replica("default"), "default-3")
+        pindb.unpin_all()
+        self.assertEqual(pindb.get_replica("default"), "default-0")
+
+    @patch("pindb.middleware.FRESH_READ_SECONDS", 10)
+    @patch("pindb.middleware.time")
+    @patch("pindb.randint")
+    def test_fresh_after_pin(self, mock_randint, mock_time):
+        mock_randint.return_value = 1
+        mw = middleware.PinDbMiddleware()
+        def request_at(now_time):
+            mock_time.return_value = now_time
+            request = HttpRequest()
+            request.COOKIES[middleware.PINNING_COOKIE] = anyjson.dumps([["default", 100]])
+            mw.process_request(request)
+            return pindb.is_pinned("default"), pindb.get_replica("default")
+
+        self.assertEqual(request_at(99), (True, "default-1"))
+        self.assertEqual(request_at(105), (False, "default-3"))
+        self.assertEqual(request_at(111), (False, "default-1"))
+
+slow_start_settings = deepcopy(zoned_settings)
+del slow_start_settings['PINDB_ZONE']
+slow_start_settings.update({
+    'PINDB_SLOW_START_SECONDS': 10,
+    'DATABASE_SETS': {'default': [{}, {}, {}]},
+})
+populate_databases(slow_start_settings)
+
+@override_settings(**slow_start_settings)
+class SlowStartTest(PinDbTestCase):
+    def tearDown(self):
+        pindb.UNHEALTHY_REPLICAS.clear()
+        pindb.RAMPING_REPLICAS.clear()
+
+    def _choose(self, mock_random, point):
+        pindb.unpin_all()
+        mock_random.return_value = point
+        return pindb.get_replica("default")
+
+    @patch("pindb.random")
+    @patch("pindb.time")
+    def test_ramp(self, mock_time, mock_random):
+        mock_time.return_value = 100
+        pindb.mark_healthy("default-0")
+        self.assertEqual(pindb.RAMPING_REPLICAS, {})  # wasn't unhealthy
+        pindb.mark_unhealthy("default-0")
+        pindb.mark_healthy("default-0")
+        self.assertEqual(pindb.RAMPING_REPLICAS, {"default-0": 100})
+
+        # Weights start at 0.05, 1, 1:
+        self.assertEqual(self._choose(mock_random, 0.02), "default-0")
+        self.assertEqual(self._choose(mock_random, 0.03), "default-1")
+        # Halfway through, 0.525, 1, 1:
+        mock_time.return_value = 105
+        self.assertEqual(self._choose(mock_random, 0.2), "default-0")
+        with override_settings(PINDB_SLOW_START_CURVE='exponential'):
+            # 0.05 ** 0.5 = 0.22, 1, 1:
+            self.assertEqual(self._choose(mock_random, 0.2), "default-1")
+
+        # Once ramped up, choosing is back to the usual randint:
+        mock_time.return_value = 110
+        self._choose(mock_random, 0.5)
+        self.assertEqual(pindb.RAMPING_REPLICAS, {})
+        with patch("pindb.randint") as mock_randint:
+            mock_randint.return_value = 0
+            self.assertEqual(self._choose(mock_random, 0.99), "default-0")
+
+
 delegate_strict_router_settings = {
     'DATABASE_ROUTERS': ['pindb.StrictPinDbRouter'],
     'DATABASES': {
@@ -410,6 +679,28 @@ class FullyConfiguredStrictTest(PinDbTestCase):
         self.assertEqual(pindb.DB_SET_SIZES['default'], -1)
         self.assertEqual(pindb.DB_SET_SIZES['egg'], 1)
 
+    @patch("pindb.randint")
+    def test_raw_strict(self, mock_randint):
+        mock_randint.return_value = 1
+        self.assertEqual(raw.resolve("egg"), "egg-1")
+        self.assertRaises(UnpinnedWriteException, raw.resolve, "egg", write=True)
+        pindb.pin("egg")
+        self.assertEqual(raw.resolve("egg"), "egg")
+        self.assertEqual(raw.resolve("egg", write=True), "egg")
+        self.assertEqual(raw.resolve("frob", write=True), "frob")
+
+    def test_predicted_pins(self):
+        # Predicted pins allow writes, but count as new only once written,
+        pindb.pin("egg", count_as_new=False, reason="predicted")
+        self.assertFalse(pindb.is_newly_pinned("egg"))
+        EggModel.objects.create()
+        self.assertTrue(pindb.is_newly_pinned("egg"))
+        # as do a view policy's:
+        pindb.unpin_all()
+        pindb.pin("egg", count_as_new=False, reason="policy")
+        EggModel.objects.create()
+        self.assertTrue(pindb.is_newly_pinned("egg"))
+
     def test_pinning(self):
         # pinning is reflected in is_pinned
         for master in settings.MASTER_DATABASES:
@@ -532,8 +823,56 @@ delegate_greedy_router_settings = {
     'PINDB_DELEGATE_ROUTERS': ['test_project.router.HamAndEggRouter']
 }
 greedy_middleware_settings = deepcopy(delegate_greedy_router_settings)
+view_policy_settings = deepcopy(delegate_greedy_router_settings)
+simulation_settings = deepcopy(delegate_greedy_router_settings)
+simulation_settings['DATABASE_SETS'] = {'default': [{}, {}], 'egg': [{}]}
+load_test_settings = deepcopy(simulation_settings)
+health_settings = deepcopy(delegate_greedy_router_settings)
+shared_connections_settings = deepcopy(delegate_greedy_router_settings)
+pressure_settings = deepcopy(delegate_greedy_router_settings)
+pressure_settings.update({
+    'PINDB_MASTER_MAX_IN_FLIGHT': 1,
+    'PINDB_STALENESS_TOLERANT_MODELS': ['test_app.HamModel'],
+})
+shadow_strict_settings = deepcopy(delegate_greedy_router_settings)
+shadow_strict_settings.update({
+    'DATABASE_ROUTERS': ['pindb.ShadowStrictPinDbRouter'],
+    'PINDB_SHADOW_READS': 2,
+})
+pool_settings = deepcopy(delegate_greedy_router_settings)
+pool_settings.update({
+    'PINDB_REPLICA_POOL_SIZE': 1,
+    'PINDB_REPLICA_POOL_IDLE_SECONDS': 60,
+})
+streaming_settings = deepcopy(delegate_greedy_router_settings)
+overlay_settings = deepcopy(delegate_greedy_router_settings)
+overlay_settings.update({
+    'PINDB_ROW_OVERLAY_MODELS': ['test_app.EggModel'],
+    'PINDB_ROW_OVERLAY_MAX_ROWS': 2,
+})
+staleness_settings = deepcopy(delegate_greedy_router_settings)
+staleness_settings.update({
+    'PINDB_STALENESS_SAMPLE_RATE': 1.0,
+})
+write_prediction_settings = deepcopy(delegate_greedy_router_settings)
+write_prediction_settings.update({
+    'PINDB_WRITE_PREDICTION': True,
+    'PINDB_WRITE_PREDICTION_MIN_REQUESTS': 2,
+})
 populate_databases(delegate_greedy_router_settings)
 populate_databases(greedy_middleware_settings)  # for GreedyMiddlewareTest
+populate_databases(view_policy_settings)  # for ViewPolicyTest
+populate_databases(write_prediction_settings)  # for WritePredictionTest
+populate_databases(pressure_settings)  # for PressureTest
+populate_databases(shadow_strict_settings)  # for ShadowStrictTest
+populate_databases(pool_settings)  # for PoolTest
+populate_databases(streaming_settings)  # for StreamingTest
+populate_databases(overlay_settings)  # for OverlayTest
+populate_databases(staleness_settings)  # for StalenessTest
+populate_databases(simulation_settings)  # for SimulationTest
+populate_databases(load_test_settings)  # for LoadHarnessTest
+populate_databases(health_settings)  # for HealthTest
+populate_databases(shared_connections_settings)  # for SharedConnectionsTest
 
 @override_settings(**delegate_greedy_router_settings)
 class FullyConfiguredGreedyTest(PinDbTestCase):
@@ -575,6 +914,56 @@ class FullyConfiguredGreedyTest(PinDbTestCase):
         ham1a = HamModel.objects.get(pk=ham1.pk)
         egg1a = EggModel.objects.get(pk=egg1.pk)  # no longer bewm
 
+    @patch("pindb.randint")
+    def test_trace(self, mock_randint):
+        mock_randint.return_value = 0
+        dj_db.router.db_for_read(EggModel)
+        self.assertEqual(pindb.get_trace(), None)
+
+        pindb.start_trace()
+        dj_db.router.db_for_read(EggModel)
+        dj_db.router.db_for_write(EggModel)
+        dj_db.router.db_for_read(EggModel)
+        with pindb.unpinned_replica("egg"):
+            dj_db.router.db_for_read(EggModel)
+        dj_db.router.db_for_read(HamModel)
+        self.assertEqual(pindb.get_trace(), [
+            (EggModel, 'read', 'egg-0', 'replica'),
+            (EggModel, 'write', 'egg', 'greedy'),
+            (EggModel, 'read', 'egg', 'greedy'),
+            (EggModel, 'read', 'egg-0', 'unpinned_replica'),
+            (HamModel, 'read', 'default', 'no_replicas'),
+        ])
+        self.assertEqual(middleware._format_trace(middleware._summarize_trace(
+            [(EggModel, 'read', 'egg-0', 'replica')] * 2)),
+            "read test_app.eggmodel egg-0 replica x2")
+
+    @patch("pindb.randint")
+    def test_raw_greedy(self, mock_randint):
+        mock_randint.return_value = 0
+        pindb.start_trace()
+        cursor = raw.cursor("egg")
+        cursor.execute("SELECT COUNT(*) FROM test_app_eggmodel")
+        self.assertEqual(cursor.fetchone(), (0,))
+        self.assertEqual(raw.resolve("egg"), "egg-0")
+        # Writes pin, to be persisted like any others:
+        cursor = raw.cursor("egg", write=True)
+        cursor.execute("INSERT INTO test_app_eggmodel DEFAULT VALUES")
+        self.assertEqual(pindb.get_newly_pinned(), set(["egg"]))
+        self.assertEqual(pindb.get_written(), set(["egg"]))
+        self.assertEqual(raw.resolve("egg"), "egg")
+        self.assertEqual(pindb.get_trace()[-1], (None, "read", "egg", "greedy"))
+
+    def test_latency_histograms(self):
+        with override_settings(PINDB_LATENCY_HISTOGRAMS=True):
+            recorder = histograms.get_recorder()
+        try:
+            EggModel.objects.create()
+            self.assertEqual(recorder.report()['egg']['write']['count'], 1)
+        finally:
+            instrumentation.remove_listener(recorder)
+            histograms._recorder = None
+
     def test_new_pins_persist(self):
         """If a greedy router scoops up a new pinning, make sure it counts as new.
 
@@ -605,6 +994,124 @@ class FullyConfiguredGreedyTest(PinDbTestCase):
         egg = EggModel.objects.get(id=egg_id)
         self.assertEqual(dj_db.router.db_for_write(EggModel), "egg")
 
+    @patch("pindb.randint")
+    def test_scatter_gather(self, mock_randint):
+        mock_randint.return_value = 1
+        egg = EggModel.objects.create()
+        pindb.unpin_all()
+        pindb.pin("default")
+
+        results = dict((result.alias, result) for result in
+            scatter.scatter_gather(lambda db: db, ["default", "egg"]))
+        self.assertEqual(results["default"].result, "default")
+        self.assertEqual(results["egg"].result, "egg-1")
+
+        results = list(scatter.scatter_gather(EggModel.objects.all(), ["egg"]))
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0].db, "egg-1")
+        self.assertEqual(results[0].error, None)
+        self.assertEqual([e.pk for e in results[0].result], [egg.pk])
+
+    def test_query_cache(self):
+        query_cache = cache._query_cache = cache.QueryCache()
+        try:
+            EggModel.objects.create()
+            pindb.unpin_all()
+            self.assertEqual(len(cache.cached(EggModel.objects.all())), 1)
+            self.assertEqual(len(cache.cached(EggModel.objects.all())), 1)
+            self.assertEqual((query_cache.hits, query_cache.misses), (1, 1))
+
+            # Writing invalidates the set, and pinned reads skip the cache:
+            EggModel.objects.create()
+            self.assertEqual(len(query_cache), 0)
+            self.assertEqual(len(cache.cached(EggModel.objects.all())), 2)
+            self.assertEqual(len(query_cache), 0)
+            pindb.unpin_all()
+            self.assertEqual(len(cache.cached(EggModel.objects.all())), 2)
+            self.assertEqual((query_cache.hits, query_cache.misses), (1, 2))
+
+            # Saves bypassing the router invalidate too:
+            EggModel.objects.all()[0].save(using="egg")
+            self.assertEqual(len(query_cache), 0)
+
+            # Querysets with the same SQL but different rows don't collide:
+            pindb.unpin_all()
+            pks = sorted(egg.pk for egg in EggModel.objects.all())
+            self.assertEqual(sorted(row["id"] for row in
+                                    cache.cached(EggModel.objects.values("id"))), pks)
+            self.assertEqual(sorted(cache.cached(EggModel.objects.values_list("id"))),
+                             [(pk,) for pk in pks])
+            self.assertEqual(sorted(cache.cached(
+                EggModel.objects.values_list("id", flat=True))), pks)
+            egg = cache.cached(EggModel.objects.only("id"))[0]
+            self.assertTrue(isinstance(egg, EggModel))
+            # and cached instances aren't shared:
+            egg.cached_attribute = True
+            self.assertFalse(any(hasattr(other, "cached_attribute") for other in
+                                 cache.cached(EggModel.objects.only("id"))))
+        finally:
+            cache._query_cache = None
+
+    @patch("pindb.cache.time")
+    def test_query_cache_limits(self, mock_time):
+        mock_time.return_value = 100
+        query_cache = cache.QueryCache(max_rows=3, ttl=5)
+        query_cache._set(("egg", "a", ()), [1, 2], 5)
+        query_cache._set(("egg", "b", ()), [], 5)
+        self.assertEqual(query_cache._get(("egg", "a", ())), [1, 2])
+        # Evicts the least recently used entry:
+        query_cache._set(("egg", "c", ()), [3], 5)
+        self.assertEqual(query_cache._get(("egg", "b", ())), None)
+        self.assertEqual(query_cache.evictions, 1)
+        # Entries expire:
+        mock_time.return_value = 105
+        self.assertEqual(query_cache._get(("egg", "a", ())), None)
+
+    def test_write_behind(self):
+        buffered = writebehind.WriteBehind([EggModel], max_queue=2, background=False)
+        for i in range(3):
+            buffered.add(EggModel())
+        self.assertRaises(PinDbConfigError, buffered.add, HamModel())
+        self.assertEqual(EggModel.objects.using("egg").count(), 0)
+
+        buffered.flush()
+        self.assertEqual(EggModel.objects.using("egg").count(), 2)
+        # Nothing was pinned or routed as a write:
+        self.assertEqual(pindb.get_pinned(), set())
+        self.assertEqual(pindb.get_written(), set())
+        stats = buffered.stats()
+        self.assertEqual((stats['flushed'], stats['dropped'], stats['last_batch_size']),
+                         (2, 1, 2))
+
+    def test_write_behind_overflow(self):
+        buffered = writebehind.WriteBehind([EggModel], max_queue=1, overflow='sync',
+                                           background=False)
+        buffered.add(EggModel())
+        buffered.add(EggModel())
+        self.assertEqual(EggModel.objects.using("egg").count(), 1)
+        self.assertEqual(buffered.stats()['queued'], 1)
+
+        buffered = writebehind.WriteBehind([EggModel], flush_seconds=60)
+        buffered.add(EggModel())
+        buffered.stop()
+        self.assertEqual(EggModel.objects.using("egg").count(), 2)
+
+    def test_scatter_gather_errors(self):
+        release = Event()
+        def read(db):
+            if db == "default":
+                release.wait(5)
+                return "late"
+            raise ValueError(db)
+
+        try:
+            results = dict((result.alias, result) for result in
+                scatter.scatter_gather(read, ["default", "egg"], max_workers=2, timeout=0.05))
+        finally:
+            release.set()
+        self.assertTrue(isinstance(results["default"].error, QueryTimeout))
+        self.assertTrue(isinstance(results["egg"].error, ValueError))
+
 
 @override_settings(**greedy_middleware_settings)
 class GreedyMiddlewareTest(PinDbTestCase):
@@ -637,6 +1144,713 @@ class GreedyMiddlewareTest(PinDbTestCase):
     def test_bad_cookie(self):
         self.assertEquals(middleware._get_request_pins('bad thing'), [])
 
+    @patch('pindb.middleware._get_request_pins', wraps=middleware._get_request_pins)
+    @patch('pindb.middleware.time')
+    def test_lazy_cookie(self, mock_time, mock_get_request_pins):
+        mock_time.return_value = 1
+        mw = middleware.PinDbMiddleware()
+        def request():
+            request = HttpRequest()
+            request.COOKIES[middleware.PINNING_COOKIE] = anyjson.dumps([["default", 10]])
+            mw.process_request(request)
+            return request
+
+        # A request which never asks what's pinned leaves the cookie alone:
+        response = mw.process_response(request(), HttpResponse())
+        self.assertFalse(mock_get_request_pins.called)
+        self.assertFalse(middleware.PINNING_COOKIE in response.cookies)
+
+        req = request()
+        self.assertTrue(pindb.has_deferred_pins())
+        self.assertEqual(dj_db.router.db_for_read(HamModel), "default")
+        self.assertEqual(mock_get_request_pins.call_count, 1)
+        self.assertFalse(pindb.has_deferred_pins())
+        response = mw.process_response(req, HttpResponse())
+        self.assertEqual(anyjson.loads(response.cookies[middleware.PINNING_COOKIE].value),
+                         [["default", 10]])
+
+    @patch('pindb.middleware.TRACE', 'header')
+    def test_trace_header(self):
+        response = self.client.post('/test_app/write/')
+        trace = response[middleware.TRACE_HEADER]
+        self.assertTrue("write test_app.hammodel default greedy" in trace)
+
+        # The next request's reads are pinned by the cookie:
+        response = self.client.post('/test_app/read/')
+        self.assertTrue(response[middleware.TRACE_HEADER].startswith(
+            "read test_app.hammodel default cookie"))
+
+    @patch('pindb.middleware.TRACE', 'header')
+    @patch('pindb.middleware.TRACE_SAMPLE_RATE', 0.0)
+    def test_trace_sampling(self):
+        response = self.client.post('/test_app/write/')
+        self.assertFalse(response.has_header(middleware.TRACE_HEADER))
+
+@override_settings(**view_policy_settings)
+class ViewPolicyTest(PinDbTestCase):
+    def _set_request_pins(self, *pins):
+        self.client.cookies[middleware.PINNING_COOKIE] = anyjson.dumps(pins)
+
+    @patch('pindb.middleware.time')
+    def test_replicas_only(self, mock_time):
+        mock_time.return_value = 100
+        self._set_request_pins(["default", 110], ["egg", 110])
+        self.assertEqual(self.client.get('/test_app/show_pins/').content, "default,egg")
+
+        response = self.client.get('/test_app/replicas_only_pins/')
+        self.assertEqual(response.content, "")
+        # The carried-over pins still persist for later requests:
+        self.assertEqual(self._get_response_cookie('/test_app/replicas_only_pins/'),
+            [["default", 110], ["egg", 110]])
+
+    @patch('pindb.middleware.time')
+    def test_pins(self, mock_time):
+        mock_time.return_value = 100
+        response = self.client.get('/test_app/prepinned_pins/')
+        self.assertEqual(response.content, "egg")
+        # The pin isn't carried over unless the view writes:
+        self.assertFalse(middleware.PINNING_COOKIE in response.cookies)
+        self.assertEqual(self._get_response_cookie('/test_app/prepinned_saves/'),
+            [["egg", 100 + middleware.PINNING_SECONDS]])
+
+    @patch('pindb.middleware.time')
+    def test_staleness(self, mock_time):
+        mock_time.return_value = 100
+        # default was written 5 seconds ago, egg 3 seconds ago:
+        self._set_request_pins(
+            ["default", 95 + middleware.PINNING_SECONDS],
+            ["egg", 97 + middleware.PINNING_SECONDS])
+        response = self.client.get('/test_app/stale_ok_pins/')
+        self.assertEqual(response.content, "egg")
+
+    def test_url_name_table(self):
+        with override_settings(PINDB_VIEW_POLICIES={'show_pins': {'pins': ['default']}}):
+            response = self.client.get('/test_app/show_pins/')
+        self.assertEqual(response.content, "default")
+
+    def test_merged_decorators(self):
+        @policies.pins("egg")
+        @policies.tolerates_staleness(10)
+        @policies.tolerates_staleness(5)
+        def view(request):
+            pass
+        policy = policies.get_view_policy(view)
+        self.assertEqual(policy.pins, set(["egg"]))
+        self.assertEqual(policy.staleness, 5)
+
+    def test_misconfigured_table(self):
+        self.assertRaises(PinDbConfigError,
+            policies.compile_policies, {'show_pins': {'bogus': True}})
+        self.assertRaises(PinDbConfigError,
+            policies.compile_policies, {'show_pins': {'pins': ['nope']}})
+
+class WritePredictorTest(TransactionTestCase):
+    def test_threshold(self):
+        predictor = learning.WritePredictor(threshold=0.5, min_requests=4)
+        for written in [["default"], ["default", "egg"], [], ["default"]]:
+            self.assertEqual(predictor.predict("view"), frozenset())
+            predictor.observe("view", written)
+        self.assertEqual(predictor.predict("view"), frozenset(["default"]))
+        self.assertEqual(predictor.predict("other"), frozenset())
+
+    def test_export_load(self):
+        predictor = learning.WritePredictor(min_requests=1)
+        predictor.observe("view", ["egg"])
+        table = anyjson.loads(anyjson.dumps(predictor.export()))
+        self.assertEqual(table, {"view": {"requests": 1, "writes": {"egg": 1}}})
+
+        frozen = learning.WritePredictor(min_requests=1, table=table, frozen=True)
+        self.assertEqual(frozen.predict("view"), frozenset(["egg"]))
+        frozen.observe("view", [])
+        frozen.observe("view", [])
+        self.assertEqual(frozen.predict("view"), frozenset(["egg"]))
+        self.assertEqual(frozen.export(), table)
+
+class LatencyHistogramTest(TransactionTestCase):
+    def test_percentiles(self):
+        histogram = histograms.LatencyHistogram()
+        self.assertEqual(histogram.percentile(50), None)
+        for millis in range(1, 101):
+            histogram.record(millis / 1000.0)
+        self.assertEqual(histogram.count, 100)
+        self.assertAlmostEqual(histogram.mean(), 0.0505)
+        # Within the buckets' precision of 1/32:
+        self.assertAlmostEqual(histogram.percentile(50), 0.050, delta=0.050 / 32)
+        self.assertAlmostEqual(histogram.percentile(99), 0.099, delta=0.099 / 32)
+        self.assertEqual(histogram.percentile(0), histogram.percentile(1))
+
+        histogram.record(0.000005)
+        histogram.record(10 ** 9)  # capped rather than lost
+        self.assertEqual(histogram.percentile(0), 0.000005)
+
+    def test_merge_across_threads_and_processes(self):
+        recorder = histograms.LatencyRecorder()
+        def work(seconds):
+            for i in range(10):
+                recorder.query_finished('egg-0', False, seconds)
+        threads = [Thread(target=work, args=(0.001 * (i + 1),)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        recorder.query_finished('egg', True, 0.5)
+
+        report = recorder.report(percentiles=(50,))
+        self.assertEqual(report['egg-0']['read']['count'], 40)
+        self.assertAlmostEqual(report['egg-0']['read']['p50'], 0.002, delta=0.002 / 32)
+        self.assertEqual(report['egg']['write']['count'], 1)
+        # Finished threads' histograms are folded together:
+        self.assertEqual(len(recorder._threads), 1)
+
+        # Another process' recorder, say:
+        other = histograms.LatencyRecorder()
+        other.load(anyjson.loads(anyjson.dumps(recorder.export())))
+        other.load(recorder.export())
+        self.assertEqual(other.report()['egg-0']['read']['count'], 80)
+        other.reset()
+        self.assertEqual(other.report(), {})
+
+# Builds the routers as Django does: from DATABASE_ROUTERS, while django.db is
+# first imported.
+ROUTERS_FROM_SETTINGS = """
+from django.conf import settings
+settings.MASTER_DATABASES = {'default': settings.DATABASES['default']}
+settings.DATABASE_SETS = {'default': []}
+settings.DATABASE_ROUTERS = ['pindb.GreedyPinDbRouter']
+settings.PINDB_ROW_OVERLAY_MODELS = ['test_app.EggModel']
+import django.db
+from django.db.models.query import QuerySet
+from test_app.models import EggModel
+django.db.router.db_for_read(EggModel)
+assert QuerySet.get.__module__ == 'pindb.overlay'
+"""
+
+class RoutersFromSettingsTest(TransactionTestCase):
+    def test_import(self):
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        process = subprocess.Popen([sys.executable, '-W', 'ignore', '-c', ROUTERS_FROM_SETTINGS],
+                                   env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        self.assertEqual(process.returncode, 0, output)
+
+class SharedStateTest(TransactionTestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'pindb.shm')
+        self.state = shared.SharedState(self.path, ['a', 'a-0', 'a-1'], slots=4)
+
+    def tearDown(self):
+        self.state.close()
+        pindb.UNHEALTHY_REPLICAS.clear()
+
+    def test_health(self):
+        self.assertEqual(self.state.get_health('a-0'), (None, None, None))
+        self.assertTrue(self.state.try_elect())
+        self.state.set_health('a-0', False, 3.5)
+        self.state.set_health('a-1', True)
+
+        # Other workers see it through their own mapping of the file:
+        other = shared.SharedState(self.path, ['a-1', 'a-0', 'a'], slots=4)
+        healthy, lag, probed = other.get_health('a-0')
+        self.assertEqual((healthy, lag), (False, 3.5))
+        self.assertTrue(probed > 0)
+        with patch.dict(pindb.REPLICA_MASTERS, {'a-0': 'a', 'a-1': 'a'}):
+            pindb.mark_unhealthy('a-1')
+            other.sync()
+        self.assertEqual(pindb.UNHEALTHY_REPLICAS, set(['a-0']))
+
+        # A different topology gets a fresh layout:
+        other = shared.SharedState(self.path, ['a', 'a-0'], slots=4)
+        self.assertEqual(other.get_health('a-0'), (None, None, None))
+        # while workers with the old one keep reading theirs:
+        self.assertEqual(self.state.get_health('a-0')[:2], (False, 3.5))
+        self.assertEqual(sorted(self.state.report()), ['a', 'a-0', 'a-1'])
+        other.close()
+
+    def test_load_across_processes(self):
+        self.assertTrue(self.state.try_elect())
+        self.state.query_started('a', False)
+        self.state.query_started('a-0', False)
+        self.state.query_finished('a-0', False, 0.25)
+
+        pid = os.fork()
+        if not pid:
+            # A second worker gets its own slot, and isn't the prober:
+            self.state.query_started('a', False)
+            os._exit(0 if self.state.slot == 1 and not self.state.try_elect() else 1)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+        report = self.state.report()
+        self.assertEqual(report['a']['in_flight'], 2)
+        self.assertEqual(report['a-0']['in_flight'], 0)
+        self.assertEqual(report['a-0']['queries'], 1)
+        self.assertEqual(report['a-0']['seconds'], 0.25)
+
+@override_settings(**write_prediction_settings)
+class WritePredictionTest(PinDbTestCase):
+    # No super() calls: override_settings subclasses under the same name.
+    def setUp(self):
+        learning._predictor = None
+
+    def tearDown(self):
+        learning._predictor = None
+
+    def test_learns_writes(self):
+        self.client.post('/test_app/write/')
+        self.client.post('/test_app/read/')
+        self.assertEqual(learning.get_predictor().predict('write'), frozenset())
+        self.client.post('/test_app/write/')
+        self.client.post('/test_app/read/')
+        self.assertEqual(learning.get_predictor().predict('write'), frozenset(['default']))
+        self.assertEqual(learning.get_predictor().predict('read'), frozenset())
+
+    def test_prepins(self):
+        learning.get_predictor().load(
+            {'show_pins': {'requests': 2, 'writes': {'egg': 2}}})
+        self.assertEqual(self.client.get('/test_app/show_pins/').content, "egg")
+
+    def test_prepins_persist_only_writes(self):
+        learning.get_predictor().load({
+            'read': {'requests': 100, 'writes': {'default': 60}},
+            'write': {'requests': 100, 'writes': {'default': 60}},
+        })
+        # A predicted write which doesn't happen doesn't pin later requests:
+        response = self.client.post('/test_app/read/')
+        self.assertFalse(middleware.PINNING_COOKIE in response.cookies)
+        response = self.client.post('/test_app/write/')
+        self.assertEqual([alias for alias, until in anyjson.loads(
+            response.cookies[middleware.PINNING_COOKIE].value)], ["default"])
+
+    def test_start_and_finish_context(self):
+        learning.start_context('task')
+        self.assertEqual(pindb.get_pinned(), set())
+        for i in range(2):
+            pindb.unpin_all()
+            EggModel.objects.create()
+            learning.finish_context('task')
+        pindb.unpin_all()
+        learning.start_context('task')
+        self.assertEqual(pindb.get_pinned(), set(['egg']))
+
+@override_settings(**pressure_settings)
+class PressureTest(PinDbTestCase):
+    def tearDown(self):
+        instrumentation.remove_listener(pressure._monitor)
+        pressure._monitor = None
+
+    def test_measures_queries(self):
+        monitor = pressure.get_monitor()
+        self.assertTrue(dj_db.router.routers[0].pressure is monitor)
+        EggModel.objects.create()
+        self.assertEqual(monitor.in_flight["egg"], 0)
+        self.assertTrue(monitor.latency["egg"] >= 0)
+        self.assertFalse(monitor.under_pressure("egg"))
+
+    @patch("pindb.randint")
+    def test_degrades_tolerant_views(self, mock_randint):
+        mock_randint.return_value = 0
+        monitor = pressure.get_monitor()
+        mw = middleware.PinDbMiddleware()
+        def request():
+            request = HttpRequest()
+            # egg was written 2 seconds ago, within the view's 5 second bound:
+            request.COOKIES[middleware.PINNING_COOKIE] = anyjson.dumps(
+                [["egg", time.time() - 2 + middleware.PINNING_SECONDS]])
+            mw.process_request(request)
+            mw.process_view(request, views.stale_ok_pins, (), {})
+        request()
+        self.assertEqual(dj_db.router.db_for_read(EggModel), "egg")
+
+        # Under pressure, the view gives up the pin:
+        monitor.query_started("egg", False)
+        request()
+        self.assertEqual(dj_db.router.db_for_read(EggModel), "egg-0")
+        self.assertEqual(monitor.report()["egg"]["degraded"], 1)
+
+    @patch("pindb.randint")
+    def test_degrades_tolerant_reads(self, mock_randint):
+        mock_randint.return_value = 0
+        monitor = pressure.get_monitor()
+        # As pinned by the middleware's cookie after a write 10 seconds ago:
+        pindb.pin("egg", count_as_new=False, reason="cookie", written_at=time.time() - 10)
+        self.assertEqual(dj_db.router.db_for_read(EggModel), "egg")
+
+        monitor.query_started("egg", False)
+        # Must-be-fresh reads and writes stay on the master:
+        self.assertEqual(dj_db.router.db_for_read(EggModel), "egg")
+        pindb.set_staleness_tolerant(20)
+        self.assertEqual(dj_db.router.db_for_read(EggModel), "egg")
+        pindb.set_staleness_tolerant(5)
+        self.assertEqual(dj_db.router.db_for_read(EggModel), "egg-0")
+        pindb.set_staleness_tolerant()
+        self.assertEqual(dj_db.router.db_for_read(EggModel), "egg-0")
+        self.assertEqual(monitor.report()["egg"]["degraded"], 2)
+
+        # but not once this context writes to the set:
+        self.assertEqual(dj_db.router.db_for_write(EggModel), "egg")
+        self.assertEqual(dj_db.router.db_for_read(EggModel), "egg")
+        # nor when it pinned the set itself:
+        pindb.unpin_all()
+        pindb.set_staleness_tolerant()
+        pindb.pin("egg")
+        self.assertEqual(dj_db.router.db_for_read(EggModel), "egg")
+
+        # Tolerant models degrade too, but only if there's a replica to use:
+        pindb.set_staleness_tolerant(False)
+        pindb.pin("default", count_as_new=False, reason="cookie", written_at=time.time() - 10)
+        monitor.query_started("default", False)
+        self.assertEqual(dj_db.router.db_for_read(HamModel), "default")
+        self.assertFalse("default" in monitor.degraded)
+
+@override_settings(**shadow_strict_settings)
+class ShadowStrictTest(PinDbTestCase):
+    def tearDown(self):
+        shadow.get_report().reset()
+
+    @patch("pindb.shadow.logger")
+    @patch("pindb.randint")
+    def test_records_unpinned_writes(self, mock_randint, mock_logger):
+        mock_randint.return_value = 0
+        save_egg = unpinned.save_egg
+        save_egg()
+        self.assertTrue(pindb.is_pinned("egg"))
+        pindb.unpin_all()
+        save_egg()
+        pindb.unpin_all()
+        pindb.pin("egg")
+        EggModel.objects.create()
+
+        violations = shadow.get_report().report()
+        self.assertEqual(len(violations), 1)
+        violation = violations[0]
+        self.assertEqual(violation["alias"], "egg")
+        self.assertEqual(violation["model"], "test_app.eggmodel")
+        self.assertTrue(violation["call_site"].endswith("in save_egg"))
+        self.assertEqual(violation["count"], 2)
+        # The last PINDB_SHADOW_READS of them:
+        self.assertEqual(violation["reads"], [("test_app.eggmodel", "egg-0")] * 2)
+        # Logged when first seen:
+        self.assertEqual(mock_logger.warning.call_count, 1)
+
+@override_settings(**pool_settings)
+class PoolTest(PinDbTestCase):
+    def tearDown(self):
+        for replica_pool in pool._pools.values():
+            replica_pool.clear()
+        pool._pools = None
+
+    def test_cursor_wrapper_order(self):
+        # Wrappers nest by order, however they were added:
+        calls = []
+        def wrapper(name):
+            def wrap(connection, make_cursor):
+                calls.append(name)
+                return make_cursor()
+            return wrap
+        with patch.object(instrumentation, "_cursor_wrappers", []):
+            instrumentation.add_cursor_wrapper(wrapper("outer"), 10)
+            instrumentation.add_cursor_wrapper(wrapper("inner"), -10)
+            dj_db.connections["egg"].cursor()
+        self.assertEqual(calls, ["outer", "inner"])
+
+    @patch("pindb.pool.time")
+    def test_reuses_connections(self, mock_time):
+        mock_time.return_value = 1000
+        # Only replicas are pooled:
+        self.assertTrue("egg-1" in pool.get_pools())
+        self.assertFalse("egg" in pool.get_pools())
+        connection = dj_db.connections["egg-0"]
+        # Start afresh, from the test DB setup's connections:
+        connection.close()
+        replica_pool = pool._pools["egg-0"] = pool.ConnectionPool(
+            "egg-0", max_size=1, idle_seconds=60)
+        connection.cursor()
+        raw = connection.connection
+        self.assertEqual(replica_pool.report()["connected"], 1)
+
+        # As at the end of a request:
+        connection.close()
+        self.assertEqual(connection.connection, None)
+        self.assertEqual(replica_pool.report()["idle"], 1)
+        connection.cursor()
+        self.assertTrue(connection.connection is raw)
+        self.assertEqual(replica_pool.report()["reused"], 1)
+
+        # Only max_size are kept:
+        other = sqlite3.connect(":memory:")
+        replica_pool.checkin(other)
+        connection.close()
+        self.assertEqual(replica_pool.report()["closed_overflow"], 1)
+        # and closed ones can't come back:
+        replica_pool.checkin(raw)
+        self.assertEqual(replica_pool.report()["closed_invalid"], 1)
+
+        # Ones idle too long are closed:
+        mock_time.return_value = 1061
+        self.assertEqual(replica_pool.checkout(), None)
+        self.assertEqual(replica_pool.report()["closed_idle"], 1)
+
+        # As are ones which stop answering:
+        other = sqlite3.connect(":memory:")
+        replica_pool.checkin(other)
+        other.close()
+        self.assertEqual(replica_pool.checkout(), None)
+        self.assertEqual(replica_pool.report()["closed_invalid"], 2)
+        self.assertEqual(replica_pool.report()["idle"], 0)
+
+@override_settings(**streaming_settings)
+class StreamingTest(PinDbTestCase):
+    def setUp(self):
+        self.pks = [EggModel.objects.create().pk for i in range(25)]
+        pindb.unpin_all()
+
+    def tearDown(self):
+        pindb.UNHEALTHY_REPLICAS.clear()
+
+    @patch("pindb.streaming.logger")
+    @patch("pindb.randint")
+    def test_stream(self, mock_randint, mock_logger):
+        mock_randint.return_value = 0
+        rows = streaming.stream(EggModel.objects.order_by("-pk"), chunk_size=10)
+        self.assertEqual([row.pk for row in rows], self.pks)
+        self.assertFalse(mock_logger.warning.called)
+        self.assertEqual(pindb.get_pinned(), set())
+
+        # Failing over mid-scan neither repeats nor skips rows:
+        pks = []
+        for row in streaming.stream(EggModel.objects.values("pk"), chunk_size=10):
+            pks.append(row["pk"])
+            if len(pks) == 10:
+                pindb.mark_unhealthy("egg-0")
+        self.assertEqual(pks, self.pks)
+        self.assertEqual(mock_logger.warning.call_args[0][2], "egg-0")
+
+    @patch("pindb.randint")
+    def test_stream_values(self, mock_randint):
+        mock_randint.return_value = 0
+        # Rows come back as asked for, whether or not they include the key:
+        rows = streaming.stream(EggModel.objects.values_list("id", flat=True), chunk_size=10)
+        self.assertEqual(list(rows), self.pks)
+        rows = streaming.stream(EggModel.objects.values_list("pk"), chunk_size=10)
+        self.assertEqual(list(rows), [(pk,) for pk in self.pks])
+        queryset = EggModel.objects.extra(select={"one": "1"})
+        rows = streaming.stream(queryset.values_list("one", flat=True), chunk_size=10)
+        self.assertEqual(list(rows), [1] * len(self.pks))
+        rows = streaming.stream(queryset.values("one"), chunk_size=10)
+        self.assertEqual(list(rows), [{"one": 1}] * len(self.pks))
+
+    @patch("pindb.streaming.logger")
+    @patch("pindb.streaming._replication_lag")
+    @patch("pindb.randint")
+    def test_lag(self, mock_randint, mock_lag, mock_logger):
+        mock_randint.return_value = 0
+        lags = {"egg-0": 30, "egg-1": 1}
+        mock_lag.side_effect = lambda connection: lags[connection.alias]
+        rows = streaming.stream(EggModel.objects.all(), chunk_size=10, max_lag=5)
+        self.assertEqual([row.pk for row in rows], self.pks)
+        self.assertEqual(mock_logger.warning.call_args[0][2], "egg-0")
+
+        lags["egg-1"] = 30
+        rows = streaming.stream(EggModel.objects.all(), chunk_size=10, max_lag=5)
+        self.assertRaises(ReplicaUnavailable, list, rows)
+
+@override_settings(**overlay_settings)
+class OverlayTest(PinDbTestCase):
+    def setUp(self):
+        for alias in ["egg", "egg-0"]:
+            dj_db.connections[alias].use_debug_cursor = True
+
+    def tearDown(self):
+        overlay._overlay = None
+
+    def _reads_on(self, alias, func, *args, **kwargs):
+        """Return whether ``func`` queried ``alias``."""
+        queries = dj_db.connections[alias].queries
+        before = len(queries)
+        func(*args, **kwargs)
+        return len(queries) > before
+
+    @patch("pindb.randint")
+    def test_overlay(self, mock_randint):
+        mock_randint.return_value = 0
+        other = EggModel.objects.create()
+        pindb.unpin_all()
+
+        egg = EggModel.objects.create()
+        # The set isn't pinned, but the row is read back from the master:
+        self.assertFalse(pindb.is_pinned("egg"))
+        self.assertTrue(self._reads_on("egg", EggModel.objects.get, pk=egg.pk))
+        self.assertTrue(self._reads_on("egg", EggModel.objects.get, id__exact=str(egg.pk)))
+        self.assertTrue(self._reads_on("egg-0", EggModel.objects.get, pk=other.pk))
+        self.assertTrue(self._reads_on("egg-0", list, EggModel.objects.all()))
+        # as it is in other threads under the pinning context:
+        def lookup():
+            return self._reads_on("egg", EggModel.objects.get, pk=egg.pk)
+        self.assertTrue(pindb.propagate_pinning(lookup)())
+
+        # Past PINDB_ROW_OVERLAY_MAX_ROWS, the set is pinned after all:
+        EggModel.objects.create()
+        self.assertFalse(pindb.is_pinned("egg"))
+        EggModel.objects.create()
+        self.assertTrue(pindb.is_pinned("egg"))
+
+        # As it is by writes to rows it can't tell:
+        pindb.unpin_all()
+        EggModel.objects.filter(pk=egg.pk).update()
+        self.assertTrue(pindb.is_pinned("egg"))
+
+    @patch("pindb.middleware.time")
+    def test_cookie(self, mock_time):
+        mock_time.return_value = 1
+        mw = middleware.PinDbMiddleware()
+        request = HttpRequest()
+        mw.process_request(request)
+        egg = EggModel.objects.create()
+        response = mw.process_response(request, HttpResponse())
+        self.assertFalse(middleware.PINNING_COOKIE in response.cookies)
+        rows = anyjson.loads(response.cookies[middleware.OVERLAY_COOKIE].value)
+        self.assertEqual(rows, [["egg", "test_app.eggmodel", egg.pk,
+                                 1 + middleware.PINNING_SECONDS]])
+
+        request = HttpRequest()
+        request.COOKIES[middleware.OVERLAY_COOKIE] = anyjson.dumps(rows)
+        mw.process_request(request)
+        self.assertTrue(self._reads_on("egg", EggModel.objects.get, pk=egg.pk))
+        response = mw.process_response(request, HttpResponse())
+        self.assertEqual(anyjson.loads(response.cookies[middleware.OVERLAY_COOKIE].value),
+                         rows)
+
+@override_settings(**staleness_settings)
+class StalenessTest(PinDbTestCase):
+    def setUp(self):
+        self.sampler = staleness.get_sampler()
+        # Check samples in the test's thread, with run_pending.
+        self.sampler.workers = 0
+
+    def tearDown(self):
+        staleness._sampler = None
+
+    @patch("pindb.randint")
+    def test_staleness(self, mock_randint):
+        mock_randint.return_value = 0
+        EggModel.objects.create()
+        EggModel.objects.create()
+        pindb.unpin_all()
+
+        # Sampled reads come back whole:
+        self.assertEqual(len(EggModel.objects.all()), 2)
+        self.assertEqual(EggModel.objects.count(), 2)
+        self.sampler.run_pending()
+        self.assertEqual(self.sampler.report(), {"test_app.eggmodel": {
+            "0-1s": {"samples": 2, "mismatches": 0, "rate": 0.0}}})
+
+        # A replica which hasn't caught up with a write is counted:
+        self.sampler.reset()
+        self.assertEqual(len(EggModel.objects.all()), 2)
+        EggModel.objects.using("egg").create()
+        self.sampler.run_pending()
+        self.assertEqual(self.sampler.report()["test_app.eggmodel"]["0-1s"]["mismatches"], 1)
+
+        # Pinned reads aren't sampled, nor are results too large to hold:
+        self.sampler.reset()
+        pindb.pin("egg")
+        list(EggModel.objects.all())
+        pindb.unpin_all()
+        self.sampler.max_rows = 2
+        self.assertEqual(len(EggModel.objects.all()), 3)
+        self.sampler.run_pending()
+        self.assertEqual(self.sampler.report(), {})
+
+    def test_buckets(self):
+        self.assertEqual(staleness._bucket(None), "no write seen")
+        self.assertEqual(staleness._bucket(0.5), "0-1s")
+        self.assertEqual(staleness._bucket(12), "10-15s")
+        self.assertEqual(staleness._bucket(600), "60s+")
+
+@override_settings(**simulation_settings)
+class SimulationTest(PinDbTestCase):
+    mix = {'/test_app/read/': 0.6, '/test_app/write/': 0.4}
+
+    def test_pinning_outlasts_lag(self):
+        report = Simulation(users=5, lag=5, pinning_seconds=15, mix=self.mix).run(60)
+        self.assertEqual(report['errors'], 0)
+        self.assertEqual(report['stale_reads'], 0)
+        self.assertTrue(report['replica_reads'] > 0)
+        self.assertTrue(report['master_reads'] > 0)
+        self.assertTrue(report['pinned_requests'] > 0)
+
+    def test_lag_outlasts_pinning(self):
+        report = Simulation(users=5, lag=5, pinning_seconds=1, mix=self.mix).run(60)
+        self.assertTrue(report['stale_reads'] > 0)
+
+@override_settings(**load_test_settings)
+class LoadHarnessTest(PinDbTestCase):
+    def test_concurrent_requests(self):
+        report = LoadTest(users=8, threads=4).run(80)
+        self.assertEqual(report['requests'], 80)
+        self.assertEqual(report['errors'], 0)
+        # Pinning state mustn't leak between threads in either direction:
+        self.assertEqual(report['misrouted_reads'], 0)
+        self.assertEqual(report['leaked_pins'], 0)
+        self.assertTrue(report['replica_reads'] > 0)
+        self.assertTrue(report['pinned_requests'] > 0)
+
+@override_settings(**health_settings)
+class HealthTest(PinDbTestCase):
+    def tearDown(self):
+        pindb.UNHEALTHY_REPLICAS.clear()
+
+    def test_healthy(self):
+        out = StringIO()
+        call_command('pindb_health', json=True, stdout=out)
+        probes = anyjson.loads(out.getvalue())
+        self.assertEqual([(probe['alias'], probe['master'], probe['healthy'])
+                          for probe in probes],
+                         [('default', 'default', True), ('egg', 'egg', True),
+                          ('egg-0', 'egg', True), ('egg-1', 'egg', True)])
+        self.assertTrue(probes[0]['latency'] >= 0)
+
+    def test_no_healthy_replica(self):
+        databases = dj_db.connections.databases
+        old_names = dict((alias, databases[alias]['NAME']) for alias in ('egg-0', 'egg-1'))
+        try:
+            databases['egg-0']['NAME'] = os.path.join(tempfile.mkdtemp(), 'nope', 'db')
+            probes = health.check_topology(timeout=5)
+            self.assertEqual([probe.alias for probe in probes if not probe.healthy],
+                             ['egg-0'])
+            self.assertEqual(health.unhealthy_sets(probes), [])
+            health.update_health(probes)
+            self.assertEqual(pindb.UNHEALTHY_REPLICAS, set(['egg-0']))
+
+            databases['egg-1']['NAME'] = databases['egg-0']['NAME']
+            # Management commands exit with an error status on CommandError:
+            self.assertRaises(SystemExit, call_command, 'pindb_health',
+                              stdout=StringIO(), stderr=StringIO())
+        finally:
+            for alias, name in old_names.items():
+                databases[alias]['NAME'] = name
+
+@override_settings(**shared_connections_settings)
+class SharedConnectionsTest(testing.SharedConnectionsMixin, PinDbTestCase):
+    def test_shared(self):
+        replica, master = dj_db.connections['egg-0'], dj_db.connections['egg']
+        self.assertEqual((replica.alias, master.alias), ('egg-0', 'egg'))
+        self.assertTrue(replica._connection is master._connection)
+
+    @patch("pindb.randint")
+    def test_replicas_see_master_transaction(self, mock_randint):
+        mock_randint.return_value = 0
+        transaction.enter_transaction_management(using='egg')
+        transaction.managed(True, using='egg')
+        try:
+            egg = self.assertRoutedTo(['egg'], EggModel.objects.create)
+            with pindb.unpinned_replica('egg'):
+                eggs = self.assertRoutedTo(['egg-0'], list, EggModel.objects.all())
+            self.assertEqual(eggs, [egg])
+        finally:
+            transaction.rollback(using='egg')
+            transaction.leave_transaction_management(using='egg')
+        self.assertEqual(list(EggModel.objects.all()), [])
+
 disabled_settings = {
     'PINDB_ENABLED': False,
     'DATABASE_ROUTERS': ['pindb.GreedyPinDbRouter'],
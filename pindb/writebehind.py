@@ -0,0 +1,210 @@
+from __future__ import absolute_import
+
+import atexit
+import logging
+from threading import Condition, Event, Thread
+from time import time
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import connections, router
+from django.db.models import AutoField
+
+from . import _get_router
+from .exceptions import PinDbConfigError
+
+__all__ = ('WriteBehind', 'get_write_behind')
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = ('drop', 'block', 'sync')
+
+def _master_for_write(model):
+    """Find the master a model writes to without pinning anything."""
+    pindb_router = _get_router()
+    if pindb_router is not None:
+        return pindb_router.master_for_write(model)
+    return router.db_for_write(model)
+
+class WriteBehind(object):
+    """Buffer inserts for declared models and write them in bulk off the request path.
+
+    This is for logging-style tables which would otherwise be written with
+    ``master()`` or ``.using()``: rows go straight to the master of their DB
+    set, so nothing is pinned, and the request doesn't wait for them.
+
+    Rows are flushed by a background thread every ``flush_seconds``, as soon
+    as ``max_batch`` rows are waiting, when a request finishes, and at process
+    exit. Once ``max_queue`` rows are waiting, ``overflow`` decides what
+    happens to more: ``'drop'`` them (counted in ``dropped``), ``'block'``
+    until there's room, or ``'sync'`` flush inline.
+
+    """
+    def __init__(self, models=(), max_batch=500, flush_seconds=1.0,
+                 max_queue=10000, overflow='drop', background=True):
+        if overflow not in OVERFLOW_POLICIES:
+            raise PinDbConfigError("Unknown write-behind overflow policy %s" % overflow)
+        self.models = set(models)
+        self.max_batch = max_batch
+        self.flush_seconds = flush_seconds
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.background = background
+
+        self.flushes = self.flushed = self.dropped = self.failed = 0
+        self.last_flush_seconds = self.max_flush_seconds = 0.0
+        self.last_batch_size = self.max_batch_size = 0
+
+        self._room = Condition()
+        self._buffers = {}  # {master alias: [instance, ...]}
+        self._queued = 0
+        self._wakeup = Event()
+        self._stopping = False
+        self._thread = None
+
+    def register(self, model):
+        self.models.add(model)
+
+    def add(self, instance):
+        """Queue an unsaved model instance to be inserted later."""
+        model = instance.__class__
+        if model not in self.models:
+            raise PinDbConfigError("%s isn't declared for write-behind" % model.__name__)
+        alias = _master_for_write(model)
+
+        with self._room:
+            if self.overflow == 'block':
+                while self._queued >= self.max_queue:
+                    self._room.wait()
+            if self._queued < self.max_queue:
+                self._buffers.setdefault(alias, []).append(instance)
+                self._queued += 1
+                if self._queued >= self.max_batch:
+                    self._wakeup.set()
+                self._ensure_thread()
+                return
+            if self.overflow == 'drop':
+                self.dropped += 1
+                return
+        # 'sync': out of room, so do the flusher's work ourselves.
+        self.flush()
+        self.add(instance)
+
+    def flush(self):
+        """Write out everything queued so far."""
+        with self._room:
+            buffers, self._buffers = self._buffers, {}
+            self._queued = 0
+            self._room.notify_all()
+        if not buffers:
+            return
+
+        started = time()
+        batch_size = 0
+        for alias, instances in buffers.items():
+            by_model = {}
+            for instance in instances:
+                by_model.setdefault(instance.__class__, []).append(instance)
+            for model, rows in by_model.items():
+                try:
+                    self._insert(model, alias, rows)
+                except Exception:
+                    logger.exception("Write-behind flush of %s %s rows to %s failed",
+                                     len(rows), model.__name__, alias)
+                    self.failed += len(rows)
+                else:
+                    self.flushed += len(rows)
+                batch_size += len(rows)
+
+        self.flushes += 1
+        self.last_flush_seconds = time() - started
+        self.max_flush_seconds = max(self.max_flush_seconds, self.last_flush_seconds)
+        self.last_batch_size = batch_size
+        self.max_batch_size = max(self.max_batch_size, batch_size)
+
+    def _insert(self, model, alias, rows):
+        manager = model._default_manager.using(alias)
+        # Django < 1.4 has no bulk_create, and rows with no columns but an
+        # auto pk can't be inserted in bulk.
+        if (hasattr(manager, 'bulk_create') and
+                [f for f in model._meta.local_fields if not isinstance(f, AutoField)]):
+            manager.bulk_create(rows)
+        else:
+            for row in rows:
+                row.save(using=alias, force_insert=True)
+
+    def _ensure_thread(self):
+        if not self.background or self._thread is not None:
+            return
+        self._thread = Thread(target=self._run, name="pindb-write-behind")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.wait(self.flush_seconds)
+            self._wakeup.clear()
+            self.flush()
+            # Don't hold connections open between flushes.
+            for alias in settings.MASTER_DATABASES:
+                connections[alias].close()
+
+    def wake(self):
+        """Ask the background thread to flush now."""
+        self._wakeup.set()
+
+    def stop(self):
+        """Flush what's queued and stop the background thread."""
+        self._stopping = True
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            self._wakeup.set()
+            thread.join()
+        self.flush()
+        self._stopping = False
+
+    def stats(self):
+        return {
+            'queued': self._queued,
+            'flushes': self.flushes,
+            'flushed': self.flushed,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'last_flush_seconds': self.last_flush_seconds,
+            'max_flush_seconds': self.max_flush_seconds,
+            'last_batch_size': self.last_batch_size,
+            'max_batch_size': self.max_batch_size,
+        }
+
+def _load_models(paths):
+    from django.db.models import get_model
+    models = []
+    for path in paths:
+        model = get_model(*path.split('.', 1))
+        if model is None:
+            raise PinDbConfigError("Unknown write-behind model %s" % path)
+        models.append(model)
+    return models
+
+_write_behind = None
+def get_write_behind():
+    """Return the process-wide buffer configured by settings."""
+    global _write_behind
+    if _write_behind is None:
+        _write_behind = WriteBehind(
+            models=_load_models(getattr(settings, 'PINDB_WRITE_BEHIND_MODELS', ())),
+            max_batch=getattr(settings, 'PINDB_WRITE_BEHIND_BATCH', 500),
+            flush_seconds=getattr(settings, 'PINDB_WRITE_BEHIND_SECONDS', 1.0),
+            max_queue=getattr(settings, 'PINDB_WRITE_BEHIND_MAX_QUEUE', 10000),
+            overflow=getattr(settings, 'PINDB_WRITE_BEHIND_OVERFLOW', 'drop'))
+    return _write_behind
+
+def _wake_at_request_end(**kwargs):
+    if _write_behind is not None:
+        _write_behind.wake()
+request_finished.connect(_wake_at_request_end)
+
+def _flush_at_exit():
+    if _write_behind is not None:
+        _write_behind.stop()
+atexit.register(_flush_at_exit)
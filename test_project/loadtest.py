@@ -0,0 +1,261 @@
+"""Load-test the test_project views through a real WSGI handler.
+
+Worker threads play users, each with their own cookie jar, hitting the
+``test_app`` views through ``PinDbMiddleware`` with Django's ``WSGIHandler``,
+so connections are opened and closed per request as in production. Every
+alias gets a SQLite file, with replicas sharing their master's, so there is
+no lag and any replica read in a request which the cookie pinned is a routing
+mistake. The report gives throughput, latency percentiles, the master/replica
+split of reads, how often cookies pinned requests, and two correctness
+counts: ``misrouted_reads`` (replica reads of a pinned set) and
+``leaked_pins`` (master reads of a set the request neither had pinned nor
+wrote to, e.g. a pin leaking between threads).
+
+Run it directly for a report::
+
+    python test_project/loadtest.py --threads 8 --users 40 --requests 5000
+
+"""
+from __future__ import absolute_import
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+from Cookie import SimpleCookie
+from optparse import OptionParser
+from StringIO import StringIO
+from threading import Lock, Thread, local
+from time import sleep, time
+
+if __name__ == '__main__':
+    # Mirror the paths setup.py's test command uses, and settings must be
+    # chosen before django.db is imported.
+    here = os.path.dirname(os.path.abspath(__file__))
+    sys.path[:0] = [os.path.dirname(here), here]
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "test_project.simulator_settings")
+
+from django import db as dj_db
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management import call_command
+from django.db import connections
+from django.utils import importlib
+
+import pindb
+from pindb import instrumentation, middleware
+
+from test_project.simulator import DEFAULT_MIX, _percentile
+
+class LoadTest(object):
+    """Drive the test_app views from ``threads`` threads at once.
+
+    ``users`` users are shared out among the threads, so no two requests of
+    one user run at once. Each thread makes its share of requests back to
+    back, or ``think_time`` seconds apart on average.
+
+    """
+    def __init__(self, users=20, threads=4, mix=None, think_time=0, seed=0):
+        self.users = users
+        self.threads = threads
+        self.mix = sorted((mix or DEFAULT_MIX).items())
+        self.think_time = think_time
+        self.seed = seed
+        self.handler = WSGIHandler()
+        self._lock = Lock()
+        self._local = local()
+
+    # Listener interface for pindb.instrumentation, called on worker threads:
+    def query_started(self, alias, is_write):
+        pass
+
+    def query_finished(self, alias, is_write, seconds):
+        queries = getattr(self._local, 'queries', None)
+        if queries is not None:
+            queries.append((alias, is_write))
+
+    def setup(self):
+        self.db_dir = tempfile.mkdtemp()
+        self._old_names = {}
+        for alias in settings.DATABASES:
+            master = pindb.REPLICA_MASTERS.get(alias, alias)
+            self._use_file(alias, os.path.join(self.db_dir, master))
+        for alias in settings.MASTER_DATABASES:
+            call_command('syncdb', database=alias, interactive=False, verbosity=0)
+            connections[alias].close()
+
+    def _use_file(self, alias, path):
+        connections[alias].close()
+        settings_dict = connections.databases[alias]
+        self._old_names[alias] = settings_dict['NAME']
+        settings_dict['NAME'] = path
+
+    def teardown(self):
+        for alias, name in self._old_names.items():
+            connections[alias].close()
+            connections.databases[alias]['NAME'] = name
+        shutil.rmtree(self.db_dir, ignore_errors=True)
+
+    def _choose_view(self, rand):
+        point = rand.random()
+        for view, share in self.mix:
+            point -= share
+            if point < 0:
+                return view
+        return self.mix[-1][0]
+
+    def _request(self, path, jar):
+        """Make one POST to ``path`` as the user owning the cookie ``jar``."""
+        environ = {
+            'REQUEST_METHOD': 'POST',
+            'SCRIPT_NAME': '',
+            'PATH_INFO': path,
+            'QUERY_STRING': '',
+            'CONTENT_TYPE': 'application/octet-stream',
+            'CONTENT_LENGTH': '0',
+            'SERVER_NAME': 'loadtest',
+            'SERVER_PORT': '80',
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': StringIO(''),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        if jar:
+            environ['HTTP_COOKIE'] = '; '.join(
+                '%s=%s' % (name, morsel.coded_value) for name, morsel in jar.items())
+
+        response = {}
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = headers
+        body = self.handler(environ, start_response)
+        try:
+            for chunk in body:
+                pass
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+        for name, value in response['headers']:
+            if name.lower() == 'set-cookie':
+                cookie = SimpleCookie()
+                cookie.load(value)
+                jar.update(cookie)
+        return response['status']
+
+    def _work(self, index, requests, users, results):
+        rand = random.Random(self.seed + index)
+        jars = dict((user, {}) for user in users)
+        self._local.queries = None
+        for i in range(requests):
+            if self.think_time:
+                sleep(rand.expovariate(1.0 / self.think_time))
+            jar = jars[rand.choice(users)]
+            pins = set()
+            cookie = jar.get(middleware.PINNING_COOKIE)
+            if cookie is not None:
+                pins = set(alias for alias, until in
+                           middleware._get_request_pins(cookie.value))
+
+            self._local.queries = queries = []
+            started = time()
+            try:
+                status = self._request(self._choose_view(rand), jar)
+            except Exception:
+                status = None
+            seconds = time() - started
+            self._local.queries = None
+
+            written = set(alias for alias, is_write in queries
+                          if is_write and alias in settings.MASTER_DATABASES)
+            master_reads = replica_reads = misrouted = leaked = 0
+            for alias, is_write in queries:
+                if is_write:
+                    continue
+                if alias in pindb.REPLICA_MASTERS:
+                    replica_reads += 1
+                    if pindb.REPLICA_MASTERS[alias] in pins:
+                        misrouted += 1
+                else:
+                    master_reads += 1
+                    if (alias not in pins and alias not in written and
+                            pindb.DB_SET_SIZES.get(alias, -1) >= 0):
+                        leaked += 1
+            results.append((status, seconds, bool(pins), master_reads,
+                            replica_reads, misrouted, leaked))
+
+    def run(self, requests=1000):
+        """Make ``requests`` requests in all and return a report dict."""
+        self.setup()
+        instrumentation.add_listener(self)
+        results = []
+        workers = []
+        try:
+            started = time()
+            for index in range(self.threads):
+                share = (requests // self.threads +
+                         (1 if index < requests % self.threads else 0))
+                users = range(index, self.users, self.threads) or [index]
+                worker = Thread(target=self._work,
+                                args=(index, share, users, results),
+                                name="pindb-loadtest-%s" % index)
+                worker.daemon = True
+                workers.append(worker)
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time() - started
+        finally:
+            instrumentation.remove_listener(self)
+            self.teardown()
+
+        latencies = sorted(result[1] for result in results)
+        master_reads = sum(result[3] for result in results)
+        replica_reads = sum(result[4] for result in results)
+        reads = master_reads + replica_reads
+        pinned_requests = len([result for result in results if result[2]])
+        return {
+            'requests': len(results),
+            'errors': len([result for result in results
+                           if result[0] is None or result[0] >= 500]),
+            'seconds': elapsed,
+            'throughput': len(results) / elapsed if elapsed else None,
+            'pinned_requests': pinned_requests,
+            'pin_rate': float(pinned_requests) / len(results) if results else None,
+            'master_reads': master_reads,
+            'replica_reads': replica_reads,
+            'replica_share': float(replica_reads) / reads if reads else None,
+            'misrouted_reads': sum(result[5] for result in results),
+            'leaked_pins': sum(result[6] for result in results),
+            'latency_mean': sum(latencies) / len(latencies) if latencies else None,
+            'latency_p50': _percentile(latencies, 0.5),
+            'latency_p95': _percentile(latencies, 0.95),
+            'latency_p99': _percentile(latencies, 0.99),
+        }
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--router', default='pindb.GreedyPinDbRouter')
+    parser.add_option('--requests', type='int', default=1000)
+    parser.add_option('--users', type='int', default=20)
+    parser.add_option('--threads', type='int', default=4)
+    parser.add_option('--think-time', type='float', default=0.0)
+    parser.add_option('--seed', type='int', default=0)
+    options, args = parser.parse_args(argv)
+
+    module_path, class_name = options.router.rsplit('.', 1)
+    router_class = getattr(importlib.import_module(module_path), class_name)
+    dj_db.router.routers = [router_class()]
+    load_test = LoadTest(users=options.users, threads=options.threads,
+        think_time=options.think_time, seed=options.seed)
+    report = load_test.run(options.requests)
+    for key in sorted(report):
+        print "%-16s %s" % (key, report[key])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+"""Simulate replication lag against the test_project views.
+
+Each DB alias gets its own SQLite file. Replicas are brought up to date by
+copying snapshots of their master's file once they are older than the
+replica's lag, on a simulated clock, so runs are quick and repeatable. Users
+with their own cookies hit the ``test_app`` views through ``PinDbMiddleware``,
+and the report says how many reads were stale, how reads split between
+masters and replicas, and what latency looked like with injected per-alias
+query latency.
+
+Run it directly for a report::
+
+    python test_project/simulator.py --requests 2000 --lag 2 --pinning-seconds 1
+
+"""
+from __future__ import absolute_import
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+from optparse import OptionParser
+from time import time as wall_time
+
+if __name__ == '__main__':
+    # Mirror the paths setup.py's test command uses, and settings must be
+    # chosen before django.db is imported.
+    here = os.path.dirname(os.path.abspath(__file__))
+    sys.path[:0] = [os.path.dirname(here), here]
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "test_project.simulator_settings")
+
+from django import db as dj_db
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connections
+from django.test.client import Client
+from django.utils import importlib
+
+import pindb
+from pindb import instrumentation, middleware
+
+# {view: share of requests}
+DEFAULT_MIX = {
+    '/test_app/read/': 0.7,
+    '/test_app/write/': 0.1,
+    '/test_app/create_no_pins/': 0.1,
+    '/test_app/create_one_pin/': 0.1,
+}
+
+class SimulatedClock(object):
+    def __init__(self, now=1000000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+def _percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class Simulation(object):
+    """Drive the test_app views under simulated replication lag.
+
+    ``lag`` is the replication delay in seconds, either one for every replica
+    or a dict of {replica alias: seconds}. ``latency`` injects seconds per
+    query, as a dict of {alias: seconds}. ``think_time`` is the mean time
+    between requests. ``pinning_seconds`` overrides
+    ``PINDB_PINNING_SECONDS`` for the run.
+
+    """
+    def __init__(self, users=20, lag=1.0, latency=None, think_time=0.5,
+                 mix=None, pinning_seconds=None, seed=0):
+        self.users = users
+        self.lag = lag
+        self.latency = latency or {}
+        self.think_time = think_time
+        self.mix = sorted((mix or DEFAULT_MIX).items())
+        self.pinning_seconds = pinning_seconds
+        self.random = random.Random(seed)
+        self.clock = SimulatedClock()
+
+    def _lag_for(self, alias):
+        if isinstance(self.lag, dict):
+            return self.lag.get(alias, 0)
+        return self.lag
+
+    # Listener interface for pindb.instrumentation:
+    def query_started(self, alias, is_write):
+        pass
+
+    def query_finished(self, alias, is_write, seconds):
+        self._request_latency += self.latency.get(alias, 0)
+        if is_write:
+            if alias in settings.MASTER_DATABASES:
+                self._written.add(alias)
+        elif alias in pindb.REPLICA_MASTERS:
+            self.replica_reads += 1
+            self._replicas_read.add(alias)
+        else:
+            self.master_reads += 1
+
+    def setup(self):
+        self.db_dir = tempfile.mkdtemp()
+        self._old_names = {}
+        self.replicas = {}  # {master alias: [replica alias, ...]}
+        for alias in settings.MASTER_DATABASES:
+            self._use_file(alias)
+            call_command('syncdb', database=alias, interactive=False, verbosity=0)
+            self.replicas[alias] = [replica for replica, master in
+                pindb.REPLICA_MASTERS.items()
+                if master == alias and replica in settings.DATABASES]
+            for replica in self.replicas[alias]:
+                self._use_file(replica)
+        self.snapshots = dict((alias, []) for alias in self.replicas)
+        self.applied = {}  # {replica alias: time of the master state it has}
+        for alias in self.replicas:
+            self._snapshot(alias)
+            for replica in self.replicas[alias]:
+                self._apply(replica, self.snapshots[alias][0])
+
+    def _use_file(self, alias):
+        connection = connections[alias]
+        connection.close()
+        self._old_names[alias] = connection.settings_dict['NAME']
+        connection.settings_dict['NAME'] = os.path.join(self.db_dir, alias)
+
+    def _snapshot(self, alias):
+        connections[alias].close()
+        path = os.path.join(self.db_dir, "%s@%s" % (alias, len(self.snapshots[alias])))
+        shutil.copyfile(connections[alias].settings_dict['NAME'], path)
+        self.snapshots[alias].append((self.clock.now, path))
+
+    def _apply(self, replica, snapshot):
+        taken_at, path = snapshot
+        if self.applied.get(replica) == taken_at:
+            return
+        connections[replica].close()
+        shutil.copyfile(path, connections[replica].settings_dict['NAME'])
+        self.applied[replica] = taken_at
+
+    def _replicate(self):
+        """Bring each replica up to the newest master state older than its lag."""
+        for alias, replicas in self.replicas.items():
+            for replica in replicas:
+                visible_at = self.clock.now - self._lag_for(replica)
+                for snapshot in reversed(self.snapshots[alias]):
+                    if snapshot[0] <= visible_at:
+                        self._apply(replica, snapshot)
+                        break
+
+    def teardown(self):
+        for alias, name in self._old_names.items():
+            connections[alias].close()
+            connections[alias].settings_dict['NAME'] = name
+        shutil.rmtree(self.db_dir, ignore_errors=True)
+
+    def _choose_view(self):
+        point = self.random.random()
+        for view, share in self.mix:
+            point -= share
+            if point < 0:
+                return view
+        return self.mix[-1][0]
+
+    def run(self, requests=1000):
+        """Make ``requests`` requests and return a report dict."""
+        self.master_reads = self.replica_reads = 0
+        stale_reads = errors = pinned_requests = 0
+        latencies = []
+        clients = [Client() for i in range(self.users)]
+        last_writes = [{} for i in range(self.users)]  # {master alias: time}
+
+        old_time, old_seconds = middleware.time, middleware.PINNING_SECONDS
+        middleware.time = self.clock.time
+        if self.pinning_seconds is not None:
+            middleware.PINNING_SECONDS = self.pinning_seconds
+        self.setup()
+        instrumentation.add_listener(self)
+        try:
+            for i in range(requests):
+                self.clock.advance(self.random.expovariate(1.0 / self.think_time))
+                self._replicate()
+                user = self.random.randrange(self.users)
+                client = clients[user]
+                cookie = client.cookies.get(middleware.PINNING_COOKIE)
+                if cookie is not None and middleware._get_request_pins(cookie.value):
+                    pinned_requests += 1
+
+                self._request_latency = 0.0
+                self._written = set()
+                self._replicas_read = set()
+                started = wall_time()
+                try:
+                    client.post(self._choose_view())
+                except Exception:
+                    errors += 1
+                latencies.append(wall_time() - started + self._request_latency)
+
+                for replica in self._replicas_read:
+                    master = pindb.REPLICA_MASTERS[replica]
+                    if self.applied[replica] < last_writes[user].get(master, 0):
+                        stale_reads += 1
+                for alias in self._written:
+                    last_writes[user][alias] = self.clock.now
+                    self._snapshot(alias)
+        finally:
+            instrumentation.remove_listener(self)
+            self.teardown()
+            middleware.time, middleware.PINNING_SECONDS = old_time, old_seconds
+
+        latencies.sort()
+        reads = self.master_reads + self.replica_reads
+        return {
+            'requests': requests,
+            'errors': errors,
+            'pinned_requests': pinned_requests,
+            'master_reads': self.master_reads,
+            'replica_reads': self.replica_reads,
+            'replica_share': float(self.replica_reads) / reads if reads else None,
+            'stale_reads': stale_reads,
+            'latency_mean': sum(latencies) / len(latencies) if latencies else None,
+            'latency_p50': _percentile(latencies, 0.5),
+            'latency_p95': _percentile(latencies, 0.95),
+            'latency_p99': _percentile(latencies, 0.99),
+        }
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--router', default='pindb.GreedyPinDbRouter')
+    parser.add_option('--requests', type='int', default=1000)
+    parser.add_option('--users', type='int', default=20)
+    parser.add_option('--lag', type='float', default=1.0)
+    parser.add_option('--master-latency', type='float', default=0.0)
+    parser.add_option('--replica-latency', type='float', default=0.0)
+    parser.add_option('--think-time', type='float', default=0.5)
+    parser.add_option('--pinning-seconds', type='int', default=None)
+    parser.add_option('--seed', type='int', default=0)
+    options, args = parser.parse_args(argv)
+
+    module_path, class_name = options.router.rsplit('.', 1)
+    router_class = getattr(importlib.import_module(module_path), class_name)
+    dj_db.router.routers = [router_class()]
+    latency = {}
+    for alias in settings.MASTER_DATABASES:
+        latency[alias] = options.master_latency
+    for alias in settings.DATABASES:
+        latency.setdefault(alias, options.replica_latency)
+    simulation = Simulation(users=options.users, lag=options.lag, latency=latency,
+        think_time=options.think_time, pinning_seconds=options.pinning_seconds,
+        seed=options.seed)
+    report = simulation.run(options.requests)
+    for key in sorted(report):
+        print "%-16s %s" % (key, report[key])
+
+if __name__ == '__main__':
+    main()
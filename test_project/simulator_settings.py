@@ -0,0 +1,28 @@
+# Settings for running test_project/simulator.py and loadtest.py standalone:
+# every DB set gets replicas, and each alias is given a SQLite file at runtime.
+from test_project.settings import *
+from pindb import populate_replicas
+
+DEBUG = False
+
+MASTER_DATABASES = {
+    'default': {
+        'NAME': ':memory:',
+        'ENGINE': 'django.db.backends.sqlite3',
+    },
+    'egg': {
+        'NAME': ':memory:',
+        'ENGINE': 'django.db.backends.sqlite3',
+    },
+}
+
+DATABASE_SETS = {
+    'default': [{}, {}],
+    'egg': [{}, {}],
+}
+
+DATABASES = populate_replicas(MASTER_DATABASES, DATABASE_SETS)
+
+# The router is installed at runtime: routers that import models can't
+# be loaded while django.db is first being imported.
+PINDB_DELEGATE_ROUTERS = ['test_project.router.HamAndEggRouter']
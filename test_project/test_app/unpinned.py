@@ -0,0 +1,9 @@
+from .models import HamModel, EggModel
+
+def save_egg():
+    """Read, then write without pinning first; a call site outside pindb."""
+    list(HamModel.objects.all())
+    list(EggModel.objects.all())
+    list(EggModel.objects.all())
+    EggModel.objects.create()  # would raise under Strict
+    EggModel.objects.create()  # pinned by then, as under Greedy
@@ -7,4 +7,9 @@ urlpatterns = patterns('',
     url(r"write", views.write, name='write'),
     url(r"create_no_pins", views.create_no_pins, name='create_no_pins'),
     url(r"create_one_pin", views.create_one_pin, name='create_one_pin'),
+    url(r"^show_pins/$", views.show_pins, name='show_pins'),
+    url(r"^replicas_only_pins/$", views.replicas_only_pins, name='replicas_only_pins'),
+    url(r"^prepinned_pins/$", views.prepinned_pins, name='prepinned_pins'),
+    url(r"^prepinned_saves/$", views.prepinned_saves, name='prepinned_saves'),
+    url(r"^stale_ok_pins/$", views.stale_ok_pins, name='stale_ok_pins'),
 )
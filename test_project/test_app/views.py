@@ -1,6 +1,7 @@
 from django.http import HttpResponse
 from .models import HamModel, EggModel
 import pindb
+from pindb.policies import pins, replicas_only, tolerates_staleness
 
 def create_no_pins(request):
     with pindb.master("default"):
@@ -18,5 +19,25 @@ def write(request):
     return HttpResponse("write")
 
 def read(request):
-    HamModel.objects.all()
+    list(HamModel.objects.all())
     return HttpResponse("read")
+
+def show_pins(request):
+    return HttpResponse(",".join(sorted(pindb.get_pinned())))
+
+@replicas_only()
+def replicas_only_pins(request):
+    return show_pins(request)
+
+@pins(["egg"])
+def prepinned_pins(request):
+    return show_pins(request)
+
+@pins(["egg"])
+def prepinned_saves(request):
+    EggModel.objects.create()
+    return show_pins(request)
+
+@tolerates_staleness(5)
+def stale_ok_pins(request):
+    return show_pins(request)